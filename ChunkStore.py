@@ -0,0 +1,431 @@
+"""
+This program stores the content of the files as chunks
+named by their SHA-256 hash, shared by every user, so
+that the same content is only stored once.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+CHUNK_SIZE = 64 * 1024
+READ_ATTEMPTS = 3
+
+
+class ChunkReader():
+    """
+    Read only file object over a file of the chunk store, used to
+    download it like a file on the disk.
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.position = 0
+
+    def read(self, count):
+        data = self.store.read(self.path, self.position, count)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class ChunkStore():
+    """
+    Content addressed storage of the files, shared by every connection.
+    --------
+    The content of a file is cut in chunks of CHUNK_SIZE bytes, stored once
+    in self.folder under their SHA-256 hash and counted by the number of
+    files using them. The manifest of a file, in the SQLite database, lists
+    its chunks and keeps the last partial chunk, so that an append only
+    writes the chunks it completes.
+    --------
+    The file in the folder of the user is kept as a sparse file of the size
+    of the content, so listings, find and the directory cache see the right
+    size while the content is read from the chunks.
+    --------
+    Only the files written while self.enabled is True are stored as chunks.
+    The other files stay plain files and are read from the disk.
+    --------
+    The chunks read are kept in an LRU cache of at most cache_bytes bytes.
+    ========
+    Methods:
+    --------
+    manages(): Tells if a file is stored as chunks.
+    --------
+    append() / import_file(): Append data to a file, replace a file by another one.
+    --------
+    read() / open(): Read a part of a file, open it for reading.
+    --------
+    remove(): Forgets a file and the chunks no other file uses.
+    --------
+    copy() / move_tree(): Copy a file by using its chunks once more, move the
+                          files of a folder.
+    --------
+    managed_under(): Returns the files of a folder stored as chunks.
+    --------
+    stats(): Returns the deduplication ratio and the hit rate of the cache.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, folder="ChunkStore", enabled=False, cache_bytes=32 * 1024 * 1024):
+        self.folder = folder
+        self.database = os.path.join(folder, "manifests.db")
+        self.enabled = enabled
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.identity = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the chunk store of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _connect(self):
+        """
+        Opens the database, again when it was removed since it was opened.
+        The lock must be held.
+        """
+        try:
+            status = os.stat(self.database)
+            identity = (status.st_dev, status.st_ino)
+        except FileNotFoundError:
+            identity = None
+        if self.connection is not None and identity == self.identity:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, "
+                                "size INTEGER NOT NULL, refs INTEGER NOT NULL) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                                "chunks INTEGER NOT NULL, tail BLOB NOT NULL) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS file_chunks (path TEXT NOT NULL, number INTEGER NOT NULL, "
+                                "hash TEXT NOT NULL, PRIMARY KEY (path, number)) WITHOUT ROWID")
+        status = os.stat(self.database)
+        self.identity = (status.st_dev, status.st_ino)
+        return self.connection
+
+    @staticmethod
+    def _key(path):
+        return os.path.normpath(path)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def manages(self, path):
+        """
+        Returns True if the file is stored as chunks.
+        """
+        if self._unused():
+            return False
+        with self._lock:
+            return self._connect().execute("SELECT 1 FROM files WHERE path = ?",
+                                           (self._key(path),)).fetchone() is not None
+
+    def _store_chunk(self, connection, data):
+        """
+        Stores a chunk, or counts one more use of it when it is already
+        stored, and returns its hash.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if connection.execute("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", (digest,)).rowcount:
+            return digest
+        path = self._chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".chunk-")
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        connection.execute("INSERT INTO chunks VALUES (?, ?, 1)", (digest, len(data)))
+        return digest
+
+    def _release_chunks(self, connection, key):
+        """
+        Forgets the chunks of a file and removes the ones no file uses any more.
+        """
+        digests = [row[0] for row in connection.execute("SELECT hash FROM file_chunks WHERE path = ?", (key,))]
+        connection.execute("DELETE FROM file_chunks WHERE path = ?", (key,))
+        for digest in digests:
+            connection.execute("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", (digest,))
+            if connection.execute("DELETE FROM chunks WHERE hash = ? AND refs <= 0", (digest,)).rowcount:
+                try:
+                    os.remove(self._chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _placeholder(path, size):
+        """
+        Sets the file in the folder of the user to a sparse file of the size.
+        """
+        with open(path, "ab"):
+            pass
+        os.truncate(path, size)
+
+    def append(self, path, data):
+        """
+        Appends the bytes to the file, creating it if needed, and returns
+        the size of the file. Only the chunks completed by the data are written.
+        """
+        key = self._key(path)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT size, chunks, tail FROM files WHERE path = ?", (key,)).fetchone()
+                size, chunks, tail = row if row is not None else (0, 0, b"")
+                tail = bytes(tail) + data
+                start = 0
+                while len(tail) - start >= CHUNK_SIZE:
+                    digest = self._store_chunk(connection, tail[start:start + CHUNK_SIZE])
+                    connection.execute("INSERT INTO file_chunks VALUES (?, ?, ?)", (key, chunks, digest))
+                    chunks += 1
+                    start += CHUNK_SIZE
+                size += len(data)
+                connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                   (key, size, chunks, tail[start:]))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._placeholder(path, size)
+        return size
+
+    def import_file(self, source, path):
+        """
+        Replaces the file by the content of the source file, which is removed,
+        and returns the size of the file.
+        """
+        key = self._key(path)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._release_chunks(connection, key)
+                size = chunks = 0
+                tail = b""
+                with open(source, "rb") as file:
+                    while True:
+                        data = file.read(CHUNK_SIZE)
+                        size += len(data)
+                        if len(data) < CHUNK_SIZE:
+                            tail = data
+                            break
+                        digest = self._store_chunk(connection, data)
+                        connection.execute("INSERT INTO file_chunks VALUES (?, ?, ?)", (key, chunks, digest))
+                        chunks += 1
+                connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (key, size, chunks, tail))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._placeholder(path, size)
+        os.remove(source)
+        return size
+
+    def remove(self, path):
+        """
+        Forgets the file. The file in the folder of the user is not removed.
+        """
+        key = self._key(path)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._release_chunks(connection, key)
+                connection.execute("DELETE FROM files WHERE path = ?", (key,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _unused(self):
+        """
+        Returns True when no file was ever stored as chunks, so there is
+        nothing to look up.
+        """
+        return not self.enabled and not os.path.exists(self.database)
+
+    def managed_under(self, path):
+        """
+        Returns the set of the keys of the files stored as chunks which are
+        the path or under it.
+        """
+        if self._unused():
+            return set()
+        key = self._key(path)
+        with self._lock:
+            rows = self._connect().execute("SELECT path FROM files WHERE path = ? OR substr(path, 1, ?) = ?",
+                                           (key, len(key) + 1, key + "/")).fetchall()
+        return {row[0] for row in rows}
+
+    def copy(self, source, path):
+        """
+        Makes the file a copy of the source file by using the chunks of the
+        source once more, so no content is written, and returns its size.
+        """
+        source_key, key = self._key(source), self._key(path)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._release_chunks(connection, key)
+                row = connection.execute("SELECT size, chunks, tail FROM files WHERE path = ?",
+                                         (source_key,)).fetchone()
+                if row is None:
+                    raise FileNotFoundError(source)
+                connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (key,) + tuple(row))
+                connection.execute("INSERT INTO file_chunks SELECT ?, number, hash FROM file_chunks "
+                                   "WHERE path = ?", (key, source_key))
+                connection.execute("UPDATE chunks SET refs = refs + 1 WHERE hash IN "
+                                   "(SELECT hash FROM file_chunks WHERE path = ?)", (key,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._placeholder(path, row[0])
+        return row[0]
+
+    def move_tree(self, path, destination):
+        """
+        Gives the files stored as chunks which are the path or under it
+        their path under the destination, after the path was renamed.
+        """
+        if self._unused():
+            return
+        key, new_key = self._key(path), self._key(destination)
+        arguments = (new_key, len(key) + 1, key, len(key) + 1, key + "/")
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("UPDATE files SET path = ? || substr(path, ?) "
+                                   "WHERE path = ? OR substr(path, 1, ?) = ?", arguments)
+                connection.execute("UPDATE file_chunks SET path = ? || substr(path, ?) "
+                                   "WHERE path = ? OR substr(path, 1, ?) = ?", arguments)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _chunk(self, digest):
+        """
+        Returns the content of a chunk, from the cache when it is there.
+        """
+        with self._lock:
+            data = self.cache.get(digest)
+            if data is not None:
+                self.cache.move_to_end(digest)
+                self.hits += 1
+                return data
+            self.misses += 1
+        with open(self._chunk_path(digest), "rb") as file:
+            data = file.read()
+        with self._lock:
+            if digest not in self.cache:
+                self.cache[digest] = data
+                self.cached_bytes += len(data)
+                while self.cached_bytes > self.cache_bytes:
+                    self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+        return data
+
+    def read(self, path, offset, count):
+        """
+        Returns at most count bytes of the file starting at offset.
+        --------
+        The chunks are read without the lock, so a chunk may be removed by
+        a command replacing or removing the file meanwhile. The manifest is
+        then read again, up to READ_ATTEMPTS times.
+        """
+        key = self._key(path)
+        for attempt in range(1, READ_ATTEMPTS + 1):
+            with self._lock:
+                connection = self._connect()
+                row = connection.execute("SELECT size, chunks, tail FROM files WHERE path = ?", (key,)).fetchone()
+                if row is None or offset >= row[0] or count <= 0:
+                    return b""
+                size, chunks, tail = row
+                end = min(offset + count, size)
+                first, last = offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE
+                digests = connection.execute("SELECT hash FROM file_chunks WHERE path = ? AND number BETWEEN ? AND ? "
+                                             "ORDER BY number", (key, first, min(last, chunks - 1))).fetchall()
+            try:
+                pieces = [self._chunk(digest) for digest, in digests]
+                break
+            except FileNotFoundError:
+                if attempt == READ_ATTEMPTS:
+                    raise
+        if last >= chunks:
+            pieces.append(bytes(tail))
+        data = b"".join(pieces)
+        start = offset - first * CHUNK_SIZE
+        return data[start:start + end - offset]
+
+    def open(self, path):
+        """
+        Returns a file object reading the file.
+        """
+        return ChunkReader(self, path)
+
+    def stats(self):
+        """
+        Returns the size of the content of the files, the size stored for
+        them, the deduplication ratio and the hit rate of the chunk cache.
+        The database is not created when no file was stored as chunks.
+        """
+        with self._lock:
+            if self._unused():
+                logical = tails = stored = chunks = 0
+            else:
+                connection = self._connect()
+                logical, tails = connection.execute("SELECT COALESCE(SUM(size), 0), "
+                                                    "COALESCE(SUM(LENGTH(tail)), 0) FROM files").fetchone()
+                stored, chunks = connection.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) "
+                                                    "FROM chunks").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "files_bytes": logical,
+                "stored_bytes": stored + tails,
+                "chunks": chunks,
+                "dedup_ratio": round(logical / (stored + tails), 3) if stored + tails else 1.0,
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def report(self):
+        """
+        Returns the stats as text.
+        """
+        values = self.stats()
+        return "\nStorage: " + ("dedup" if self.enabled else "plain") + "\n" + \
+            "\n".join(name + ": " + str(value) for name, value in values.items())
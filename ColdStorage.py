@@ -0,0 +1,451 @@
+"""
+This program compresses the files which were not
+written for a while, in blocks which can be read
+back one at a time.
+"""
+
+import array
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BLOCK_SIZE = 256 * 1024
+SWAP_WAIT_SECONDS = 0.001
+SWAP_WAITS = 1000
+CODECS = ("zstd", "zlib") if zstandard is not None else ("zlib",)
+
+
+def compress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("the zstandard module is needed to read this file")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class ColdReader():
+    """
+    Read only file object over a compressed file, used to
+    download it like a file on the disk.
+    """
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.position = 0
+
+    def read(self, count):
+        data = self.storage.read(self.path, self.position, count)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class ColdStorage():
+    """
+    Compressed tier of the files not written for cold_after seconds,
+    shared by every connection of the process.
+    --------
+    sweep() compresses those files into self.folder, in blocks of BLOCK_SIZE
+    bytes compressed one by one, and replaces them by sparse files of the
+    same size and modification time, so listings and find do not change.
+    The offsets of the blocks are kept in a SQLite database, so a window of
+    the file is read by decompressing only the blocks it covers. The blocks
+    decompressed last are kept in an LRU cache of cache_bytes bytes, so
+    paging through a file with read_file decompresses every block once.
+    --------
+    A file appended to after it was compressed keeps its compressed part
+    and the appended bytes are read from the file itself, until the next
+    sweep compresses the whole file again.
+    --------
+    The compression uses zstd when the zstandard module is installed and
+    zlib otherwise.
+    ========
+    Methods:
+    --------
+    sweep(): Compresses the cold files of a tree.
+    --------
+    manages(): Tells if a file is compressed.
+    --------
+    read() / open(): Read a part of a file, open it for reading.
+    --------
+    remove(): Forgets a compressed file, before it is replaced.
+    --------
+    managed_under() / move_tree(): Return the compressed files of a folder,
+                                   move them with the folder.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, folder="ColdStore", cold_after=None, min_size=4096, cache_bytes=16 * 1024 * 1024):
+        self.folder = folder
+        self.database = os.path.join(folder, "cold.db")
+        self.cold_after = cold_after
+        self.min_size = min_size
+        self.codec = CODECS[0]
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.connection = None
+        self.identity = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the cold storage of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _connect(self):
+        """
+        Opens the database, again when it was removed since it was opened.
+        The lock must be held.
+        """
+        try:
+            status = os.stat(self.database)
+            identity = (status.st_dev, status.st_ino)
+        except FileNotFoundError:
+            identity = None
+        if self.connection is not None and identity == self.identity:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER NOT NULL, "
+                                "size INTEGER NOT NULL, codec TEXT NOT NULL, blocks BLOB NOT NULL, "
+                                "data TEXT NOT NULL, stored INTEGER NOT NULL) WITHOUT ROWID")
+        status = os.stat(self.database)
+        self.identity = (status.st_dev, status.st_ino)
+        return self.connection
+
+    @staticmethod
+    def _key(path):
+        return os.path.normpath(path)
+
+    def _record(self, path):
+        """
+        Returns the record of a compressed file, or None. A record whose file
+        was replaced outside of the server is forgotten.
+        --------
+        The record of a file being compressed is written before its sparse
+        file takes its place, so while the sparse file is waiting next to the
+        data the inodes differ and the swap is waited for, as it takes an
+        instant. The sparse file is looked for before the file, so a swap
+        ending in between is seen by the inode. Meanwhile the file still has its bytes, so when the wait is
+        over None is returned and the file itself is read.
+        """
+        if self.cold_after is None and not os.path.exists(self.database):
+            return None
+        key = self._key(path)
+        for wait in range(SWAP_WAITS):
+            with self._lock:
+                row = self._connect().execute("SELECT inode, size, codec, blocks, data FROM files WHERE path = ?",
+                                              (key,)).fetchone()
+                if row is None:
+                    return None
+                swapping = os.path.exists(self._placeholder(row[4]))
+                try:
+                    inode = os.stat(path).st_ino
+                except FileNotFoundError:
+                    inode = None
+            if inode == row[0]:
+                return row
+            if not swapping:
+                self.remove(path, row[0])
+                return None
+            time.sleep(SWAP_WAIT_SECONDS)
+        return None
+
+    @staticmethod
+    def _placeholder(data_path):
+        """
+        Returns the path of the sparse file made for the compressed data,
+        which only exists until it replaced the file.
+        """
+        return os.path.join(os.path.dirname(data_path), ".placeholder-" + os.path.basename(data_path))
+
+    def manages(self, path):
+        """
+        Returns True if the file is compressed.
+        """
+        return self._record(path) is not None
+
+    def _block(self, data_path, codec, offsets, number):
+        """
+        Returns the decompressed block of a file, from the cache when it is there.
+        """
+        key = (data_path, number)
+        with self._lock:
+            block = self.cache.get(key)
+            if block is not None:
+                self.cache.move_to_end(key)
+                return block
+        with open(data_path, "rb") as file:
+            file.seek(offsets[number])
+            block = decompress(codec, file.read(offsets[number + 1] - offsets[number]))
+        with self._lock:
+            if key not in self.cache:
+                self.cache[key] = block
+                self.cached_bytes += len(block)
+                while self.cached_bytes > self.cache_bytes:
+                    self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+        return block
+
+    def read(self, path, offset, count):
+        """
+        Returns at most count bytes of the file starting at offset,
+        decompressing only the blocks they are in.
+        """
+        record = self._record(path)
+        if record is None:
+            with open(path, "rb") as file:
+                file.seek(offset)
+                return file.read(count)
+        inode, size, codec, blocks, data_path = record
+        offsets = array.array("Q")
+        offsets.frombytes(blocks)
+        pieces = []
+        end = offset + count
+        position = offset
+        while position < min(end, size):
+            number = position // BLOCK_SIZE
+            block = self._block(data_path, codec, offsets, number)
+            start = position - number * BLOCK_SIZE
+            piece = block[start:start + min(end, size) - position]
+            pieces.append(piece)
+            position += len(piece)
+        if end > size:
+            with open(path, "rb") as file:
+                file.seek(max(offset, size))
+                pieces.append(file.read(end - max(offset, size)))
+        return b"".join(pieces)
+
+    def open(self, path):
+        """
+        Returns a file object reading the file.
+        """
+        return ColdReader(self, path)
+
+    def remove(self, path, inode=None):
+        """
+        Forgets the compressed file and removes its compressed data, only
+        when its record is still for the inode when one is given.
+        """
+        if self.cold_after is None and not os.path.exists(self.database):
+            return
+        key = self._key(path)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT data, inode FROM files WHERE path = ?", (key,)).fetchone()
+            if row is None or (inode is not None and row[1] != inode):
+                return
+            connection.execute("DELETE FROM files WHERE path = ?", (key,))
+        try:
+            os.remove(row[0])
+        except FileNotFoundError:
+            pass
+
+    def managed_under(self, path):
+        """
+        Returns the set of the keys of the compressed files which are the
+        path or under it.
+        """
+        if self.cold_after is None and not os.path.exists(self.database):
+            return set()
+        key = self._key(path)
+        with self._lock:
+            rows = self._connect().execute("SELECT path FROM files WHERE path = ? OR substr(path, 1, ?) = ?",
+                                           (key, len(key) + 1, key + "/")).fetchall()
+        return {row[0] for row in rows}
+
+    def move_tree(self, path, destination):
+        """
+        Gives the compressed files which are the path or under it their path
+        under the destination, after the path was renamed, which keeps their
+        inode.
+        """
+        if self.cold_after is None and not os.path.exists(self.database):
+            return
+        key = self._key(path)
+        with self._lock:
+            self._connect().execute("UPDATE files SET path = ? || substr(path, ?) "
+                                    "WHERE path = ? OR substr(path, 1, ?) = ?",
+                                    (self._key(destination), len(key) + 1, key, len(key) + 1, key + "/"))
+
+    def compress_file(self, path, write_behind=None):
+        """
+        Compresses the file and replaces it by a sparse file of the same size
+        and modification time. Returns the number of bytes stored, or None
+        when the file was written during the compression.
+        --------
+        The appends of this process are held back by write_behind while the
+        file is replaced. Bytes appended by another process between the last
+        check and the replacement are copied to the new file.
+        """
+        status = os.stat(path)
+        source = open(path, "rb")
+        reader = self.open(path) if self.manages(path) else source
+        os.makedirs(self.folder, exist_ok=True)
+        descriptor, data_path = tempfile.mkstemp(dir=self.folder, prefix="cold-", suffix=".z")
+        offsets = array.array("Q", [0])
+        try:
+            with os.fdopen(descriptor, "wb") as output:
+                while True:
+                    block = reader.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    output.write(compress(self.codec, block))
+                    offsets.append(output.tell())
+            placeholder = self._placeholder(data_path)
+            with open(placeholder, "wb"):
+                pass
+            os.truncate(placeholder, status.st_size)
+            os.utime(placeholder, ns=(status.st_atime_ns, status.st_mtime_ns))
+            with (write_behind.exclusive(path) if write_behind is not None else contextlib.nullcontext()), self._lock:
+                current = os.stat(path)
+                if (current.st_ino, current.st_size, current.st_mtime_ns) != \
+                        (status.st_ino, status.st_size, status.st_mtime_ns):
+                    os.remove(placeholder)
+                    os.remove(data_path)
+                    return None
+                previous = self._record_data(path)
+                connection = self._connect()
+                connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (self._key(path), os.stat(placeholder).st_ino, status.st_size, self.codec,
+                                    offsets.tobytes(), data_path, offsets[-1]))
+                try:
+                    os.replace(placeholder, path)
+                except BaseException:
+                    connection.execute("DELETE FROM files WHERE path = ? AND data = ?", (self._key(path), data_path))
+                    os.remove(placeholder)
+                    os.remove(data_path)
+                    raise
+                late = os.fstat(source.fileno()).st_size - status.st_size
+                if late > 0:
+                    source.seek(status.st_size)
+                    with open(path, "ab") as file:
+                        file.write(source.read(late))
+        finally:
+            source.close()
+        if previous is not None and previous != data_path:
+            try:
+                os.remove(previous)
+            except FileNotFoundError:
+                pass
+        return offsets[-1]
+
+    def _record_data(self, path):
+        with self._lock:
+            row = self._connect().execute("SELECT data FROM files WHERE path = ?", (self._key(path),)).fetchone()
+        return None if row is None else row[0]
+
+    def sweep(self, root, skip=None, write_behind=None, now=None):
+        """
+        Compresses the files under root not written for cold_after seconds,
+        and the compressed files appended to since, except the files for
+        which skip(path) is True, and the folder of the cold storage itself.
+        Returns the number of files compressed.
+        --------
+        The sweep holds a lock on a file of the folder of the cold storage,
+        so when the worker processes sweep at the same time one of them does
+        the work and the others return 0.
+        """
+        if self.cold_after is None:
+            return 0
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, ".sweep.lock"), "ab") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return 0
+            return self._sweep(root, skip, write_behind, now)
+
+    def _sweep(self, root, skip, write_behind, now):
+        now = time.time() if now is None else now
+        own_folder = os.path.abspath(self.folder)
+        compressed = 0
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            try:
+                scanner = os.scandir(folder)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            with scanner:
+                entries = list(scanner)
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if os.path.abspath(entry.path) != own_folder:
+                            folders.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False) or entry.name.startswith("."):
+                        continue
+                    status = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if status.st_size < self.min_size or now - status.st_mtime < self.cold_after:
+                    continue
+                record = self._record(entry.path)
+                if record is not None and record[1] == status.st_size:
+                    continue
+                if skip is not None and skip(entry.path):
+                    continue
+                if self.compress_file(entry.path, write_behind) is not None:
+                    compressed += 1
+        return compressed
+
+    def stats(self):
+        """
+        Returns the number of compressed files, their size and the size
+        of their compressed data.
+        """
+        with self._lock:
+            files, size, stored = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored), 0) FROM files").fetchone()
+        return {
+            "cold_files": files,
+            "cold_bytes": size,
+            "cold_stored_bytes": stored,
+            "cold_ratio": round(size / stored, 3) if stored else 1.0,
+            "codec": self.codec,
+        }
@@ -1,353 +1,1306 @@
-"""
-This program handles the commands
-passed by the client to server.
-"""
-
-import pathlib
-import os
-import pandas
-import time
-from shutil import rmtree
-import csv
-
-class CommandHandler():
-    """
-    Used to create a user
-    This class involves attributes like
-    --------
-    self.user_id : Returns a string representing the user ID of the user
-    --------
-    self.is_login : Gives data if the user is logged in or not
-    --------
-    self.registered_users: Returns list of registered users
-    --------
-    self.logged_in_users : Returns a list of users who are already logged in
-    ========
-    Methods:
-    This class involves methods like:
-    --------
-    register(): Used to register a new user and enables to create
-                a username and password of their choice inorder to
-                login.
-    --------
-    login(): Logs in the user only if the username and password provided matches the 
-            data in registered data.
-    --------
-    quit(): Quits the Login Session, sets back all the parameters to initial values.
-    --------
-    change_folder(): Changes the current directory position to the specified position.
-                    If the specified position is one up the Root directory, it will 
-                    return an error.
-    --------
-    list(): Returns the list of subdirectories and files under the current directory. 
-            Prints out the name, size, modified date of the files and subdirectories.
-    --------
-    read_file(): Read data from the file using the filename provided. Each time the function 
-                is called reads next 100 characters of data. 
-    --------
-    write_file(): Writes data to the file using the filename provided.
-    --------
-    create_folder(): Creates a new folder with the specified name. If the specified folder 
-                    already exists, returns an error message. 
-    """
-
-
-    REGISTERED_USERS_CSV_FILE = "AccessSession/registered_users.csv"
-    LOGGED_IN_USERS_CSV_FILE = "AccessSession/logged_in_users.csv"
-    CSV_HEADING = "username,password\n"
-    NOT_LOGGED_IN = "\nLogin to Continue"
-    ROOT_DIR = "Root/"
-
-
-    def __init__(self):
-        """
-        The parameters are passed to the __init__ function
-        The Parameters include :
-        ------
-        self.user_id : A string representing the user ID of the user
-        ------
-        self.is_login : A Boolean value (whether the user is logged in or not)
-        ------
-        self.registered_users : A list of registered usernames
-        ------
-        self.logged_in_users : A list of already logged in usernames 
-        ------
-        self.current_directory : The current file path of the user. By default, 
-                                set to "Root/"
-        ------
-        self.char_count : Number of characters that should be read each time read_file() function 
-                            is called
-        """
-        self.user_id = ""
-        self.is_login = None
-        self.registered_users = None
-        self.logged_in_users = None
-        self.current_directory = CommandHandler.ROOT_DIR
-        self.read_index = {}
-        self.char_count = 100
-    
-
-    def access_user_info(self):
-        """
-        This function deals with accessing the user information
-        ----------------------------------------------------
-        The user information involves both registered users
-        and logged in users per session
-        """
-
-        if not os.path.exists("AccessSession"):
-            os.mkdir("AccessSession")
-
-        if not os.path.isfile(CommandHandler.REGISTERED_USERS_CSV_FILE):
-            with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "w") as writer:
-                writer.write(CommandHandler.CSV_HEADING)
-        if not os.path.isfile(CommandHandler.LOGGED_IN_USERS_CSV_FILE):
-            with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "w") as writer:
-                writer.write(CommandHandler.CSV_HEADING)
-        self.logged_in_users = pandas.read_csv(CommandHandler.LOGGED_IN_USERS_CSV_FILE)
-        self.registered_users = pandas.read_csv(CommandHandler.REGISTERED_USERS_CSV_FILE)
-
-
-    def commands(self):
-        """
-        This function returns the description of the commands that can be used by the user
-        and the detailed functionality of each command
-        """
-
-        commands = ["register : For registering the new user ,command:register <username> <password> \n",
-                 "login : To login, command:login <username> <password>,Note:password should be in integer\n",
-                 "quit : To logout, command:quit\n",
-                 
-                 "change_folder : To change the path, command:change_folder <name>\n",
-                 "list : list of all files in the path, command:list\n",
-                 "read_file : To read content from the file, command:read_file <name>\n",
-                 "write_file : To write content into the file, command:write_file <name>\n",
-                 "create_folder : To create new folder, command:create_folder <name>\n"
-                ]
-        description = ""
-        for command in commands:
-            description += command
-        return description
-
-    
-    def register(self, user_id, password):
-        """
-        This function is used to create a new user
-         using the username and password provided.
-        --------
-        If a username already exists, it displays that the username is not
-        available.
-        --------
-        Note that length of passwords should be more than 8
-        """
-        self.access_user_info()
-        if user_id in self.registered_users['username'].tolist():
-            return "\nUsername not available"
-        if len(password) < 8:
-            return "\n Password length should be more than 8 characters."
-        with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "a") as writer:
-            writer.write(user_id+","+password+"\n")
-        if not os.path.exists(self.current_directory):
-            os.mkdir(self.current_directory)
-        os.mkdir(os.path.join(self.current_directory, user_id))
-        self.current_directory = self.current_directory + self.user_id
-        return "\nSuccessfully registered user"
-
-
-    def login(self, user_id, password):
-        """
-        This function is used to login the user, when respective credentials
-        are provided by the user.
-        --------
-        When the username and password provided by the user matches the
-        register data, then the user is allowed to login.
-        --------
-        Displays "Username not registered, please register to continue" when the credentials provided doesnot
-        match the previous register data.
-        --------
-        Displays "Wrong password, try again", if the entered password does not match the registered
-        username.
-        """
-        
-        self.access_user_info()
-        if self.is_login:
-            return "\nAlready Logged In"
-        if user_id not in self.registered_users['username'].tolist():
-           # print (self.registered_users)
-            return "\nUser not registered, please register to continue"
-        if password not in self.registered_users['password'].tolist() and user_id in self.registered_users['username'].tolist():
-            return "\nWrong Password, try again"
-        if user_id in self.logged_in_users['username'].tolist():
-            self.is_login = True
-            self.user_id = user_id
-            self.current_directory = self.current_directory + self.user_id
-            return "\nUser logged through another port"
-        
-        self.is_login = True
-        self.user_id = user_id
-        self.current_directory = self.current_directory + self.user_id
-        with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "a") as writer:
-            writer.write(user_id + "," + password + "\n")
-        return "Logged into the system successfully!"
-
-
-    def quit(self):
-        """
-        This function is used to 'Log Out' the user from the current login session.
-        """
-        
-        try:
-            self.access_user_info()
-            with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "w") as file:
-                file.write(CommandHandler.CSV_HEADING)
-                user_ids = self.logged_in_users['username'].tolist()
-                passwords = self.logged_in_users['password'].tolist()
-                for i in range(len(user_ids)):
-                    if self.user_id != str(user_ids[i]):
-                        file.write(user_ids[i]+","+passwords[i])
-            self.is_login = False
-            self.user_id = ""
-            return "\nLogged Out"
-        except KeyError:
-            return "\nForced Logged Out through Keyboard Interruption (CTRL-C)"
-
-
-    def list(self):
-        """
-        This function gives information about the name, size, date and
-        time of creation of the request.
-        -------
-        It also prints all files and folders in the current working directory
-        for issuing the request.
-        -------
-        It only has access to the current directory and can not print
-        the information regarding content in sub- directories.
-        """
-
-        self.access_user_info()
-        if not self.is_login:
-            return CommandHandler.NOT_LOGGED_IN
-        path = os.path.join(self.current_directory)
-        directories = []
-        try:
-            for file_name in os.listdir(path):
-               a = os.stat(os.path.join(path, file_name))
-               directories.append([file_name, str(a.st_size), str(time.ctime(a.st_ctime))])
-        except NotADirectoryError:
-            return "\nNot A Directory"
-        details = "\nFile | Size | Modified Date"
-        for directory in directories:
-            line = " | ".join([directory[0], directory[1], directory[2]]) + "\n"
-            details += "-----------------------\n" + line
-        return details
-
-
-    def write_file(self, filepath, data):
-        """
-        This function appends data to the file in the diectotry
-        as per the command given
-        --------
-        The file will be written with the data of the user input
-        --------
-        If data already exists in the file in the directory,
-        the new data will be appended to the existing data
-        without any data loss.
-        """
-
-        self.access_user_info()
-        if not self.is_login:
-            return CommandHandler.NOT_LOGGED_IN
-        t_file = []
-        for file in os.listdir(os.path.join(self.current_directory)):
-            if os.path.isfile(os.path.join(self.current_directory, file)):
-                t_file.append(file)
-            
-        writeable_data = ""
-        path = os.path.join(self.current_directory, filepath)
-        for i in data:
-            writeable_data += i
-        if filepath in t_file:
-            with open(path, "a+") as file:
-                file.write(writeable_data)
-            return "\nSuccess Written data to file " + filepath + "successfully"
-        with open(path, "w+") as file:
-            file.write(writeable_data)
-        return "\nCreated and written data to file " + filepath + "successfully"
-
-
-    def create_folder(self, directory):
-        """
-        This function creates new directory as per the user command
-        --------
-        The function checks the existing directories before creating
-        new ones to avoid duplication.
-        """
-
-        if not self.is_login:
-            return CommandHandler.NOT_LOGGED_IN
-        self.access_user_info()
-        path = os.path.join(self.current_directory)
-        directories = []
-        for subdirectory in os.listdir(path):
-            path2 = os.path.join(subdirectory)
-            if os.path.isdir(path2):
-                directories.append(path2)
-        if directory in directories:
-            return "\nThe directory is already created"
-        os.mkdir(os.path.join(path, directory))
-        return "\nSuccessfully created directory " + directory
-
-
-
-    def change_folder(self, directory):
-        """
-        This function is used to change the position of current directory for
-        the current user to the specified directory.
-        """
-
-        self.access_user_info()
-        if not self.is_login:
-            return CommandHandler.NOT_LOGGED_IN
-
-        if directory == ".." and self.current_directory != CommandHandler.ROOT_DIR + self.user_id:
-            self.current_directory = os.path.dirname(os.path.join(self.current_directory))
-            return "\nSuccessfully moved to directory " + self.current_directory
-        
-        elif directory == ".." and self.current_directory == CommandHandler.ROOT_DIR + self.user_id:
-            return "\nCannot Move Back from Root/" + self.user_id + " directory"
-
-        if directory in os.listdir(self.current_directory):
-            self.current_directory = os.path.join(self.current_directory, directory)
-            return "\nSuccessfully Moved to directory " + self.current_directory
-        return "\n No such directory exists"
-
-
-    def read_file(self, filepath):
-        """
-        This function is used to read data from the file standing
-        in the current directory.
-        -------
-        If a file with specified name does not exist in the current
-        working directory for the user, the request is denied.
-        """
-
-        self.access_user_info()
-        if not self.is_login:
-            return CommandHandler.NOT_LOGGED_IN
-        files = []
-        for file in os.listdir(os.path.join(self.current_directory)):
-            if os.path.isfile(os.path.join(self.current_directory, file)):
-                files.append(file)
-        if filepath not in files:
-            return "\nGiven file does not exist"
-        t_path = os.path.join(self.current_directory, filepath)
-        if t_path not in list(self.read_index.keys()):
-            self.read_index[t_path] = 0
-        with open(t_path, "r") as file:
-            content = file.read()
-        old_index = str(self.read_index[t_path]*self.char_count)
-        index = self.read_index[t_path]
-        data = content[index*self.char_count:(index+1)*self.char_count]
-        self.read_index[t_path] += 1
-        self.read_index[t_path] %= len(content) // self.char_count + 1
-        return "\n" + "Read file from " + old_index + " to " + str(int(old_index)+self.char_count) + "are\n" + data
\ No newline at end of file
+"""
+This program handles the commands
+passed by the client to server.
+"""
+
+import os
+import time
+import errno
+import shutil
+import mmap
+import heapq
+import itertools
+import json
+import tempfile
+from UserRegistry import UserRegistry
+from DirectoryCache import DirectoryCache
+from SessionManager import SessionManager
+from Metrics import Metrics, Timer
+from WriteBehind import WriteBehind
+from PathIndex import PathIndex
+from ChunkStore import ChunkStore
+from ColdStorage import ColdStorage
+from ResponseCache import ResponseCache
+from DiskUsage import DiskUsage
+from JobManager import JobManager, JobFailed, walk_tree, copy_file
+
+
+class CommandHandler():
+    """
+    Used to create a user
+    This class involves attributes like
+    --------
+    self.user_id : Returns a string representing the user ID of the user
+    --------
+    self.is_login : Gives data if the user is logged in or not
+    --------
+    self.registered_users: Returns a dictionary of registered users and their passwords
+    --------
+    self.logged_in_users : Returns the users who are already logged in
+    ========
+    Methods:
+    This class involves methods like:
+    --------
+    register(): Used to register a new user and enables to create
+                a username and password of their choice inorder to
+                login.
+    --------
+    login(): Logs in the user only if the username and password provided matches the 
+            data in registered data.
+    --------
+    quit(): Quits the Login Session, sets back all the parameters to initial values.
+    --------
+    change_folder(): Changes the current directory position to the specified position.
+                    If the specified position is one up the Root directory, it will 
+                    return an error.
+    --------
+    list(): Returns the list of subdirectories and files under the current directory. 
+            Prints out the name, size, modified date of the files and subdirectories.
+            The list can be sorted, paginated and given as csv or json lines.
+    --------
+    read_file(): Read data from the file using the filename provided. Each time the function
+                is called reads next 100 characters of data, or the number of characters
+                asked for.
+    --------
+    write_file(): Writes data to the file using the filename provided.
+    --------
+    create_folder(): Creates a new folder with the specified name. If the specified folder 
+                    already exists, returns an error message. 
+    --------
+    start_upload() / finish_upload(): Receive a file into a temporary file which is renamed
+                    into the current directory once it is complete.
+    --------
+    start_download() / open_file(): Check a file can be downloaded and return its path and
+                    size, open it for reading.
+    --------
+    start_follow() / read_bytes(): Check a file can be followed, read the bytes appended to it.
+    --------
+    find(): Finds the files and folders of the whole tree under the current directory
+            by name, size, modification time and type, from the path index.
+    --------
+    flush() / fsync(): Write the appends buffered by write_file to the files, and to the disk.
+    --------
+    batch(): Runs many operations with one check of the login state and returns
+            the result of every operation.
+    --------
+    delete_folder() / copy() / move(): Delete, copy and move whole trees in a job
+            running in the background.
+    --------
+    jobs() / cancel(): Give the progress of the jobs of the user, stop one of them.
+    """
+
+
+    REGISTERED_USERS_CSV_FILE = "AccessSession/registered_users.csv"
+    LOGGED_IN_USERS_CSV_FILE = "AccessSession/logged_in_users.csv"
+    CSV_HEADING = "username,password\n"
+    NOT_LOGGED_IN = "\nLogin to Continue"
+    ROOT_DIR = "Root/"
+    UPLOAD_PREFIX = ".upload-"
+    LIST_SORT_KEYS = {
+        "name": lambda entry: entry.name,
+        "size": lambda entry: entry.size,
+        "mtime": lambda entry: entry.mtime,
+    }
+    LIST_FORMATS = ("table", "csv", "json")
+    BATCH_COMMANDS = ("write_file", "create_folder", "change_folder", "read_file", "list")
+    BATCH_READS = ("read_file", "list")
+    MAX_CHAR_COUNT = 1024 * 1024
+    MMAP_THRESHOLD = 64 * 1024 * 1024
+    PATH_INDEX_DATABASE = "AccessSession/path_index.db"
+    FIND_LIMIT = 1000
+    USAGE_DATABASE = "AccessSession/usage.db"
+
+
+    def __init__(self):
+        """
+        The parameters are passed to the __init__ function
+        The Parameters include :
+        ------
+        self.user_id : A string representing the user ID of the user
+        ------
+        self.is_login : A Boolean value (whether the user is logged in or not)
+        ------
+        self.registered_users : A dictionary of registered usernames and passwords
+        ------
+        self.logged_in_users : The already logged in usernames with the tokens of their sessions
+        ------
+        self.session_token : Token of the login session of this connection
+        ------
+        self.sessions : The SessionManager shared by every connection of the process
+        ------
+        self.registry : The UserRegistry shared by every connection of the process
+        ------
+        self.metrics : The Metrics of the process
+        ------
+        self.directory_cache : The DirectoryCache shared by every connection of the process
+        ------
+        self.write_behind : The WriteBehind table of the files appended to by write_file
+        ------
+        self.path_index : The PathIndex of the trees of the users, used by find()
+        ------
+        self.disk_usage : The DiskUsage of the users, used by usage() and to enforce the quotas
+        ------
+        self.chunk_store : The ChunkStore of the files deduplicated in chunks
+        ------
+        self.cold_storage : The ColdStorage of the files compressed after not being written for a while
+        ------
+        self.response_cache : The ResponseCache of read_file and list shared by every connection
+        ------
+        self.job_manager : The JobManager running delete_folder, copy and move in the background
+        ------
+        self.current_directory : The current file path of the user. By default, 
+                                set to "Root/"
+        ------
+        self.read_index : Byte offset of the next window to read for every file read
+        ------
+        self.char_count : Default number of characters that should be read each time read_file() function
+                            is called
+        ------
+        self.last_error : Error message of the last failed operation, see batch()
+        """
+        self.user_id = ""
+        self.is_login = None
+        self.registered_users = None
+        self.current_directory = CommandHandler.ROOT_DIR
+        self.read_index = {}
+        self.char_count = 100
+        self.session_token = None
+        self.metrics = Metrics.shared()
+        self.last_error = None
+        self._batch = None
+        self.directory_cache = DirectoryCache.shared()
+        self.write_behind = WriteBehind.shared()
+        self.path_index = PathIndex.shared(CommandHandler.PATH_INDEX_DATABASE)
+        self.disk_usage = DiskUsage.shared(CommandHandler.USAGE_DATABASE)
+        self.chunk_store = ChunkStore.shared()
+        self.cold_storage = ColdStorage.shared()
+        self.response_cache = ResponseCache.shared()
+        self.job_manager = JobManager.shared()
+        self.sessions = SessionManager.shared()
+        self.registry = UserRegistry.shared(CommandHandler.REGISTERED_USERS_CSV_FILE,
+                                            CommandHandler.CSV_HEADING)
+    
+
+    def access_user_info(self):
+        """
+        This function deals with accessing the user information
+        ----------------------------------------------------
+        The user information involves both registered users
+        and logged in users per session
+        ----------------------------------------------------
+        The csv file is only parsed again by the shared
+        registry when it was changed on disk. The logged in
+        users are kept by the shared session manager; a session
+        evicted after being idle too long logs this connection out.
+        Within a batch the state is only checked once, by batch().
+        """
+
+        if self._batch is not None:
+            return
+        with Timer(self.metrics, "access_user_info"):
+            self.registry.refresh()
+            self.registered_users = self.registry.registered
+            if self.is_login and not self.sessions.touch(self.session_token):
+                self._end_session()
+
+
+    @property
+    def logged_in_users(self):
+        """
+        The logged in users of the shared session manager.
+        """
+
+        return self.sessions.users
+
+
+    def _end_session(self):
+        """
+        This function sets back the parameters of the login session to their initial values.
+        """
+
+        self.is_login = False
+        self.user_id = ""
+        self.session_token = None
+        self.current_directory = CommandHandler.ROOT_DIR
+        self.read_index = {}
+
+
+    def commands(self):
+        """
+        This function returns the description of the commands that can be used by the user
+        and the detailed functionality of each command
+        """
+
+        commands = ["register : For registering the new user ,command:register <username> <password> \n",
+                 "login : To login, command:login <username> <password>,Note:password should be in integer\n",
+                 "quit : To logout, command:quit\n",
+                 
+                 "change_folder : To change the path, command:change_folder <name>\n",
+                 "list : list of all files in the path, command:list [--offset <n>] [--limit <n>] "
+                 "[--sort name|size|mtime] [--reverse] [--format table|csv|json] [--stream]\n",
+                 "read_file : To read content from the file, command:read_file <name> [<characters>]\n",
+                 "write_file : To write content into the file, command:write_file <name>\n",
+                 "create_folder : To create new folder, command:create_folder <name>\n",
+                 "upload : To upload a file in chunks, command:upload <name> <size> (framed protocol)\n",
+                 "download : To download a file in chunks, command:download <name> (framed protocol)\n",
+                 "follow : To receive what is appended to a file as it is written, "
+                 "command:follow <name> [<offset>] (framed protocol)\n",
+                 "unfollow : To stop following a file, command:unfollow <name> (framed protocol)\n",
+                 "find : To find files in all sub folders, command:find [--name <pattern>] "
+                 "[--min-size <n>] [--max-size <n>] [--newer <seconds>] [--older <seconds>] "
+                 "[--type file|dir] [--limit <n>] [--format table|csv|json]\n",
+                 "search : To find files whose name contains a text, command:search <text> [<find options>]\n",
+                 "reindex : To index the files changed outside of the server, command:reindex\n",
+                 "usage : To see the space used and the quota, command:usage\n",
+                 "delete_folder : To delete a folder and all its content, command:delete_folder <name>\n",
+                 "copy : To copy a file or a folder, command:copy <path> <destination>\n",
+                 "move : To move or rename a file or a folder, command:move <path> <destination>\n",
+                 "jobs : To see the progress of delete_folder, copy and move, command:jobs [<job>]\n",
+                 "cancel : To stop a job, command:cancel <job>\n",
+                 "flush : To write the buffered data of a file or of all files, command:flush [<name>]\n",
+                 "fsync : To write the buffered data of a file or of all files to the disk, "
+                 "command:fsync [<name>]\n",
+                 "batch : To run many commands at once, command:batch [--stop-on-error] followed by "
+                 "one command per line\n"
+                ]
+        description = ""
+        for command in commands:
+            description += command
+        return description
+
+    
+    def register(self, user_id, password):
+        """
+        This function is used to create a new user
+         using the username and password provided.
+        --------
+        If a username already exists, it displays that the username is not
+        available.
+        --------
+        Note that length of passwords should be more than 8
+        """
+        self.access_user_info()
+        if self.registry.is_registered(user_id):
+            return "\nUsername not available"
+        if len(password) < 8:
+            return "\n Password length should be more than 8 characters."
+        if not self.registry.add_user(user_id, password):
+            return "\nUsername not available"
+        if not os.path.exists(self.current_directory):
+            os.mkdir(self.current_directory)
+        os.mkdir(os.path.join(self.current_directory, user_id))
+        self.current_directory = self.current_directory + self.user_id
+        return "\nSuccessfully registered user"
+
+
+    def login(self, user_id, password):
+        """
+        This function is used to login the user, when respective credentials
+        are provided by the user.
+        --------
+        When the username and password provided by the user matches the
+        register data, then the user is allowed to login.
+        --------
+        Displays "Username not registered, please register to continue" when the credentials provided doesnot
+        match the previous register data.
+        --------
+        Displays "Wrong password, try again", if the entered password does not match the registered
+        username.
+        """
+        
+        self.access_user_info()
+        if self.is_login:
+            return "\nAlready Logged In"
+        if not self.registry.is_registered(user_id):
+            return "\nUser not registered, please register to continue"
+        if not self.registry.password_matches(user_id, password):
+            return "\nWrong Password, try again"
+        logged_through_another_port = self.sessions.is_logged_in(user_id)
+        self.is_login = True
+        self.user_id = user_id
+        self.current_directory = CommandHandler.ROOT_DIR + self.user_id
+        self.session_token = self.sessions.login(user_id)
+        if logged_through_another_port:
+            return "\nUser logged through another port"
+        return "Logged into the system successfully!"
+
+
+    def quit(self):
+        """
+        This function is used to 'Log Out' the user from the current login session.
+        """
+        
+        if self.session_token is not None:
+            self.sessions.logout(self.session_token)
+        self._end_session()
+        return "\nLogged Out"
+
+
+    def list(self, offset=0, limit=None, sort=None, reverse=False, output="table"):
+        """
+        This function gives information about the name, size, date and
+        time of creation of the request.
+        -------
+        It also prints all files and folders in the current working directory
+        for issuing the request.
+        -------
+        It only has access to the current directory and can not print
+        the information regarding content in sub- directories.
+        -------
+        The listing can be sorted by name, size or mtime, paginated with
+        offset and limit and given as a table, csv or json lines, see list_rows().
+        """
+
+        return "".join(self.list_rows(offset, limit, sort, reverse, output))
+
+
+    def list_rows(self, offset=0, limit=None, sort=None, reverse=False, output="table"):
+        """
+        This function yields the listing of list() piece by piece, first the
+        heading and then one row per entry, so that it can be sent to the client
+        while it is produced. An error message is yielded alone.
+        -------
+        The entries come from the directory cache, which is filled with
+        os.scandir. When only a page of a sorted listing is asked for, only the
+        first offset + limit entries are sorted.
+        -------
+        A listing rendered from a cached directory listing is kept in the
+        response cache under the version of that listing and the options,
+        so that polling an unchanged folder yields it without rendering it.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            yield self._failed(CommandHandler.NOT_LOGGED_IN)
+            return
+        path = os.path.join(self.current_directory)
+        self.write_behind.flush_directory(path)
+        try:
+            version, entries = self.directory_cache.snapshot(path)
+        except NotADirectoryError:
+            yield self._failed("\nNot A Directory")
+            return
+        key = None if version is None else ("list", version, offset, limit, sort, reverse, output)
+        if key is not None:
+            response = self.response_cache.get(key)
+            if response is not None:
+                yield response
+                return
+        pieces = []
+        length = 0
+        for piece in self._render_listing(entries.values(), offset, limit, sort, reverse, output):
+            yield piece
+            if pieces is not None:
+                pieces.append(piece)
+                length += len(piece)
+                if not self.response_cache.fits(length):
+                    pieces = None
+        if key is not None and pieces is not None:
+            self.response_cache.put(key, "".join(pieces))
+
+
+    @staticmethod
+    def _render_listing(entries, offset, limit, sort, reverse, output):
+        """
+        This function yields the heading and the rows of a page of the entries.
+        """
+
+        end = None if limit is None else offset + limit
+        if sort is not None:
+            key = CommandHandler.LIST_SORT_KEYS[sort]
+            if end is not None and not reverse:
+                entries = heapq.nsmallest(end, entries, key=key)
+            elif end is not None:
+                entries = heapq.nlargest(end, entries, key=key)
+            else:
+                entries = sorted(entries, key=key, reverse=reverse)
+        elif reverse:
+            entries = reversed(list(entries))
+        entries = itertools.islice(entries, offset, end)
+        if output == "csv":
+            yield "name,type,size,modified\n"
+            for entry in entries:
+                yield ",".join([CommandHandler._csv_field(entry.name), "dir" if entry.is_dir else "file",
+                                str(entry.size), str(int(entry.mtime))]) + "\n"
+        elif output == "json":
+            for entry in entries:
+                yield json.dumps({"name": entry.name, "type": "dir" if entry.is_dir else "file",
+                                  "size": entry.size, "modified": int(entry.mtime)}) + "\n"
+        else:
+            yield "\nFile | Size | Modified Date"
+            for entry in entries:
+                line = " | ".join([entry.name, str(entry.size), str(time.ctime(entry.ctime))]) + "\n"
+                yield "-----------------------\n" + line
+
+
+    @staticmethod
+    def _csv_field(value):
+        """
+        This function quotes a csv field when it has to be.
+        """
+
+        if any(character in value for character in ',"\n\r'):
+            return '"' + value.replace('"', '""') + '"'
+        return value
+
+
+    def write_file(self, filepath, data):
+        """
+        This function appends data to the file in the diectotry
+        as per the command given
+        --------
+        The file will be written with the data of the user input
+        --------
+        If data already exists in the file in the directory,
+        the new data will be appended to the existing data
+        without any data loss.
+        --------
+        The appends go through the WriteBehind table shared by every
+        connection, which keeps the file open and, depending on its
+        durability mode, buffers them or waits for the disk. The size of
+        the file in the cached listing is updated in place.
+        --------
+        When the chunk store is enabled, new files and the files already
+        stored as chunks are appended to in the chunk store instead.
+        --------
+        The write is refused when it would take the user over its quota.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        path = os.path.join(self.current_directory, filepath)
+        directory, name = os.path.split(path)
+        entry = self.directory_cache.lookup(directory, name)
+        if entry is not None and entry.is_dir:
+            return self._failed("\nA folder named " + filepath + " already exists")
+        data = data.encode()
+        if not self.disk_usage.allows(self.user_id, self._user_root(), len(data)):
+            return self._failed(self._quota_exceeded(len(data)))
+        try:
+            if self.chunk_store.enabled and (entry is None or self.chunk_store.manages(path)):
+                size = self.chunk_store.append(path, data)
+            else:
+                size = self.write_behind.append(path, data)
+        except IsADirectoryError:
+            return self._failed("\nA folder named " + filepath + " already exists")
+        self.disk_usage.add(self.user_id, len(data), 0 if entry is not None else 1, path=path)
+        self._index(filepath, False, size)
+        if entry is not None:
+            self.directory_cache.update(directory, name, size)
+            return "\nSuccess Written data to file " + filepath + "successfully"
+        self._invalidate(directory)
+        return "\nCreated and written data to file " + filepath + "successfully"
+
+
+    def flush(self, filepath=None):
+        """
+        This function writes the appends buffered by write_file to the file
+        of the current directory, or to every file.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        self.write_behind.flush(None if filepath is None else os.path.join(self.current_directory, filepath))
+        return "\nFlushed " + ("all files" if filepath is None else filepath)
+
+
+    def fsync(self, filepath=None):
+        """
+        This function writes the appends buffered by write_file to the file
+        of the current directory, or to every file, and waits until they are
+        on the disk.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        self.write_behind.sync(None if filepath is None else os.path.join(self.current_directory, filepath))
+        return "\nSynced " + ("all files" if filepath is None else filepath)
+
+
+    def _invalidate(self, path):
+        """
+        This function forgets the cached listing of a directory, at the end
+        of the batch when a batch is running.
+        """
+
+        if self._batch is None:
+            self.directory_cache.invalidate(path)
+        else:
+            self._batch.add(path)
+
+
+    def _index(self, filepath, is_dir, size):
+        """
+        This function records an entry of the current directory written
+        by a command in the path index.
+        """
+
+        path = os.path.relpath(os.path.join(self.current_directory, filepath),
+                               CommandHandler.ROOT_DIR + self.user_id)
+        if not path.startswith(".."):
+            self.path_index.record(self.user_id, path, is_dir, size, time.time())
+
+
+    def find(self, name=None, contains=None, min_size=None, max_size=None, newer=None, older=None,
+             kind=None, limit=None, output="table"):
+        """
+        This function finds the files and folders under the current directory,
+        in all its sub directories, whose name matches the glob pattern name or
+        contains the text contains, whose size is between min_size and max_size,
+        which were modified less than newer or more than older seconds ago and
+        which are of the kind "file" or "dir".
+        -------
+        The entries come from the PathIndex, so the tree is not listed. At most
+        limit entries are returned, FIND_LIMIT by default, with their path from
+        the current directory, as a table, csv or json lines.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        root = CommandHandler.ROOT_DIR + self.user_id
+        folder = os.path.relpath(self.current_directory, root)
+        folder = "" if folder == "." else folder
+        now = time.time()
+        entries = self.path_index.find(self.user_id, root, folder, name, contains, min_size, max_size,
+                                       None if newer is None else now - newer,
+                                       None if older is None else now - older,
+                                       None if kind is None else kind == "dir",
+                                       CommandHandler.FIND_LIMIT if limit is None else limit)
+        start = len(folder) + 1 if folder else 0
+        if output == "csv":
+            return "path,type,size,modified\n" + "".join(
+                ",".join([CommandHandler._csv_field(entry.path[start:]), "dir" if entry.is_dir else "file",
+                          str(entry.size), str(int(entry.mtime))]) + "\n" for entry in entries)
+        if output == "json":
+            return "".join(json.dumps({"path": entry.path[start:], "type": "dir" if entry.is_dir else "file",
+                                       "size": entry.size, "modified": int(entry.mtime)}) + "\n"
+                           for entry in entries)
+        return "\nPath | Size | Modified Date" + "".join(
+            "-----------------------\n" + " | ".join([entry.path[start:], str(entry.size),
+                                                     str(time.ctime(entry.mtime))]) + "\n"
+            for entry in entries)
+
+
+    def _user_root(self):
+        """
+        This function returns the folder of the logged in user.
+        """
+
+        return CommandHandler.ROOT_DIR + self.user_id
+
+
+    def _quota_exceeded(self, size, user_id=None):
+        """
+        This function returns the error of a write of size bytes over the quota.
+        """
+
+        user_id = self.user_id if user_id is None else user_id
+        usage = self.disk_usage.usage(user_id, CommandHandler.ROOT_DIR + user_id)
+        return "\nQuota exceeded: " + str(size) + " more bytes would make " + str(usage.bytes + size) + \
+            " of the " + str(usage.quota) + " bytes allowed"
+
+
+    def usage(self):
+        """
+        This function gives the bytes, files and folders stored by the user
+        and its quota, from the totals kept up to date by the commands, so
+        the tree of the user is not walked.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        usage = self.disk_usage.usage(self.user_id, self._user_root())
+        quota = "none"
+        if usage.quota is not None:
+            used = 100 * usage.bytes / usage.quota if usage.quota else 100
+            quota = str(usage.quota) + " bytes (" + str(round(used, 1)) + "% used)"
+        return "\nUsed: " + str(usage.bytes) + " bytes in " + str(usage.files) + " files and " + \
+            str(usage.folders) + " folders | Quota: " + quota
+
+
+    def reindex(self):
+        """
+        This function indexes the tree of the user again, to pick up the
+        changes made outside of the server.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        count = self.path_index.rescan(self.user_id, CommandHandler.ROOT_DIR + self.user_id)
+        return "\nIndexed " + str(count) + " entries"
+
+
+    def _tree_path(self, path, root_allowed=False):
+        """
+        This function returns the path of a file or folder given from the
+        current directory, or None for a path out of the folder of the user,
+        or for the folder of the user itself unless root_allowed.
+        """
+
+        if not path or "\0" in path:
+            return None
+        full_path = os.path.normpath(os.path.join(self.current_directory, path))
+        relative = os.path.relpath(full_path, self._user_root())
+        if (relative == "." and not root_allowed) or relative.startswith(".."):
+            return None
+        return full_path
+
+
+    def _destination(self, source_path, destination):
+        """
+        This function returns the path a file or folder is copied or moved
+        to and None, or None and the error message. A destination which is
+        a folder receives the file or folder under its own name.
+        """
+
+        path = self._tree_path(destination, root_allowed=True)
+        if path is None:
+            return None, "\nInvalid destination " + destination
+        if os.path.isdir(path) and not os.path.islink(path):
+            path = os.path.join(path, os.path.basename(source_path))
+        if os.path.lexists(path):
+            return None, "\nA file or folder named " + os.path.relpath(path, self.current_directory) + \
+                " already exists"
+        if path.startswith(source_path + os.sep):
+            return None, "\nCannot copy or move a folder into itself"
+        if not os.path.isdir(os.path.dirname(path)):
+            return None, "\n No such directory exists"
+        return path, None
+
+
+    def _holds_current_directory(self, path):
+        """
+        This function tells if the folder is the current directory or holds it.
+        """
+
+        current = os.path.normpath(self.current_directory)
+        return current == path or current.startswith(path + os.sep)
+
+
+    def _job_response(self, job, name):
+        """
+        This function returns the response of a job which finished within
+        WAIT_SECONDS, or tells the job was started and goes on in the background.
+        """
+
+        if job is None:
+            return self._failed("\nAnother job is running on " + name)
+        if not self.job_manager.wait(job, JobManager.WAIT_SECONDS):
+            return "\nStarted job " + str(job.job_id) + ": " + job.description + \
+                ", see jobs " + str(job.job_id) + " for its progress"
+        if job.state == "failed":
+            return self._failed(job.result)
+        return job.result
+
+
+    @staticmethod
+    def _job_summary(job, action, folders):
+        """
+        This function returns the response of a job on a tree once it is finished.
+        """
+
+        summary = "\n" + ("Cancelled: " if job.cancelled.is_set() else "") + action + ": " + str(job.files) + \
+            " files, " + str(folders) + " folders, " + str(job.bytes) + " bytes"
+        if job.errors:
+            summary += " | " + str(job.errors) + " errors, first: " + job.first_error
+        return summary
+
+
+    def delete_folder(self, directory):
+        """
+        This function deletes a folder and everything under it, in a job.
+        -------
+        The tree is walked with os.scandir and its files are removed in
+        parallel on the pool of the JobManager, then the folders from the
+        deepest up. A job which is cancelled leaves the files not removed yet.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        path = self._tree_path(directory)
+        if path is None or os.path.islink(path) or not os.path.isdir(path):
+            return self._failed("\n No such directory exists")
+        if self._holds_current_directory(path):
+            return self._failed("\nCannot delete the current directory")
+        job = self.job_manager.start(self.user_id, "delete_folder " + directory, [path],
+                                     self._delete_tree, self.user_id, path, directory)
+        return self._job_response(job, directory)
+
+
+    def _delete_tree(self, job, user_id, path, name):
+        """
+        This function is the job of delete_folder(). The files go out of
+        the chunk store, the cold storage, the path index and the usage of
+        the user as they are removed.
+        """
+
+        root = CommandHandler.ROOT_DIR + user_id
+        self.write_behind.close_tree(path)
+        folders, files = walk_tree(path, job)
+        job.total_files, job.total_bytes = len(files), sum(size for file_path, size in files)
+        chunked = self.chunk_store.managed_under(path)
+        cold = self.cold_storage.managed_under(path)
+
+        def remove(item):
+            file_path, size = item
+            os.remove(file_path)
+            if file_path in chunked:
+                self.chunk_store.remove(file_path)
+            if file_path in cold:
+                self.cold_storage.remove(file_path)
+            self.disk_usage.add(user_id, -size, -1, path=file_path)
+            job.advance(size)
+
+        self.job_manager.fan_out(job, remove, files)
+        removed = 0
+        if not job.cancelled.is_set():
+            for folder in reversed([path] + folders):
+                try:
+                    os.rmdir(folder)
+                except OSError as error:
+                    job.failed(folder, error)
+                    continue
+                self.disk_usage.add(user_id, folders=-1, path=folder)
+                removed += 1
+        self.directory_cache.invalidate_tree(path)
+        self.directory_cache.invalidate(os.path.dirname(path))
+        if os.path.exists(path):
+            self.path_index.rescan(user_id, root)
+        else:
+            self.path_index.forget(user_id, os.path.relpath(path, root))
+        return self._job_summary(job, "Deleted folder " + name, removed)
+
+
+    def copy(self, source, destination):
+        """
+        This function copies a file or a folder and everything under it to
+        the destination, in a job.
+        -------
+        The folders are created first, then the files are copied in parallel
+        on the pool of the JobManager with copy_file(), which lets the kernel
+        copy the data. A file stored as chunks is copied by using its chunks
+        once more and a compressed file is copied decompressed. The copy is
+        refused when it would take the user over its quota.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        source_path = self._tree_path(source)
+        if source_path is None or not os.path.lexists(source_path):
+            return self._failed("\nGiven file or folder does not exist")
+        destination_path, error = self._destination(source_path, destination)
+        if error is not None:
+            return self._failed(error)
+        job = self.job_manager.start(self.user_id, "copy " + source + " " + destination,
+                                     [source_path, destination_path], self._copy_tree, self.user_id,
+                                     source_path, destination_path, source + " to " + destination)
+        return self._job_response(job, source)
+
+
+    def _copy_tree(self, job, user_id, source, destination, name):
+        """
+        This function is the job of copy(). The copies are added to the path
+        index and to the usage of the user as they are made.
+        """
+
+        root = CommandHandler.ROOT_DIR + user_id
+        self.write_behind.close_tree(source)
+        is_folder = os.path.isdir(source) and not os.path.islink(source)
+        if is_folder:
+            folders, files = walk_tree(source, job)
+            folders.insert(0, source)
+        else:
+            folders, files = [], [(source, os.lstat(source).st_size)]
+        job.total_files, job.total_bytes = len(files), sum(size for file_path, size in files)
+        if not self.disk_usage.allows(user_id, root, job.total_bytes):
+            raise JobFailed(self._quota_exceeded(job.total_bytes, user_id).lstrip("\n"))
+        chunked = self.chunk_store.managed_under(source)
+        cold = self.cold_storage.managed_under(source)
+        created = 0
+        for folder in folders:
+            if job.cancelled.is_set():
+                break
+            target = destination + folder[len(source):]
+            os.mkdir(target)
+            self.disk_usage.add(user_id, folders=1, path=target)
+            self.path_index.record(user_id, os.path.relpath(target, root), True, os.stat(target).st_size,
+                                   time.time())
+            created += 1
+
+        def copy(item):
+            file_path, size = item
+            target = destination + file_path[len(source):]
+            if file_path in chunked:
+                self.chunk_store.copy(file_path, target)
+            elif file_path in cold:
+                with self.cold_storage.open(file_path) as reader, open(target, "xb") as writer:
+                    shutil.copyfileobj(reader, writer)
+            else:
+                copy_file(file_path, target)
+            self.disk_usage.add(user_id, size, 1, path=target)
+            self.path_index.record(user_id, os.path.relpath(target, root), False, size, time.time())
+            job.advance(size)
+
+        self.job_manager.fan_out(job, copy, files)
+        self.directory_cache.invalidate(os.path.dirname(destination))
+        return self._job_summary(job, "Copied " + name, created)
+
+
+    def move(self, source, destination):
+        """
+        This function moves a file or a folder and everything under it to
+        the destination, in a job.
+        -------
+        On the same file system the move is one os.rename, after which the
+        entries of the chunk store, the cold storage and the path index are
+        given their new path. Across file systems the tree is copied and
+        then deleted.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        source_path = self._tree_path(source)
+        if source_path is None or not os.path.lexists(source_path):
+            return self._failed("\nGiven file or folder does not exist")
+        if self._holds_current_directory(source_path):
+            return self._failed("\nCannot move the current directory")
+        destination_path, error = self._destination(source_path, destination)
+        if error is not None:
+            return self._failed(error)
+        job = self.job_manager.start(self.user_id, "move " + source + " " + destination,
+                                     [source_path, destination_path], self._move_tree, self.user_id,
+                                     source_path, destination_path, source + " to " + destination)
+        return self._job_response(job, source)
+
+
+    def _move_tree(self, job, user_id, source, destination, name):
+        """
+        This function is the job of move().
+        """
+
+        root = CommandHandler.ROOT_DIR + user_id
+        # writes the buffered appends before the files are renamed or copied
+        self.write_behind.close_tree(source)
+        try:
+            os.rename(source, destination)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            copied = self._copy_tree(job, user_id, source, destination, name)
+            if job.cancelled.is_set() or job.errors:
+                return copied
+            files, size = job.files, job.bytes
+            self._delete_tree(job, user_id, source, name)
+            return "\nMoved " + name + " by copying " + str(files) + " files, " + str(size) + " bytes"
+        # a file appended to during the rename was opened again under the
+        # source path, and its handle would append to the moved file
+        self.write_behind.close_tree(source)
+        self.chunk_store.move_tree(source, destination)
+        self.cold_storage.move_tree(source, destination)
+        self.path_index.move(user_id, os.path.relpath(source, root), os.path.relpath(destination, root))
+        self.directory_cache.invalidate_tree(source)
+        self.directory_cache.invalidate(os.path.dirname(source))
+        self.directory_cache.invalidate(os.path.dirname(destination))
+        return "\nMoved " + name
+
+
+    def jobs(self, job_id=None):
+        """
+        This function gives the state and progress of the jobs of the user,
+        or of one job with its response once it is finished.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        jobs = self.job_manager.jobs(self.user_id, job_id)
+        if job_id is not None and not jobs:
+            return self._failed("\nNo such job " + str(job_id))
+        response = "\nJob | Command | State | Files | Bytes | Time" + "".join("\n" + job.progress() for job in jobs)
+        if job_id is not None and jobs[0].result is not None:
+            response += jobs[0].result
+        return response
+
+
+    def cancel(self, job_id):
+        """
+        This function stops a running job of the user. What it did so far
+        is kept.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        job = self.job_manager.cancel(self.user_id, job_id)
+        if job is None:
+            return self._failed("\nNo running job " + str(job_id))
+        if self.job_manager.wait(job, JobManager.WAIT_SECONDS):
+            return job.result
+        return "\nCancelling job " + str(job_id) + ": " + job.description
+
+
+    def _failed(self, message):
+        """
+        This function records the error message of the last failed
+        operation, so that batch() can tell failures from results.
+        """
+
+        self.last_error = message
+        return message
+
+
+    def create_folder(self, directory):
+        """
+        This function creates new directory as per the user command
+        --------
+        The function checks the existing directories before creating
+        new ones to avoid duplication.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        path = os.path.join(self.current_directory)
+        entry = self.directory_cache.lookup(path, directory)
+        if entry is not None and entry.is_dir:
+            return self._failed("\nThe directory is already created")
+        if entry is not None:
+            return self._failed("\nA file named " + directory + " already exists")
+        os.mkdir(os.path.join(path, directory))
+        self.disk_usage.add(self.user_id, folders=1, path=os.path.join(path, directory))
+        self._invalidate(path)
+        self._index(directory, True, os.stat(os.path.join(path, directory)).st_size)
+        return "\nSuccessfully created directory " + directory
+
+
+
+    def change_folder(self, directory):
+        """
+        This function is used to change the position of current directory for
+        the current user to the specified directory.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+
+        if directory == ".." and self.current_directory != CommandHandler.ROOT_DIR + self.user_id:
+            self.current_directory = os.path.dirname(os.path.join(self.current_directory))
+            return "\nSuccessfully moved to directory " + self.current_directory
+        
+        elif directory == ".." and self.current_directory == CommandHandler.ROOT_DIR + self.user_id:
+            return self._failed("\nCannot Move Back from Root/" + self.user_id + " directory")
+
+        entry = self.directory_cache.lookup(self.current_directory, directory)
+        if entry is not None and entry.is_dir:
+            self.current_directory = os.path.join(self.current_directory, directory)
+            return "\nSuccessfully Moved to directory " + self.current_directory
+        return self._failed("\n No such directory exists")
+
+
+    def read_file(self, filepath, char_count=None):
+        """
+        This function is used to read data from the file standing
+        in the current directory.
+        -------
+        If a file with specified name does not exist in the current
+        working directory for the user, the request is denied.
+        -------
+        Only the requested window of the file is read. self.read_index
+        keeps the byte offset of the next window for every file, the file
+        is seeked to that offset and char_count bytes are read from it.
+        Files bigger than MMAP_THRESHOLD are read through a memory map.
+        When the end of the file is reached the next read starts again
+        from the beginning. The files of the chunk store are read from
+        their chunks, and only the blocks of the window are decompressed
+        for the files of the cold storage.
+        -------
+        The response is kept in the response cache under the inode,
+        modification time and size of the file and the window, unless the
+        file was modified less than DirectoryCache.RACY_SECONDS ago, so
+        that polling an unchanged file does not read it again.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return self._failed(CommandHandler.NOT_LOGGED_IN)
+        if char_count is None:
+            char_count = self.char_count
+        if char_count <= 0 or char_count > CommandHandler.MAX_CHAR_COUNT:
+            return self._failed("\nNumber of characters should be between 1 and " + str(CommandHandler.MAX_CHAR_COUNT))
+        entry = self.directory_cache.lookup(self.current_directory, filepath)
+        if entry is None or entry.is_dir:
+            return self._failed("\nGiven file does not exist")
+        t_path = os.path.join(self.current_directory, filepath)
+        self.write_behind.flush(t_path)
+        status = os.stat(t_path)
+        size = status.st_size
+        offset = self.read_index.get(t_path, 0)
+        if offset >= size:
+            offset = 0
+        key = None
+        if time.time() - status.st_mtime >= DirectoryCache.RACY_SECONDS:
+            key = ("read_file", t_path, status.st_ino, status.st_mtime_ns, size, offset, char_count)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                next_offset, response = cached
+                self.read_index[t_path] = next_offset
+                return response
+        if self.chunk_store.manages(t_path):
+            data = self.whole_characters(self.chunk_store.read(t_path, offset, char_count), offset, size)
+        elif self.cold_storage.manages(t_path):
+            data = self.whole_characters(self.cold_storage.read(t_path, offset, char_count), offset, size)
+        else:
+            data = self.read_window(t_path, offset, char_count, size)
+        next_offset = offset + len(data)
+        if next_offset >= size:
+            next_offset = 0
+        self.read_index[t_path] = next_offset
+        response = "\n" + "Read file from " + str(offset) + " to " + str(offset + char_count) + "are\n" + \
+            data.decode(errors="replace")
+        if key is not None:
+            self.response_cache.put(key, (next_offset, response), len(response))
+        return response
+
+
+    @staticmethod
+    def read_window(path, offset, count, size):
+        """
+        This function returns at most count bytes of the file starting
+        at offset without reading the rest of the file.
+        -------
+        A window never ends in the middle of a UTF-8 character, so the
+        following window starts on a character boundary.
+        """
+
+        with open(path, "rb") as file:
+            if size >= CommandHandler.MMAP_THRESHOLD:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    data = view[offset:offset + count]
+            else:
+                file.seek(offset)
+                data = file.read(count)
+        return CommandHandler.whole_characters(data, offset, size)
+
+
+    @staticmethod
+    def whole_characters(data, offset, size):
+        """
+        This function cuts the UTF-8 character at the end of a window of
+        the file starting at offset, unless the window ends the file.
+        """
+
+        if offset + len(data) >= size:
+            return data
+        for back in range(1, min(4, len(data)) + 1):
+            byte = data[-back]
+            if byte & 0xC0 == 0x80:
+                continue
+            if byte & 0x80:
+                length = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4
+                if length > back and len(data) > back:
+                    data = data[:-back]
+            break
+        return data
+
+
+    def _transfer_path(self, filepath):
+        """
+        This function returns the path of a file of the current directory
+        which can be uploaded or downloaded, or None for names which
+        would leave the current directory.
+        """
+
+        if not filepath or filepath in (".", "..") or "/" in filepath or os.sep in filepath:
+            return None
+        return os.path.join(self.current_directory, filepath)
+
+
+    def open_file(self, path):
+        """
+        This function opens a file returned by start_download() for reading,
+        from the chunk store or the cold storage when it is stored there.
+        """
+
+        if self.chunk_store.manages(path):
+            return self.chunk_store.open(path)
+        if self.cold_storage.manages(path):
+            return self.cold_storage.open(path)
+        return open(path, "rb")
+
+
+    def batch(self, operations, stop_on_error=False):
+        """
+        This function runs many operations with one check of the login state
+        and returns the (name, ok, response) of every operation run.
+        --------
+        operations is a list of (name, function) where the function runs the
+        operation on this CommandHandler, or is None for an operation which
+        is not valid. Only the commands of BATCH_COMMANDS can be batched.
+        --------
+        The directories written to are invalidated in the directory cache once,
+        when an operation reads them back or the batch ends.
+        With stop_on_error the batch stops after the first failed operation.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return [("batch", False, CommandHandler.NOT_LOGGED_IN)]
+        results = []
+        self._batch = set()
+        try:
+            for name, function in operations:
+                if function is None or name not in CommandHandler.BATCH_COMMANDS:
+                    results.append((name, False, "Enter correct command"))
+                else:
+                    if name in CommandHandler.BATCH_READS:
+                        self._flush_batch()
+                    self.last_error = None
+                    response = function(self)
+                    results.append((name, self.last_error is None, response))
+                if stop_on_error and not results[-1][1]:
+                    break
+        finally:
+            self._flush_batch()
+            self._batch = None
+        return results
+
+
+    def _flush_batch(self):
+        """
+        This function invalidates the directories written to by the batch so far.
+        """
+
+        for path in self._batch:
+            self.directory_cache.invalidate(path)
+        self._batch.clear()
+
+
+    def start_upload(self, filepath, size=None):
+        """
+        This function prepares the upload of a file into the current directory.
+        -------
+        The data is written to a temporary file in the ROOT_DIR, on the same
+        file system as the user folders, so that finish_upload() can move it
+        into place atomically. Returns the temporary path and None, or None and
+        the error message.
+        -------
+        An upload of size bytes which would take the user over its quota,
+        counting the file it replaces, is refused before it is received.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return None, CommandHandler.NOT_LOGGED_IN
+        if self._transfer_path(filepath) is None:
+            return None, "\nInvalid file name " + filepath
+        entry = self.directory_cache.lookup(self.current_directory, filepath)
+        if entry is not None and entry.is_dir:
+            return None, "\nA directory named " + filepath + " already exists"
+        if size is not None:
+            growth = size - (entry.size if entry is not None else 0)
+            if not self.disk_usage.allows(self.user_id, self._user_root(), growth):
+                return None, self._quota_exceeded(growth)
+        descriptor, temp_path = tempfile.mkstemp(dir=CommandHandler.ROOT_DIR, prefix=CommandHandler.UPLOAD_PREFIX)
+        os.close(descriptor)
+        return temp_path, None
+
+
+    def finish_upload(self, temp_path, filepath):
+        """
+        This function renames a completely received upload into the current
+        directory, replacing a file with the same name.
+        """
+
+        path = self._transfer_path(filepath)
+        size = os.path.getsize(temp_path)
+        self.write_behind.close(path)
+        try:
+            replaced = os.path.getsize(path)
+            self.disk_usage.add(self.user_id, size - replaced, path=path)
+        except FileNotFoundError:
+            self.disk_usage.add(self.user_id, size, 1, path=path)
+        self.cold_storage.remove(path)
+        if self.chunk_store.enabled:
+            self.chunk_store.import_file(temp_path, path)
+        else:
+            if self.chunk_store.manages(path):
+                self.chunk_store.remove(path)
+            os.replace(temp_path, path)
+        self.directory_cache.invalidate(self.current_directory)
+        self._index(filepath, False, size)
+        return "\nUploaded " + str(size) + " bytes to file " + filepath
+
+
+    @staticmethod
+    def abort_upload(temp_path):
+        """
+        This function removes the temporary file of an upload which did not complete.
+        """
+
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+    def start_download(self, filepath):
+        """
+        This function checks a file of the current directory can be downloaded.
+        -------
+        Returns the path and size of the file and None, or None, 0 and the
+        error message.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return None, 0, CommandHandler.NOT_LOGGED_IN
+        path = self._transfer_path(filepath)
+        entry = self.directory_cache.lookup(self.current_directory, filepath)
+        if path is None or entry is None or entry.is_dir:
+            return None, 0, "\nGiven file does not exist"
+        self.write_behind.flush(path)
+        return path, os.path.getsize(path), None
+
+
+    def start_follow(self, filepath, offset=None):
+        """
+        This function checks a file of the current directory can be followed.
+        -------
+        Returns the path of the file, the offset from which it is followed,
+        its end by default, and its size and None, or None, 0, 0 and the
+        error message.
+        """
+
+        self.access_user_info()
+        if not self.is_login:
+            return None, 0, 0, CommandHandler.NOT_LOGGED_IN
+        path = self._transfer_path(filepath)
+        entry = self.directory_cache.lookup(self.current_directory, filepath)
+        if path is None or entry is None or entry.is_dir:
+            return None, 0, 0, "\nGiven file does not exist"
+        self.write_behind.flush(path)
+        size = os.path.getsize(path)
+        return path, size if offset is None else min(offset, size), size, None
+
+
+    def read_bytes(self, path, offset, count):
+        """
+        This function returns at most count bytes of a file from offset, from
+        the chunk store or the cold storage when it is stored there.
+        """
+
+        if self.chunk_store.manages(path):
+            return self.chunk_store.read(path, offset, count)
+        if self.cold_storage.manages(path):
+            return self.cold_storage.read(path, offset, count)
+        with open(path, "rb") as file:
+            file.seek(offset)
+            return file.read(count)
@@ -0,0 +1,202 @@
+"""
+This program caches the content of the directories
+so that the commands do not have to list a whole
+directory to find one name in it.
+"""
+
+import itertools
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+Entry = namedtuple("Entry", ["name", "is_dir", "size", "ctime", "mtime"])
+
+
+class DirectoryCache():
+    """
+    Process-wide cache of directory listings shared by every connection.
+    --------
+    A listing is kept with the modification time of its directory and is
+    used only while that modification time did not change, which happens
+    whenever an entry is created, renamed or removed. Changes to the size of
+    a file do not change the directory, so the commands which modify files
+    call update() or invalidate().
+    --------
+    Directories modified less than RACY_SECONDS ago are not cached, because
+    another change within the same timestamp tick would not be noticed.
+    --------
+    The least recently used listings are evicted once more than
+    max_directories listings or max_entries entries are cached.
+    ========
+    Methods:
+    --------
+    listing(): Returns the entries of a directory by name.
+    --------
+    snapshot(): Returns the entries of a directory with the version of its
+                cached listing, which changes whenever the listing does.
+    --------
+    lookup(): Returns the entry of one name in a directory, or None, without
+              scanning the directory when its listing is not cached.
+    --------
+    update(): Sets the size of a file of a cached listing.
+    --------
+    invalidate() / invalidate_tree(): Forget the listing of a directory, of
+                                      a directory and its sub directories.
+    """
+
+    RACY_SECONDS = 1.0
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_directories=256, max_entries=500000):
+        self.max_directories = max_directories
+        self.max_entries = max_entries
+        self.listings = OrderedDict()
+        self.cached_entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the cache of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    @staticmethod
+    def _scan(path):
+        entries = {}
+        with os.scandir(path) as scanner:
+            for entry in scanner:
+                try:
+                    status = entry.stat()
+                    is_dir = entry.is_dir()
+                except FileNotFoundError:
+                    continue
+                entries[entry.name] = Entry(entry.name, is_dir, status.st_size,
+                                            status.st_ctime, status.st_mtime)
+        return entries
+
+    def listing(self, path):
+        """
+        Returns a dictionary of the entries of the directory by name.
+        Raises NotADirectoryError if the path is not a directory.
+        """
+        return self.snapshot(path)[1]
+
+    def snapshot(self, path):
+        """
+        Returns the version of the cached listing of the directory and the
+        dictionary of its entries by name. The version is None when the
+        listing could not be cached, otherwise it changes with every change
+        of the listing, so it can key what is computed from the entries.
+        Raises NotADirectoryError if the path is not a directory.
+        """
+        key = self._key(path)
+        status = os.stat(path)
+        if not stat.S_ISDIR(status.st_mode):
+            raise NotADirectoryError(path)
+        with self._lock:
+            cached = self.listings.get(key)
+            if cached is not None and cached[0] == status.st_mtime_ns:
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return cached[2], cached[1]
+            self.misses += 1
+            invalidations = self.invalidations
+        entries = self._scan(path)
+        if time.time() - status.st_mtime < DirectoryCache.RACY_SECONDS:
+            return None, entries
+        with self._lock:
+            if invalidations != self.invalidations:
+                return None, entries
+            self._forget(key)
+            version = next(self._versions)
+            self.listings[key] = (status.st_mtime_ns, entries, version)
+            self.cached_entries += len(entries)
+            while self.listings and (len(self.listings) > self.max_directories
+                                     or self.cached_entries > self.max_entries):
+                self._forget(next(iter(self.listings)))
+        return version, entries
+
+    def lookup(self, path, name):
+        """
+        Returns the Entry of the name in the directory, or None.
+        --------
+        When the listing of the directory is not cached, only the name is
+        looked up with os.stat, so a directory which keeps changing is not
+        scanned again for every lookup.
+        """
+        if not name or name in (".", "..") or "/" in name or "\0" in name:
+            return None
+        try:
+            status = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not stat.S_ISDIR(status.st_mode):
+            return None
+        key = self._key(path)
+        with self._lock:
+            cached = self.listings.get(key)
+            if cached is not None and cached[0] == status.st_mtime_ns:
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return cached[1].get(name)
+            self.misses += 1
+        try:
+            status = os.stat(os.path.join(path, name))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return Entry(name, stat.S_ISDIR(status.st_mode), status.st_size, status.st_ctime, status.st_mtime)
+
+    def update(self, path, name, size):
+        """
+        Sets the size of a file of the cached listing of the directory after
+        it was appended to, which does not change the directory.
+        """
+        key = self._key(path)
+        with self._lock:
+            cached = self.listings.get(key)
+            if cached is None:
+                return
+            entry = cached[1].get(name)
+            if entry is not None:
+                cached[1][name] = entry._replace(size=size, mtime=time.time())
+                self.listings[key] = (cached[0], cached[1], next(self._versions))
+
+    def _forget(self, key):
+        cached = self.listings.pop(key, None)
+        if cached is not None:
+            self.cached_entries -= len(cached[1])
+
+    def invalidate(self, path):
+        """
+        Forgets the cached listing of the directory.
+        """
+        with self._lock:
+            self.invalidations += 1
+            self._forget(self._key(path))
+
+    def invalidate_tree(self, path):
+        """
+        Forgets the cached listings of the directory and of the directories
+        under it, after it was moved or removed.
+        """
+        key = self._key(path)
+        with self._lock:
+            self.invalidations += 1
+            for cached in [cached for cached in self.listings
+                           if cached == key or cached.startswith(key + os.sep)]:
+                self._forget(cached)
@@ -0,0 +1,286 @@
+"""
+This program keeps the disk usage of every user up to
+date as the commands write, so that it can be given and
+checked against a quota without walking the tree.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+Usage = namedtuple("Usage", ["bytes", "files", "folders", "quota", "reconciled"])
+
+
+class DiskUsage():
+    """
+    Totals of the bytes and the number of files and folders under the
+    folder of every user, shared by every connection of the process.
+    --------
+    The commands which create, grow, replace or remove entries call add()
+    with the change and the path changed. The changes are kept in memory and added to the rows
+    of the SQLite database in one transaction once the oldest is
+    FLUSH_SECONDS old, and on flush(). The rows read are kept for
+    FLUSH_SECONDS too, so usage() and allows() do not touch the disk on
+    every write, and see the changes of the other worker processes after
+    at most FLUSH_SECONDS.
+    --------
+    reconcile() walks the folder of a user and replaces its totals by what
+    is on the disk, plus the changes made by the commands during the walk,
+    which fixes the drift left by the changes made outside of the server.
+    A user without totals yet is reconciled on first use.
+    --------
+    self.default_quota : Bytes every user may store, None for no limit. The
+                         quota given to a user by set_quota() or
+                         set_quotas() replaces it.
+    ========
+    Methods:
+    --------
+    add(): Adds the change made by a command to the totals of a user.
+    --------
+    usage() / allows(): Return the totals of a user, tell if a user may
+                        store some more bytes.
+    --------
+    set_quota() / set_quotas(): Set the quota of one user, replace the
+                                quotas of all the users.
+    --------
+    reconcile() / reconcile_all(): Compute the totals of one user, of every
+                                   user, from the disk.
+    """
+
+    FLUSH_SECONDS = 1.0
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, database, default_quota=None):
+        self.database = database
+        self.default_quota = default_quota
+        self.rows = {}
+        self.pending = {}
+        self.pending_since = None
+        self.walking = {}
+        self.connection = None
+        self.identity = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, database=None):
+        """
+        Returns the disk usage of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(database)
+                atexit.register(cls._shared.flush)
+            return cls._shared
+
+    def _connect(self):
+        """
+        Opens the database, again when it was removed since it was opened.
+        The lock must be held.
+        """
+        try:
+            status = os.stat(self.database)
+            identity = (status.st_dev, status.st_ino)
+        except FileNotFoundError:
+            identity = None
+        if self.connection is not None and identity == self.identity:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+            self.rows.clear()
+        folder = os.path.dirname(self.database)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS usage (user_id TEXT PRIMARY KEY, "
+                                "bytes INTEGER NOT NULL, files INTEGER NOT NULL, folders INTEGER NOT NULL, "
+                                "quota INTEGER, reconciled REAL)")
+        status = os.stat(self.database)
+        self.identity = (status.st_dev, status.st_ino)
+        return self.connection
+
+    def add(self, user_id, size=0, files=0, folders=0, path=None):
+        """
+        Adds a change of the bytes, files and folders of the user, made to
+        the entry at path.
+        """
+        with self._lock:
+            change = self.pending.setdefault(user_id, [0, 0, 0])
+            change[0] += size
+            change[1] += files
+            change[2] += folders
+            walking = self.walking.get(user_id)
+            if walking is not None and (path is None or
+                                        os.path.dirname(os.path.normpath(path)) in walking[1]):
+                walking[0][0] += size
+                walking[0][1] += files
+                walking[0][2] += folders
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            elif time.monotonic() - self.pending_since >= DiskUsage.FLUSH_SECONDS:
+                self._flush()
+
+    def flush(self):
+        """
+        Writes the pending changes to the database.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        changes = [(size, files, folders, user_id) for user_id, (size, files, folders) in self.pending.items()]
+        self.pending = {}
+        self.pending_since = None
+        connection = self._connect()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany("UPDATE usage SET bytes = bytes + ?, files = files + ?, folders = folders + ? "
+                                   "WHERE user_id = ?", changes)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        for change in changes:
+            self.rows.pop(change[3], None)
+
+    def _row(self, user_id, root):
+        """
+        Returns the row of the user read less than FLUSH_SECONDS ago,
+        reconciling the user first when it has no row yet.
+        """
+        with self._lock:
+            cached = self.rows.get(user_id)
+            if cached is not None and time.monotonic() - cached[0] < DiskUsage.FLUSH_SECONDS:
+                return cached[1]
+            row = self._connect().execute("SELECT bytes, files, folders, quota, reconciled FROM usage "
+                                          "WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                self.rows[user_id] = (time.monotonic(), row)
+                return row
+        self.reconcile(user_id, root)
+        return self._row(user_id, root)
+
+    def usage(self, user_id, root):
+        """
+        Returns the Usage of the user whose folder is root, with the quota
+        which applies to it.
+        """
+        size, files, folders, quota, reconciled = self._row(user_id, root)
+        with self._lock:
+            change = self.pending.get(user_id, (0, 0, 0))
+        return Usage(size + change[0], files + change[1], folders + change[2],
+                     self.default_quota if quota is None else quota, reconciled)
+
+    def allows(self, user_id, root, size):
+        """
+        Returns True if the user may store size more bytes.
+        """
+        usage = self.usage(user_id, root)
+        return size <= 0 or usage.quota is None or usage.bytes + size <= usage.quota
+
+    def set_quota(self, user_id, root, quota):
+        """
+        Sets the quota of the user, None to use the default quota.
+        """
+        self._row(user_id, root)
+        with self._lock:
+            self._connect().execute("UPDATE usage SET quota = ? WHERE user_id = ?", (quota, user_id))
+            self.rows.pop(user_id, None)
+
+    def set_quotas(self, root, quotas):
+        """
+        Gives every user of the dictionary quotas its quota, and the default
+        quota to all the other users, so a quota taken out of the options of
+        the server does not stay in the database. root holds the folders of
+        the users.
+        """
+        for user_id in quotas:
+            self._row(user_id, os.path.join(root, user_id))
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("UPDATE usage SET quota = NULL WHERE quota IS NOT NULL")
+                connection.executemany("UPDATE usage SET quota = ? WHERE user_id = ?",
+                                       [(quota, user_id) for user_id, quota in quotas.items()])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self.rows.clear()
+
+    @staticmethod
+    def _walk(root, passed=None):
+        """
+        Returns the bytes of the files, the number of files and the number
+        of folders under the folder, without following symbolic links. The
+        folders whose entries were counted are added to the set passed.
+        """
+        size = files = folders = 0
+        pending = [root]
+        while pending:
+            folder = pending.pop()
+            try:
+                scanner = os.scandir(folder)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            with scanner:
+                for entry in scanner:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders += 1
+                            pending.append(entry.path)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except FileNotFoundError:
+                        continue
+            if passed is not None:
+                passed.add(os.path.normpath(folder))
+        return size, files, folders
+
+    def reconcile(self, user_id, root):
+        """
+        Replaces the totals of the user by the ones of its folder on the
+        disk, and returns the Usage. The changes added while the folder is
+        walked to the entries of a folder the walk had already counted are
+        added to what the walk found. The changes to the folders it had not
+        reached yet are left out, as the walk finds them on the disk. A
+        change made to a folder while the walk counts it may be missed,
+        and is counted by the next reconcile.
+        """
+        with self._lock:
+            self.walking[user_id] = ([0, 0, 0], set())
+        try:
+            size, files, folders = self._walk(root, self.walking[user_id][1])
+        finally:
+            with self._lock:
+                during = self.walking.pop(user_id)[0]
+        with self._lock:
+            self._flush()
+            self._connect().execute("INSERT INTO usage (user_id, bytes, files, folders, reconciled) "
+                                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+                                    "bytes = excluded.bytes, files = excluded.files, folders = excluded.folders, "
+                                    "reconciled = excluded.reconciled",
+                                    (user_id, size + during[0], files + during[1], folders + during[2], time.time()))
+            self.rows.pop(user_id, None)
+        return self.usage(user_id, root)
+
+    def reconcile_all(self, root):
+        """
+        Reconciles every user with a folder under root and returns their number.
+        """
+        with os.scandir(root) as scanner:
+            users = [entry.name for entry in scanner
+                     if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")]
+        for user_id in users:
+            self.reconcile(user_id, os.path.join(root, user_id))
+        return len(users)
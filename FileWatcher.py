@@ -0,0 +1,373 @@
+"""
+This program tells the connections following a file
+about the bytes appended to it as soon as they are
+written, with inotify, or by polling the size of the
+file where inotify is missing.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from collections import deque
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+FOLDER_EVENTS = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class Inotify():
+    """
+    The inotify calls of the C library, through ctypes.
+    Raises OSError when the system does not have them.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            self._init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError("inotify is not available")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.descriptor = self._init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        watch = self._add_watch(self.descriptor, os.fsencode(path), mask)
+        if watch < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return watch
+
+    def remove_watch(self, watch):
+        self._rm_watch(self.descriptor, watch)
+
+    def read_events(self):
+        """
+        Returns the (watch, mask, name) of the events waiting to be read.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.descriptor, 64 * 1024)
+            except BlockingIOError:
+                return events
+            position = 0
+            while position + EVENT.size <= len(data):
+                watch, mask, cookie, length = EVENT.unpack_from(data, position)
+                position += EVENT.size
+                name = data[position:position + length].rstrip(b"\0")
+                position += length
+                events.append((watch, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.descriptor)
+
+
+class Subscriber():
+    """
+    One client following a file, fed by the Watch of the file.
+    --------
+    self.position : Offset of the next byte to give to the client
+    --------
+    self.target : Size of the file the Watch last saw
+    --------
+    self.chunks : (offset, bytes) read by the Watch for every subscriber. A
+                  subscriber with MAX_QUEUED bytes waiting gets no more of
+                  them and reads the bytes it missed from the file itself,
+                  so a slow client costs no memory and does not slow the others.
+    --------
+    self.ended : Why the follow ended, None while it goes on
+    """
+
+    MAX_QUEUED = 1024 * 1024
+
+    def __init__(self, watch, position):
+        self.watch = watch
+        self.position = position
+        self.target = max(position, watch.size)
+        self.chunks = deque()
+        self.queued = 0
+        self.ended = None
+        self.changed = asyncio.Event()
+
+    def push(self, offset, data, end):
+        self.target = max(self.target, end)
+        if data is not None and self.queued + len(data) <= Subscriber.MAX_QUEUED:
+            self.chunks.append((offset, data))
+            self.queued += len(data)
+        self.changed.set()
+
+    def end(self, reason):
+        if self.ended is None:
+            self.ended = reason
+        self.changed.set()
+
+    async def read(self):
+        """
+        Waits for bytes appended to the file and returns them, or returns
+        None once the follow ended and everything before was given.
+        """
+        while True:
+            self.changed.clear()
+            while self.chunks and self.chunks[0][0] <= self.position:
+                offset, data = self.chunks.popleft()
+                self.queued -= len(data)
+                if offset + len(data) > self.position:
+                    data = data[self.position - offset:]
+                    self.position += len(data)
+                    return data
+            end = self.chunks[0][0] if self.chunks else self.target
+            if end > self.position and self.ended is None:
+                data = await self.watch.read(self.position, min(end - self.position, READ_SIZE))
+                if data:
+                    self.position += len(data)
+                    return data
+            if self.ended is not None:
+                return None
+            await self.changed.wait()
+
+
+class Watch():
+    """
+    The subscribers of one file and the size of the file given to them.
+    The appended bytes are read once and given to every subscriber.
+    """
+
+    def __init__(self, path, size, run, read):
+        self.path = path
+        self.size = size
+        self.run = run
+        self.reader = read
+        self.subscribers = set()
+        self.checking = False
+        self.again = False
+        self.ended = False
+
+    async def read(self, offset, count):
+        return await self.run(self.reader, self.path, offset, count)
+
+    async def check(self):
+        """
+        Gives the bytes appended since the last check to the subscribers,
+        and ends the follows when the file was removed or made shorter.
+        Checks which come while one runs are done once after it.
+        """
+        if self.checking:
+            self.again = True
+            return
+        self.checking = True
+        try:
+            self.again = True
+            while self.again and self.subscribers:
+                self.again = False
+                try:
+                    size = os.stat(self.path).st_size
+                except FileNotFoundError:
+                    self.end("removed")
+                    return
+                if size < self.size:
+                    self.end("truncated")
+                    return
+                if size == self.size:
+                    continue
+                offset, self.size = self.size, size
+                try:
+                    data = await self.read(offset, min(size - offset, Subscriber.MAX_QUEUED))
+                except OSError as error:
+                    self.end(error.strerror or str(error))
+                    return
+                for subscriber in list(self.subscribers):
+                    subscriber.push(offset, data, size)
+        finally:
+            self.checking = False
+
+    def end(self, reason):
+        self.ended = True
+        for subscriber in list(self.subscribers):
+            subscriber.end(reason)
+
+
+class FileWatcher():
+    """
+    The files followed by the connections of the process, shared by every
+    connection and run on the event loop.
+    --------
+    Every followed file has one Watch, however many connections follow it.
+    The folders of the followed files are watched with one inotify
+    descriptor read by the event loop, so an append wakes the watch of the
+    file at once. Without inotify, or with poll_seconds set, the followed
+    files are checked every poll_seconds seconds instead.
+    --------
+    A follow goes on when the file is replaced by a file at least as long,
+    and ends when the file is removed or made shorter.
+    ========
+    Methods:
+    --------
+    follow() / unfollow(): Subscribe to the bytes appended to a file, stop.
+    --------
+    stats(): Returns the number of files followed and of subscribers.
+    """
+
+    POLL_SECONDS = 0.5
+    _shared = None
+
+    def __init__(self, poll_seconds=None):
+        self.poll_seconds = poll_seconds
+        self.watches = {}
+        self.folders = {}
+        self.folder_watches = {}
+        self.inotify = None
+        self.loop = None
+        self.poller = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the file watcher of this process, creating it on first use.
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def _start(self):
+        """
+        Binds the watcher to the running event loop, with inotify when it can.
+        """
+        self.loop = asyncio.get_running_loop()
+        if self.poll_seconds is None:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.inotify = None
+        if self.inotify is not None:
+            self.loop.add_reader(self.inotify.descriptor, self._read_events)
+        else:
+            self.poller = asyncio.ensure_future(self._poll())
+
+    def _stop(self):
+        """
+        Forgets the watches of an event loop which is not running any more.
+        """
+        self.watches.clear()
+        self.folders.clear()
+        self.folder_watches.clear()
+        if self.inotify is not None:
+            if not self.loop.is_closed():
+                self.loop.remove_reader(self.inotify.descriptor)
+            self.inotify.close()
+            self.inotify = None
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+        self.loop = None
+
+    def follow(self, path, position, size, run, read):
+        """
+        Returns a Subscriber of the bytes appended to the file from position.
+        size is the size of the file now, run(read, path, offset, count) is
+        awaited to read the file.
+        """
+        if self.loop is not asyncio.get_running_loop():
+            if self.loop is not None:
+                self._stop()
+            self._start()
+        key = os.path.abspath(path)
+        watch = self.watches.get(key)
+        if watch is None or watch.ended:
+            watch = self.watches[key] = Watch(key, size, run, read)
+            self._watch_folder(os.path.dirname(key))
+        subscriber = Subscriber(watch, position)
+        watch.subscribers.add(subscriber)
+        if watch.size < size:
+            asyncio.ensure_future(watch.check())
+        return subscriber
+
+    def _watch_folder(self, folder):
+        if self.inotify is None:
+            return
+        watched = self.folders.get(folder)
+        if watched is not None:
+            self.folders[folder] = (watched[0], watched[1] + 1)
+            return
+        try:
+            descriptor = self.inotify.add_watch(folder, FOLDER_EVENTS)
+        except OSError:
+            return
+        self.folders[folder] = (descriptor, 1)
+        self.folder_watches[descriptor] = folder
+
+    def _unwatch_folder(self, folder):
+        watched = self.folders.get(folder)
+        if watched is None:
+            return
+        if watched[1] > 1:
+            self.folders[folder] = (watched[0], watched[1] - 1)
+            return
+        del self.folders[folder]
+        self.folder_watches.pop(watched[0], None)
+        self.inotify.remove_watch(watched[0])
+
+    def unfollow(self, subscriber):
+        """
+        Stops giving the appended bytes to the subscriber, and stops watching
+        the file when nobody follows it any more.
+        """
+        subscriber.end("unfollowed")
+        watch = subscriber.watch
+        if subscriber not in watch.subscribers:
+            return
+        watch.subscribers.discard(subscriber)
+        if watch.subscribers:
+            return
+        if self.watches.get(watch.path) is watch:
+            del self.watches[watch.path]
+        self._unwatch_folder(os.path.dirname(watch.path))
+
+    def _read_events(self):
+        changed = set()
+        for descriptor, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.watches.values())
+                continue
+            folder = self.folder_watches.get(descriptor)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                changed.update(watch for path, watch in self.watches.items() if os.path.dirname(path) == folder)
+                continue
+            watch = self.watches.get(os.path.join(folder, name))
+            if watch is not None:
+                changed.add(watch)
+        for watch in changed:
+            asyncio.ensure_future(watch.check())
+
+    async def _poll(self):
+        """
+        Checks every followed file every poll_seconds seconds, or POLL_SECONDS.
+        """
+        while True:
+            await asyncio.sleep(self.poll_seconds or FileWatcher.POLL_SECONDS)
+            for watch in list(self.watches.values()):
+                asyncio.ensure_future(watch.check())
+
+    def stats(self):
+        return {"files": len(self.watches), "subscribers": sum(len(watch.subscribers)
+                                                                for watch in self.watches.values()),
+                "mode": "poll" if self.loop is not None and self.inotify is None else "inotify"}
@@ -0,0 +1,305 @@
+"""
+This program runs the commands which work on whole
+trees in the background, with their progress, so
+that they can be followed and cancelled while the
+other commands go on.
+"""
+
+import itertools
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def walk_tree(root, job=None):
+    """
+    Returns the folders under root, parents before their sub folders, and
+    the (path, size) of the files under it, without following symbolic
+    links. Stops early when the job is cancelled.
+    """
+    folders = []
+    files = []
+    pending = [root]
+    while pending and (job is None or not job.cancelled.is_set()):
+        try:
+            scanner = os.scandir(pending.pop())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with scanner:
+            for entry in scanner:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                        pending.append(entry.path)
+                    else:
+                        files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+                except FileNotFoundError:
+                    continue
+    return folders, files
+
+
+def copy_file(source, destination):
+    """
+    Copies the content of a file into a new file without reading it into
+    Python, with copy_file_range where the kernel has it, which lets the
+    file system share or copy the blocks itself, and sendfile otherwise.
+    Returns the number of bytes copied.
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+        return 0
+    with open(source, "rb") as reader, open(destination, "xb") as writer:
+        size = os.fstat(reader.fileno()).st_size
+        copied = 0
+        for function in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if function is None:
+                continue
+            try:
+                while copied < size:
+                    if function is os.sendfile:
+                        count = function(writer.fileno(), reader.fileno(), copied, size - copied)
+                    else:
+                        count = function(reader.fileno(), writer.fileno(), size - copied, copied, copied)
+                    if count == 0:
+                        break
+                    copied += count
+                return copied
+            except OSError:
+                if copied:
+                    raise
+        shutil.copyfileobj(reader, writer, 1024 * 1024)
+        return writer.tell()
+
+
+class JobFailed(Exception):
+    """
+    Raised by the function of a job to end it with the message as its response.
+    """
+
+
+class Job():
+    """
+    One command running in the background for a user.
+    --------
+    self.job_id : Number of the job in the process
+    --------
+    self.user_id / self.description : The user who started it and its command line
+    --------
+    self.paths : The paths it works on, no other job may work on them meanwhile
+    --------
+    self.state : "running", then "done", "failed" or "cancelled"
+    --------
+    self.files / self.bytes : Files and bytes done so far, of total_files
+                              and total_bytes once the tree was walked
+    --------
+    self.errors / self.first_error : Number of the files which failed and
+                                     the error of the first one
+    --------
+    self.result : Response of the command once it is finished
+    """
+
+    def __init__(self, job_id, user_id, description, paths):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.description = description
+        self.paths = paths
+        self.state = "running"
+        self.files = 0
+        self.bytes = 0
+        self.total_files = None
+        self.total_bytes = None
+        self.errors = 0
+        self.first_error = None
+        self.result = None
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def advance(self, size):
+        """
+        Counts one more file of size bytes done.
+        """
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def failed(self, path, error):
+        """
+        Counts one more file which failed.
+        """
+        with self._lock:
+            self.errors += 1
+            if self.first_error is None:
+                self.first_error = path + ": " + (getattr(error, "strerror", None) or str(error))
+
+    def progress(self):
+        """
+        Returns the state and progress of the job as one line of text.
+        """
+        files = str(self.files) + ("" if self.total_files is None else " of " + str(self.total_files))
+        size = str(self.bytes) + ("" if self.total_bytes is None else " of " + str(self.total_bytes))
+        line = " | ".join([str(self.job_id), self.description, self.state, files + " files", size + " bytes",
+                           str(round((self.finished or time.time()) - self.started, 1)) + "s"])
+        if self.errors:
+            line += " | " + str(self.errors) + " errors, first: " + self.first_error
+        return line
+
+
+class JobManager():
+    """
+    Runs the jobs of the users of the process in the background and keeps
+    the last FINISHED_KEPT finished ones, shared by every connection.
+    --------
+    Every job runs its function in a thread of its own, which walks the tree
+    and gives the work on the files to fan_out(), run on a pool of threads
+    threads shared by the jobs, so a command on a large tree neither stalls
+    the threads of the commands nor waits for one file after the other.
+    --------
+    The jobs live in the process which started them, so with several worker
+    processes a job is only seen from the connections of its worker.
+    ========
+    Methods:
+    --------
+    start(): Starts a job, unless another job works on the same paths.
+    --------
+    fan_out(): Runs a function on many files of a job on the pool.
+    --------
+    wait() / jobs() / cancel(): Wait for a job, return the jobs of a user,
+                                cancel a job.
+    --------
+    cancel_all(): Cancels every job, when the server stops.
+    """
+
+    FINISHED_KEPT = 100
+    WAIT_SECONDS = 0.2
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, threads=8):
+        self.threads = threads
+        self.pool = None
+        self.jobs_by_id = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the job manager of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @staticmethod
+    def _overlap(first, second):
+        return first == second or first.startswith(second + os.sep) or second.startswith(first + os.sep)
+
+    def start(self, user_id, description, paths, function, *args):
+        """
+        Starts a job running function(job, *args), which returns the response
+        of the command, and returns the Job. Returns None when a running job
+        works on one of the paths, or on a folder holding one of them.
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        with self._lock:
+            for job in self.jobs_by_id.values():
+                if job.state == "running" and any(self._overlap(path, other)
+                                                  for path in paths for other in job.paths):
+                    return None
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="job")
+            job = Job(next(self._ids), user_id, description, paths)
+            self.jobs_by_id[job.job_id] = job
+            finished = [key for key, old in self.jobs_by_id.items() if old.state != "running"]
+            for key in finished[:max(len(finished) - JobManager.FINISHED_KEPT, 0)]:
+                del self.jobs_by_id[key]
+        threading.Thread(target=self._run, args=(job, function, args), name="job-" + str(job.job_id),
+                         daemon=True).start()
+        return job
+
+    def _run(self, job, function, args):
+        try:
+            job.result = function(job, *args)
+            job.state = "cancelled" if job.cancelled.is_set() else "done"
+        except JobFailed as error:
+            job.result = "\n" + str(error)
+            job.state = "failed"
+        except Exception as error:
+            job.result = "\nJob " + str(job.job_id) + " failed: " + str(error)
+            job.state = "failed"
+        finally:
+            job.finished = time.time()
+            job.done.set()
+
+    def fan_out(self, job, function, items):
+        """
+        Runs function(item) for every item on the pool, with at most four
+        items per thread waiting, until the job is cancelled. Any error of an
+        item is counted as a failed file of the job and the others go on.
+        """
+        running = set()
+        for item in items:
+            if job.cancelled.is_set():
+                break
+            running.add(self.pool.submit(self._item, job, function, item))
+            if len(running) >= self.threads * 4:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+        wait(running)
+
+    @staticmethod
+    def _item(job, function, item):
+        if job.cancelled.is_set():
+            return
+        try:
+            function(item)
+        except Exception as error:
+            job.failed(item[0] if isinstance(item, tuple) else item, error)
+
+    def wait(self, job, timeout=None):
+        """
+        Waits until the job is finished or timeout seconds passed and returns
+        True if it is finished.
+        """
+        return job.done.wait(timeout)
+
+    def jobs(self, user_id, job_id=None):
+        """
+        Returns the jobs of the user, or the job job_id in a list when it is one of them.
+        """
+        with self._lock:
+            return [job for job in self.jobs_by_id.values()
+                    if job.user_id == user_id and (job_id is None or job.job_id == job_id)]
+
+    def cancel(self, user_id, job_id):
+        """
+        Asks the running job job_id of the user to stop and returns it, or None.
+        """
+        for job in self.jobs(user_id, job_id):
+            if job.state == "running":
+                job.cancelled.set()
+                return job
+        return None
+
+    def cancel_all(self):
+        """
+        Asks every running job to stop.
+        """
+        with self._lock:
+            jobs = list(self.jobs_by_id.values())
+        for job in jobs:
+            job.cancelled.set()
+
+    def stats(self):
+        """
+        Returns the number of running and finished jobs.
+        """
+        with self._lock:
+            running = sum(1 for job in self.jobs_by_id.values() if job.state == "running")
+            return {"threads": self.threads, "running": running, "finished": len(self.jobs_by_id) - running}
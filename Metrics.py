@@ -0,0 +1,256 @@
+"""
+This program collects the metrics of the server:
+counters and latencies of the commands, bytes
+transferred and connections.
+"""
+
+import bisect
+import io
+import itertools
+import json
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+
+
+class Histogram():
+    """
+    Latency histogram with fixed buckets, from 0.1 ms to 5 s.
+    --------
+    self.buckets : Number of samples at most each bound of LATENCY_BUCKETS
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, fraction):
+        """
+        Returns the bound of the bucket holding the given fraction of the samples.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        for bound, seen in zip(LATENCY_BUCKETS, itertools.accumulate(self.buckets)):
+            if seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.maximum * 1000, 3),
+        }
+
+
+class Metrics():
+    """
+    Process-wide metrics of the server. Nothing is recorded while
+    self.enabled is False, so the callers only pay for one check.
+    --------
+    self.commands : Latency histogram of every command
+    --------
+    self.timers : Latency histogram of internal steps, like access_user_info
+    --------
+    self.bytes_in / self.bytes_out : Bytes received and sent for the commands
+    --------
+    self.connections : Number of open connections
+    --------
+    self.profile_every : When set, one command out of profile_every is run
+                        under cProfile and its profile added to self.profile
+    ========
+    Methods:
+    --------
+    record(): Records one command.
+    --------
+    record_time(): Records the time spent in an internal step, see Timer.
+    --------
+    profiled(): Runs a command under cProfile.
+    --------
+    report() / profile_report(): Return the metrics and the profile as text.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, enabled=False, profile_every=None):
+        self.enabled = enabled
+        self.profile_every = profile_every
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the metrics of this process, creating them on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def reset(self):
+        """
+        Clears every metric.
+        """
+        with self._lock:
+            self.started = time.time()
+            self.commands = {}
+            self.timers = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.connections = 0
+            self.connections_total = 0
+            self.dispatched = 0
+            self.profile = None
+
+    def record(self, command, seconds, bytes_in=0, bytes_out=0):
+        """
+        Records one command with its latency and size.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = Histogram()
+            histogram.add(seconds)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def record_time(self, step, seconds):
+        """
+        Records the time spent in an internal step.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.timers.get(step)
+            if histogram is None:
+                histogram = self.timers[step] = Histogram()
+            histogram.add(seconds)
+
+    def connection_opened(self):
+        if self.enabled:
+            with self._lock:
+                self.connections += 1
+                self.connections_total += 1
+
+    def connection_closed(self):
+        if self.enabled:
+            with self._lock:
+                self.connections = max(self.connections - 1, 0)
+
+    def should_profile(self):
+        """
+        Returns True for one command out of profile_every.
+        """
+        if not self.enabled or not self.profile_every:
+            return False
+        with self._lock:
+            self.dispatched += 1
+            return self.dispatched % self.profile_every == 0
+
+    def profiled(self, function, *args):
+        """
+        Runs the function under cProfile and adds its profile to the others.
+        cProfile and pstats are only imported when profiling is used, they
+        would slow down the start of every process.
+        """
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            with self._lock:
+                if self.profile is None:
+                    self.profile = pstats.Stats(profiler, stream=io.StringIO())
+                else:
+                    self.profile.add(profiler)
+
+    def snapshot(self, **extra):
+        """
+        Returns the metrics as a dictionary.
+        """
+        with self._lock:
+            return dict({
+                "uptime_s": round(time.time() - self.started, 3),
+                "connections": self.connections,
+                "connections_total": self.connections_total,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "commands": {name: histogram.summary() for name, histogram in sorted(self.commands.items())},
+                "timers": {name: histogram.summary() for name, histogram in sorted(self.timers.items())},
+            }, **extra)
+
+    def report(self, output="text", **extra):
+        """
+        Returns the metrics as a table, or as json when output is "json".
+        Extra values, like the state of the thread pool, are added to the report.
+        """
+        if not self.enabled:
+            return "\nMetrics are disabled, start the server with --metrics"
+        values = self.snapshot(**extra)
+        if output == "json":
+            return json.dumps(values)
+        lines = ["\nUptime: " + str(values["uptime_s"]) + " s | Connections: " + str(values["connections"])
+                 + " open, " + str(values["connections_total"]) + " total | Bytes in: "
+                 + str(values["bytes_in"]) + " | Bytes out: " + str(values["bytes_out"])]
+        for name, value in extra.items():
+            lines.append(name + ": " + str(value))
+        lines.append("Command | Count | Mean ms | p50 ms | p99 ms | Max ms")
+        for group in ("commands", "timers"):
+            for name, summary in values[group].items():
+                lines.append(" | ".join([name, str(summary["count"]), str(summary["mean_ms"]),
+                                         str(summary["p50_ms"]), str(summary["p99_ms"]), str(summary["max_ms"])]))
+        return "\n".join(lines)
+
+    def profile_report(self, limit=20):
+        """
+        Returns the functions with the most cumulative time in the sampled commands.
+        """
+        if not self.enabled or not self.profile_every:
+            return "\nProfiling is disabled, start the server with --metrics --profile-every <n>"
+        with self._lock:
+            if self.profile is None:
+                return "\nNo command was profiled yet"
+            output = io.StringIO()
+            self.profile.stream = output
+            self.profile.sort_stats("cumulative").print_stats(limit)
+        return "\n" + output.getvalue()
+
+
+class Timer():
+    """
+    Context manager recording the time spent in its block as an internal
+    step of the metrics, only while they are enabled.
+    """
+
+    def __init__(self, metrics, step):
+        self.metrics = metrics
+        self.step = step
+        self.start = None
+
+    def __enter__(self):
+        if self.metrics.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.metrics.record_time(self.step, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,256 @@
+"""
+This program keeps an index of the files and folders
+of every user in a SQLite database, so that a user's
+whole tree can be searched without listing it.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+IndexEntry = namedtuple("IndexEntry", ["path", "is_dir", "size", "mtime"])
+
+
+class PathIndex():
+    """
+    Index of the entries of the tree of every user, by path relative to the
+    folder of the user, shared by every connection of the process.
+    --------
+    The commands which create or write entries call record(). The records are
+    kept in memory and written to the database in one transaction once
+    MAX_PENDING of them are waiting or the oldest is FLUSH_SECONDS old, and
+    before every query.
+    --------
+    The tree of a user is scanned again when it was never scanned, when the
+    folder of the user was replaced, when the index is older than max_age
+    seconds, or on rescan(), to pick up changes made outside the server.
+    ========
+    Methods:
+    --------
+    record(): Adds or updates one entry.
+    --------
+    find(): Returns the entries under a folder matching a name pattern,
+            a text, a size range, a modification time range and a type.
+    --------
+    rescan(): Indexes the tree of a user again from the disk.
+    --------
+    forget() / move(): Remove an entry and the entries under it, give them
+                       another path.
+    """
+
+    MAX_PENDING = 1000
+    FLUSH_SECONDS = 1.0
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, database, max_age=None):
+        self.database = database
+        self.max_age = max_age
+        self.pending = {}
+        self.pending_since = None
+        self.connection = None
+        self.identity = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, database=None):
+        """
+        Returns the index of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(database)
+                atexit.register(cls._shared.flush)
+            return cls._shared
+
+    def _connect(self):
+        """
+        Opens the database, again when it was removed since it was opened.
+        The lock must be held.
+        """
+        try:
+            status = os.stat(self.database)
+            identity = (status.st_dev, status.st_ino)
+        except FileNotFoundError:
+            identity = None
+        if self.connection is not None and identity == self.identity:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+        folder = os.path.dirname(self.database)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(self.database, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (user_id TEXT NOT NULL, path TEXT NOT NULL, "
+                                "name TEXT NOT NULL, is_dir INTEGER NOT NULL, size INTEGER NOT NULL, "
+                                "mtime REAL NOT NULL, PRIMARY KEY (user_id, path)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_name ON entries (user_id, name)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_size ON entries (user_id, size)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_mtime ON entries (user_id, mtime)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scans (user_id TEXT PRIMARY KEY, "
+                                "root INTEGER NOT NULL, scanned REAL NOT NULL)")
+        status = os.stat(self.database)
+        self.identity = (status.st_dev, status.st_ino)
+        return self.connection
+
+    def record(self, user_id, path, is_dir, size, mtime):
+        """
+        Adds or updates the entry of the path of the user.
+        """
+        with self._lock:
+            self.pending[(user_id, path)] = (user_id, path, os.path.basename(path), int(is_dir), size, mtime)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            if len(self.pending) < PathIndex.MAX_PENDING and \
+                    time.monotonic() - self.pending_since < PathIndex.FLUSH_SECONDS:
+                return
+            self._flush()
+
+    def flush(self):
+        """
+        Writes the pending records to the database.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        rows = list(self.pending.values())
+        self.pending = {}
+        self.pending_since = None
+        connection = self._connect()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def forget(self, user_id, path):
+        """
+        Removes the entry of the path of the user and the entries under it.
+        """
+        with self._lock:
+            self._flush()
+            self._connect().execute("DELETE FROM entries WHERE user_id = ? AND "
+                                    "(path = ? OR (path > ? AND path < ?))", (user_id, path, path + "/", path + "0"))
+
+    def move(self, user_id, path, destination):
+        """
+        Gives the entry of the path of the user and the entries under it
+        their path under the destination, after the path was renamed.
+        """
+        with self._lock:
+            self._flush()
+            self._connect().execute("UPDATE OR REPLACE entries SET path = ? || substr(path, ?), "
+                                    "name = CASE WHEN path = ? THEN ? ELSE name END "
+                                    "WHERE user_id = ? AND (path = ? OR (path > ? AND path < ?))",
+                                    (destination, len(path) + 1, path, os.path.basename(destination),
+                                     user_id, path, path + "/", path + "0"))
+
+    @staticmethod
+    def _walk(user_id, root):
+        """
+        Yields the rows of every entry under the folder, without following
+        symbolic links.
+        """
+        folders = [(root, "")]
+        while folders:
+            folder, prefix = folders.pop()
+            try:
+                scanner = os.scandir(folder)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            with scanner:
+                for entry in scanner:
+                    try:
+                        status = entry.stat(follow_symlinks=False)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    path = prefix + entry.name
+                    yield (user_id, path, entry.name, int(is_dir), status.st_size, status.st_mtime)
+                    if is_dir:
+                        folders.append((entry.path, path + "/"))
+
+    def rescan(self, user_id, root):
+        """
+        Replaces the entries of the user by the ones found under its folder
+        and returns their number. The statistics of the tables are updated
+        afterwards, so that SQLite picks the index matching each query.
+        --------
+        The folder is walked without the lock, which is only taken to swap
+        in the entries found. The records made meanwhile are written after
+        them, as they are newer.
+        """
+        root_status = os.stat(root)
+        rows = list(self._walk(user_id, root))
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            try:
+                connection.execute("DELETE FROM entries WHERE user_id = ?", (user_id,))
+                connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+                count = connection.execute("SELECT COUNT(*) FROM entries WHERE user_id = ?",
+                                           (user_id,)).fetchone()[0]
+                connection.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?)",
+                                   (user_id, root_status.st_ino, time.time()))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._flush()
+            connection.execute("ANALYZE")
+        return count
+
+    def _ensure_scanned(self, user_id, root):
+        """
+        Scans the tree of the user when the index of it cannot be trusted.
+        """
+        root_status = os.stat(root)
+        with self._lock:
+            scan = self._connect().execute("SELECT root, scanned FROM scans WHERE user_id = ?",
+                                           (user_id,)).fetchone()
+        if scan is None or scan[0] != root_status.st_ino or \
+                (self.max_age is not None and time.time() - scan[1] > self.max_age):
+            self.rescan(user_id, root)
+
+    def find(self, user_id, root, folder="", name=None, contains=None, min_size=None, max_size=None,
+             newer=None, older=None, is_dir=None, limit=None):
+        """
+        Returns the IndexEntry of the entries of the user under the folder,
+        a path relative to root, sorted by path.
+        --------
+        name is a glob pattern of the name of the entries, contains a text
+        found in it, newer and older are modification times, is_dir selects
+        folders or files.
+        """
+        self._ensure_scanned(user_id, root)
+        query = "SELECT path, is_dir, size, mtime FROM entries WHERE user_id = ?"
+        parameters = [user_id]
+        if folder:
+            query += " AND path > ? AND path < ?"
+            parameters += [folder + "/", folder + "0"]
+        for condition, value in (("name GLOB ?", name), ("instr(name, ?) > 0", contains),
+                                 ("size >= ?", min_size), ("size <= ?", max_size),
+                                 ("mtime >= ?", newer), ("mtime <= ?", older),
+                                 ("is_dir = ?", None if is_dir is None else int(is_dir))):
+            if value is not None:
+                query += " AND " + condition
+                parameters.append(value)
+        query += " ORDER BY path"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        with self._lock:
+            self._flush()
+            rows = self._connect().execute(query, parameters).fetchall()
+        return [IndexEntry(path, bool(is_dir), size, mtime) for path, is_dir, size, mtime in rows]
@@ -0,0 +1,119 @@
+"""
+This program caches the responses of the commands
+which only read data, so that polling the same file
+or folder again does not read it again.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache():
+    """
+    Process-wide LRU cache of the responses of read_file and list, shared
+    by every connection.
+    --------
+    The keys are built by the commands from what the response depends on:
+    the path, the inode, modification time and size of the file and the
+    window read for read_file, the version of the directory listing and
+    the options for list. A change of the data gives another key, so the
+    entries are never invalidated and the old ones are evicted by the LRU.
+    --------
+    At most max_bytes bytes of responses are kept. Responses bigger than
+    an eighth of it are not cached, so one big listing cannot evict all the
+    others. A max_bytes of 0 disables the cache.
+    ========
+    Methods:
+    --------
+    get() / put(): Return the response cached for a key, cache a response.
+    --------
+    fits(): Tells if a response of some size can be cached.
+    --------
+    stats(): Returns the number of hits and misses and the size of the cache.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.responses = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the cache of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def get(self, key):
+        """
+        Returns the response cached for the key, or None.
+        """
+        if not self.max_bytes:
+            return None
+        with self._lock:
+            cached = self.responses.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self.responses.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+
+    def fits(self, size):
+        """
+        Returns True if a response of size bytes can be cached.
+        """
+        return size * 8 <= self.max_bytes
+
+    def put(self, key, response, size=None):
+        """
+        Caches the response for the key. size is the number of bytes it
+        takes, by default its length.
+        """
+        if size is None:
+            size = len(response)
+        if not self.fits(size):
+            return
+        with self._lock:
+            previous = self.responses.pop(key, None)
+            if previous is not None:
+                self.cached_bytes -= previous[1]
+            self.responses[key] = (response, size)
+            self.cached_bytes += size
+            while self.cached_bytes > self.max_bytes:
+                self.cached_bytes -= self.responses.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Forgets every response.
+        """
+        with self._lock:
+            self.responses.clear()
+            self.cached_bytes = 0
+
+    def stats(self):
+        """
+        Returns the hits, misses and evictions and the size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.responses),
+                "bytes": self.cached_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,257 @@
+"""
+This program keeps the login sessions of the
+server process in memory, or in a SQLite database
+shared by the worker processes of the server.
+"""
+
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+Session = namedtuple("Session", ["token", "user_id", "created"])
+
+
+class SessionManager():
+    """
+    Table of the login sessions shared by every connection of the process.
+    Every connection which logs in gets its own session token, so the same
+    user can be logged in through several connections.
+    --------
+    self.sessions : Dictionary of the Session of every token
+    --------
+    self.last_active : Dictionary of the last time every token was used
+    --------
+    self.users : Dictionary of the set of tokens of every logged in user
+    --------
+    self.idle_timeout : Seconds after which an unused session is evicted,
+                        None to keep sessions until logout
+    ========
+    Methods:
+    --------
+    login() / logout(): Open and close a session, in constant time.
+    --------
+    touch(): Marks a session as used and tells if it is still open.
+    --------
+    evict_idle(): Closes the sessions unused for more than idle_timeout.
+    --------
+    snapshot(): Writes the open sessions to a csv file.
+    """
+
+    SNAPSHOT_HEADING = "username,token,last_active\n"
+    clock = staticmethod(time.monotonic)
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.last_active = {}
+        self._user_tokens = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the session manager of this process, creating it on first use.
+        """
+        with cls._shared_lock:
+            if SessionManager._shared is None:
+                SessionManager._shared = SessionManager()
+            return SessionManager._shared
+
+    @classmethod
+    def set_shared(cls, manager):
+        """
+        Makes every connection of this process use the given session manager,
+        e.g. a SqliteSessionManager in the worker processes.
+        """
+        with cls._shared_lock:
+            SessionManager._shared = manager
+
+    def login(self, user_id):
+        """
+        Opens a session for the user and returns its token.
+        """
+        token = secrets.token_hex(16)
+        now = self.clock()
+        with self._lock:
+            self.sessions[token] = Session(token, user_id, time.time())
+            self.last_active[token] = now
+            self._user_tokens.setdefault(user_id, set()).add(token)
+        return token
+
+    def logout(self, token):
+        """
+        Closes the session of the token. Returns False if it was not open.
+        """
+        with self._lock:
+            return self._close(token)
+
+    def _close(self, token):
+        session = self.sessions.pop(token, None)
+        if session is None:
+            return False
+        self.last_active.pop(token, None)
+        tokens = self._user_tokens.get(session.user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._user_tokens[session.user_id]
+        return True
+
+    def touch(self, token):
+        """
+        Marks the session as used now. Returns False if the session is not open,
+        for example because it was evicted.
+        """
+        with self._lock:
+            if token not in self.sessions:
+                return False
+            self.last_active[token] = self.clock()
+            return True
+
+    def is_logged_in(self, user_id):
+        """
+        Returns True if the user has a session open through any connection.
+        """
+        return user_id in self._user_tokens
+
+    @property
+    def users(self):
+        """
+        Dictionary of the set of tokens of every logged in user.
+        """
+        return self._user_tokens
+
+    def evict_idle(self, now=None):
+        """
+        Closes the sessions unused for more than idle_timeout seconds and
+        returns how many were closed. now is a time of clock().
+        """
+        if self.idle_timeout is None:
+            return 0
+        now = self.clock() if now is None else now
+        with self._lock:
+            idle = [token for token, last_active in self.last_active.items()
+                    if now - last_active > self.idle_timeout]
+            for token in idle:
+                self._close(token)
+        return len(idle)
+
+    def _snapshot_rows(self):
+        now_clock = self.clock()
+        now = time.time()
+        with self._lock:
+            return [(session.user_id, token, now - (now_clock - self.last_active[token]))
+                    for token, session in self.sessions.items()]
+
+    def snapshot(self, path):
+        """
+        Writes the open sessions to a csv file. The file is replaced
+        atomically, so readers never see a partly written file.
+        """
+        rows = self._snapshot_rows()
+        folder = os.path.dirname(path) or "."
+        os.makedirs(folder, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix=".sessions-")
+        with os.fdopen(descriptor, "w") as writer:
+            writer.write(SessionManager.SNAPSHOT_HEADING)
+            for user_id, token, last_active in rows:
+                writer.write(user_id + "," + token + "," + str(int(last_active)) + "\n")
+        os.replace(temp_path, path)
+
+
+class SqliteSessionManager(SessionManager):
+    """
+    Session table kept in a SQLite database, so that the worker processes
+    of the server see the same sessions. Every process opens its own
+    connection to the database.
+    --------
+    touch() writes the time of use of a session at most once every
+    TOUCH_INTERVAL seconds, so most commands only read the database.
+    """
+
+    TOUCH_INTERVAL = 1.0
+    clock = staticmethod(time.time)
+
+    def __init__(self, database, idle_timeout=None):
+        super().__init__(idle_timeout)
+        self.database = database
+        folder = os.path.dirname(database)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(database, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        with self._lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, "
+                                    "user_id TEXT NOT NULL, created REAL NOT NULL, last_active REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user_id)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)")
+
+    def clear(self):
+        """
+        Closes every session, e.g. those left in the database by a previous
+        run of the server, and returns how many were closed.
+        """
+        with self._lock:
+            self.last_active.clear()
+        return self._execute("DELETE FROM sessions").rowcount
+
+    def _execute(self, statement, parameters=()):
+        with self._lock:
+            return self.connection.execute(statement, parameters)
+
+    def login(self, user_id):
+        token = secrets.token_hex(16)
+        now = self.clock()
+        self._execute("INSERT INTO sessions VALUES (?, ?, ?, ?)", (token, user_id, now, now))
+        with self._lock:
+            self.last_active[token] = now
+        return token
+
+    def logout(self, token):
+        with self._lock:
+            self.last_active.pop(token, None)
+        return self._execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount > 0
+
+    def touch(self, token):
+        now = self.clock()
+        with self._lock:
+            written = self.last_active.get(token)
+        if written is not None and now - written < SqliteSessionManager.TOUCH_INTERVAL:
+            return True
+        alive = self._execute("UPDATE sessions SET last_active = ? WHERE token = ?", (now, token)).rowcount > 0
+        with self._lock:
+            if alive:
+                self.last_active[token] = now
+            else:
+                self.last_active.pop(token, None)
+        return alive
+
+    def is_logged_in(self, user_id):
+        return self._execute("SELECT 1 FROM sessions WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    @property
+    def users(self):
+        """
+        Dictionary of the set of tokens of every logged in user,
+        read from the database.
+        """
+        users = {}
+        for token, user_id in self._execute("SELECT token, user_id FROM sessions").fetchall():
+            users.setdefault(user_id, set()).add(token)
+        return users
+
+    def evict_idle(self, now=None):
+        if self.idle_timeout is None:
+            return 0
+        now = self.clock() if now is None else now
+        return self._execute("DELETE FROM sessions WHERE last_active < ?", (now - self.idle_timeout,)).rowcount
+
+    def _snapshot_rows(self):
+        return self._execute("SELECT user_id, token, last_active FROM sessions").fetchall()
@@ -0,0 +1,145 @@
+"""
+This program keeps the registered users in memory
+so that the commands do not have to parse the csv
+file on every request.
+"""
+
+import csv
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class UserRegistry():
+    """
+    Process-wide registry of the registered users.
+    One registry is shared by every connection of the server.
+    --------
+    self.registered : Dictionary mapping each registered username to its password
+    ========
+    Methods:
+    --------
+    shared(): Returns the registry shared by the whole process for the given file.
+    --------
+    refresh(): Reloads the csv file only when its modification time or size changed
+              since it was last read, so external edits are picked up.
+    --------
+    add_user(): Registers a user by appending a single line to the csv file.
+    --------
+    The csv file is locked while it is read or appended to, so that the worker
+    processes of the server can share it.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, registered_file, heading):
+        """
+        The parameters include :
+        ------
+        registered_file : Path of the csv file with the registered users
+        ------
+        heading : Heading written to a newly created csv file
+        """
+        self.registered_file = registered_file
+        self.heading = heading
+        self.registered = {}
+        self._signature_on_disk = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, registered_file, heading):
+        """
+        Returns the registry of this process for the given file,
+        creating it on first use.
+        """
+        key = os.path.abspath(registered_file)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(registered_file, heading)
+            return cls._instances[key]
+
+    @staticmethod
+    def _signature(path):
+        """
+        Returns what identifies the current version of a file on disk.
+        """
+        status = os.stat(path)
+        return (status.st_ino, status.st_mtime_ns, status.st_size)
+
+    def _ensure_file(self, path):
+        """
+        Creates the folder and the csv file with its heading if they are missing.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        if not os.path.isfile(path):
+            try:
+                with open(path, "x") as writer:
+                    writer.write(self.heading)
+            except FileExistsError:
+                pass
+
+    @staticmethod
+    def _load(path, lock=True):
+        """
+        Reads a csv file into a dictionary of username to password. Unless the
+        caller already holds the lock, the file is locked while it is read,
+        where fcntl is available.
+        Blank lines are skipped and a missing password is read as "".
+        """
+        with open(path, newline="") as reader:
+            if lock and fcntl is not None:
+                fcntl.flock(reader, fcntl.LOCK_SH)
+            return {row["username"]: row["password"] for row in csv.DictReader(reader, restval="")}
+
+    def refresh(self):
+        """
+        Makes sure the csv file exists and reloads it only if it
+        changed on disk since the last time it was read.
+        """
+        with self._lock:
+            self._ensure_file(self.registered_file)
+            signature = self._signature(self.registered_file)
+            if self._signature_on_disk != signature:
+                self.registered = self._load(self.registered_file)
+                self._signature_on_disk = signature
+
+    def is_registered(self, user_id):
+        """
+        Returns True if the username is registered.
+        """
+        return user_id in self.registered
+
+    def password_matches(self, user_id, password):
+        """
+        Returns True if the password is the one registered for the username.
+        """
+        return self.registered.get(user_id) == password
+
+    def add_user(self, user_id, password):
+        """
+        Registers a new user by appending it to the csv file.
+        Returns False if the username is taken.
+        """
+        with self._lock:
+            self._ensure_file(self.registered_file)
+            with open(self.registered_file, "a") as writer:
+                if fcntl is not None:
+                    fcntl.flock(writer, fcntl.LOCK_EX)
+                signature = self._signature(self.registered_file)
+                if self._signature_on_disk != signature:
+                    self.registered = self._load(self.registered_file, lock=False)
+                if user_id in self.registered:
+                    self._signature_on_disk = signature
+                    return False
+                writer.write(user_id + "," + password + "\n")
+                writer.flush()
+                self._signature_on_disk = self._signature(self.registered_file)
+            self.registered[user_id] = password
+            return True
@@ -0,0 +1,344 @@
+"""
+This program keeps the files appended to by write_file
+open, and buffers the appends in memory depending on
+the durability mode of the server.
+"""
+
+import atexit
+import contextlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DURABILITY_MODES = ("buffered", "write", "fsync")
+
+
+class AppendHandle():
+    """
+    One file open for appending.
+    --------
+    self.size : Size of the file once every append is written
+    --------
+    self.pending : Appends not written yet, in the buffered mode
+    --------
+    self.written / self.synced : Number of appends written to the file and
+                                 number of appends known to be on the disk
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.descriptor = None
+        self.identity = None
+        self.size = 0
+        self._open()
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.written = 0
+        self.synced = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    def _open(self):
+        if self.descriptor is not None:
+            os.close(self.descriptor)
+        self.descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        status = os.fstat(self.descriptor)
+        self.identity = (status.st_dev, status.st_ino)
+        self.size = status.st_size
+
+    def write_pending(self):
+        """
+        Writes the buffered appends to the file. The lock must be held.
+        --------
+        The file is opened again when it was removed or replaced since it
+        was opened, so the appends never go to a file which is gone. The
+        size is taken from the file, which other processes may append to.
+        """
+        if not self.pending:
+            return
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            status = None
+        if status is None or (status.st_dev, status.st_ino) != self.identity:
+            self._open()
+        else:
+            self.size = status.st_size
+        self.size += self.pending_bytes
+        data = memoryview(b"".join(self.pending))
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        while data:
+            data = data[os.write(self.descriptor, data):]
+
+
+class WriteBehind():
+    """
+    Process-wide table of the files open for appending, shared by every
+    connection, so that the appends of all the connections to a file go
+    through one descriptor instead of opening and closing the file each time.
+    --------
+    self.durability : "write" writes every append to the file before
+                      write_file answers, which is what it always did.
+                      "buffered" keeps the appends in memory until a file
+                      has max_buffer bytes pending or its oldest append is
+                      max_delay seconds old; they are lost if the process
+                      dies. "fsync" also waits for the append to reach the
+                      disk; concurrent appends to a file share one fsync.
+    --------
+    self.handles : LRU of the AppendHandle of every open file, by absolute
+                   path, holding at most max_files descriptors
+    ========
+    Methods:
+    --------
+    append(): Appends data to a file and returns its new size.
+    --------
+    flush() / flush_directory(): Write the buffered appends to the files.
+    --------
+    sync(): Writes the buffered appends of a file and fsyncs it.
+    --------
+    exclusive(): Holds back the appends to a file while it is replaced.
+    --------
+    close() / close_tree(): Flush and close a file, the files of a folder,
+                            before they are replaced or removed.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, durability="write", max_files=128, max_buffer=64 * 1024, max_delay=0.2):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("durability should be one of " + ", ".join(DURABILITY_MODES))
+        self.durability = durability
+        self.max_files = max_files
+        self.max_buffer = max_buffer
+        self.max_delay = max_delay
+        self.handles = OrderedDict()
+        self.flusher = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the write-behind table of this process, creating it on first use.
+        Its files are flushed and closed when the process exits.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                atexit.register(cls._shared.close_all)
+            return cls._shared
+
+    def _handle(self, path):
+        evicted = []
+        with self._lock:
+            handle = self.handles.get(path)
+            if handle is not None:
+                self.handles.move_to_end(path)
+                return handle
+            handle = self.handles[path] = AppendHandle(path)
+            while len(self.handles) > self.max_files:
+                evicted.append(self.handles.popitem(last=False)[1])
+        for old in evicted:
+            self._close(old)
+        return handle
+
+    def append(self, path, data):
+        """
+        Appends the bytes to the file, creating it if needed, and returns
+        the size of the file once the append is written.
+        """
+        path = os.path.abspath(path)
+        while True:
+            handle = self._handle(path)
+            with handle.lock:
+                if handle.closed:
+                    continue
+                handle.pending.append(data)
+                handle.pending_bytes += len(data)
+                handle.size += len(data)
+                if self.durability != "buffered":
+                    handle.write_pending()
+                elif handle.pending_bytes >= self.max_buffer:
+                    handle.write_pending()
+                elif handle.pending_since is None:
+                    handle.pending_since = time.monotonic()
+                size = handle.size
+                handle.written += 1
+                sequence = handle.written
+            break
+        if self.durability == "buffered":
+            self._start_flusher()
+        elif self.durability == "fsync":
+            self._sync(handle, sequence)
+        return size
+
+    def _sync(self, handle, sequence):
+        """
+        Fsyncs the file unless another thread already did after the
+        append number sequence was written.
+        --------
+        The fsync goes through a duplicate of the descriptor, taken under the
+        lock of the handle, so the appends go on meanwhile and a handle closed
+        by the LRU during the fsync does not take the descriptor away. A
+        closed handle was fsynced by its close.
+        """
+        with handle.sync_lock:
+            if handle.synced >= sequence:
+                return
+            with handle.lock:
+                if handle.closed:
+                    return
+                written = handle.written
+                descriptor = os.dup(handle.descriptor)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            handle.synced = written
+
+    def flush(self, path=None):
+        """
+        Writes the buffered appends of the file, or of every file, to the files.
+        """
+        with self._lock:
+            if path is None:
+                handles = list(self.handles.values())
+            else:
+                handle = self.handles.get(os.path.abspath(path))
+                handles = [] if handle is None else [handle]
+        for handle in handles:
+            with handle.lock:
+                if not handle.closed:
+                    handle.write_pending()
+
+    def flush_directory(self, directory):
+        """
+        Writes the buffered appends of the files of the directory.
+        """
+        if self.durability != "buffered":
+            return
+        directory = os.path.abspath(directory)
+        with self._lock:
+            paths = [path for path in self.handles if os.path.dirname(path) == directory]
+        for path in paths:
+            self.flush(path)
+
+    def sync(self, path=None):
+        """
+        Writes the buffered appends of the file, or of every file, and waits
+        until they are on the disk.
+        """
+        self.flush(path)
+        with self._lock:
+            if path is None:
+                handles = list(self.handles.values())
+            else:
+                handle = self.handles.get(os.path.abspath(path))
+                handles = [] if handle is None else [handle]
+        for handle in handles:
+            with handle.lock:
+                written = handle.written
+            self._sync(handle, written)
+
+    @contextlib.contextmanager
+    def exclusive(self, path):
+        """
+        Writes the buffered appends of the file and holds back the next
+        appends of this process while the block runs, so that the file
+        can be replaced without losing an append. Only the lock of the
+        file is held while the block runs, and a handle closed before it is
+        taken is looked up again.
+        """
+        path = os.path.abspath(path)
+        while True:
+            with self._lock:
+                handle = self.handles.get(path)
+            if handle is None:
+                yield
+                return
+            with handle.lock:
+                if handle.closed:
+                    continue
+                handle.write_pending()
+                yield
+                return
+
+    def close(self, path):
+        """
+        Flushes and closes the file, so that it can be replaced or removed.
+        """
+        with self._lock:
+            handle = self.handles.pop(os.path.abspath(path), None)
+        if handle is not None:
+            self._close(handle)
+
+    def close_tree(self, path):
+        """
+        Flushes and closes the file, or the files under the folder, so that
+        they can be copied, moved or removed.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            handles = [self.handles.pop(key) for key in list(self.handles)
+                       if key == path or key.startswith(path + os.sep)]
+        for handle in handles:
+            self._close(handle)
+
+    def close_all(self):
+        """
+        Flushes and closes every file.
+        """
+        with self._lock:
+            handles = list(self.handles.values())
+            self.handles.clear()
+        for handle in handles:
+            self._close(handle)
+
+    def _close(self, handle):
+        with handle.lock:
+            if handle.closed:
+                return
+            try:
+                handle.write_pending()
+                if self.durability == "fsync":
+                    os.fsync(handle.descriptor)
+            finally:
+                handle.closed = True
+                os.close(handle.descriptor)
+
+    def _start_flusher(self):
+        with self._lock:
+            if self.flusher is not None and self.flusher.is_alive():
+                return
+            self.flusher = threading.Thread(target=self._flush_expired, name="write-behind", daemon=True)
+            self.flusher.start()
+
+    def _flush_expired(self):
+        """
+        Writes the appends buffered for more than max_delay seconds, until
+        nothing is buffered any more.
+        """
+        while True:
+            time.sleep(self.max_delay / 2)
+            now = time.monotonic()
+            with self._lock:
+                handles = list(self.handles.values())
+            waiting = False
+            for handle in handles:
+                with handle.lock:
+                    if handle.closed or handle.pending_since is None:
+                        continue
+                    if now - handle.pending_since >= self.max_delay:
+                        handle.write_pending()
+                    else:
+                        waiting = True
+            if not waiting:
+                with self._lock:
+                    if not any(handle.pending for handle in self.handles.values()):
+                        self.flusher = None
+                        return
@@ -0,0 +1,350 @@
+'''
+This file benchmarks the server and the command handler
+--------
+The load test starts server.py on a free port in a temporary folder and
+drives it with many concurrent clients using the framed protocol. It
+reports the latency percentiles and throughput of every command and the
+memory of the server.
+--------
+The microbenchmarks time every CommandHandler method against a synthetic
+folder with a given number of entries.
+--------
+The startup benchmark times the import of server.py in fresh interpreters
+and measures their memory, which every worker process and every run of
+test.py pays, and checks them against STARTUP_LIMITS. The script exits
+with status 1 when one of them is exceeded.
+--------
+Usage: python benchmark.py [--clients 50] [--operations 200] [--sizes 1000,10000]
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MIX = {"list": 4, "write_file": 3, "read_file": 3}
+STARTUP_LIMITS = {"import_ms": 1000, "peak_kb": 48 * 1024}
+HEAVY_MODULES = ("pandas", "numpy")
+STARTUP_SCRIPT = '''
+import json, os, resource, sys, time
+start = time.perf_counter()
+import server
+elapsed = (time.perf_counter() - start) * 1000
+import benchmark
+memory = benchmark.memory_of(os.getpid())
+print(json.dumps({
+    "import_ms": elapsed,
+    "peak_kb": memory[1] if memory else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "heavy_modules": [name for name in %r if name in sys.modules],
+}))
+'''
+
+
+def percentile(samples, fraction):
+    '''
+    This function returns the value below which the given
+    fraction of the sorted samples fall
+    '''
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def memory_of(pid):
+    '''
+    This function returns the resident and peak memory of a process in
+    kilobytes, read from /proc, or None where /proc is not available
+    '''
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def report(title, latencies, elapsed):
+    '''
+    This function prints the latency percentiles and throughput of every command
+    '''
+    print(f"\n{title}")
+    print(f"{'command':<16}{'count':>8}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    total = 0
+    for command, samples in sorted(latencies.items()):
+        total += len(samples)
+        print(f"{command:<16}{len(samples):>8}{len(samples) / elapsed:>12.1f}"
+              f"{percentile(samples, 0.5) * 1000:>10.2f}{percentile(samples, 0.99) * 1000:>10.2f}"
+              f"{max(samples) * 1000:>10.2f}")
+    print(f"{'all':<16}{total:>8}{total / elapsed:>12.1f}")
+
+
+class ServerProcess():
+    '''
+    This class runs server.py in a temporary folder on a free port,
+    so that the benchmark leaves no state behind
+    '''
+
+    def __init__(self, arguments=()):
+        self.arguments = list(arguments)
+        self.folder = None
+        self.process = None
+        self.port = None
+
+    def __enter__(self):
+        self.folder = tempfile.mkdtemp(prefix="fms-benchmark-")
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"), "--port", "0"]
+                                        + self.arguments, cwd=self.folder,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        first_line = self.process.stdout.readline()
+        self.port = int(first_line.split(", ")[1].split(")")[0])
+        threading.Thread(target=self.process.stdout.read, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait(10)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+async def load_client(port, number, operations, mix, latencies):
+    '''
+    This function logs in and runs a random mix of commands, recording
+    the latency of every command
+    '''
+    connection = await client.FramedClient.connect('127.0.0.1', port)
+    commands = list(mix)
+    weights = [mix[command] for command in commands]
+    randomizer = random.Random(number)
+    payload = "x" * 512
+
+    async def timed(name, command):
+        start = time.perf_counter()
+        await connection.request(command)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    await timed("login", "login bench benchpassword")
+    for _ in range(operations):
+        name = randomizer.choices(commands, weights)[0]
+        if name == "list":
+            await timed(name, "list --limit 100")
+        elif name == "write_file":
+            await timed(name, f"write_file client{number}.log {payload}")
+        elif name == "read_file":
+            await timed(name, "read_file large.txt 4096")
+    await timed("quit", "quit")
+    await connection.close()
+
+
+async def open_idle_connections(port, count):
+    '''
+    This function opens count connections which never send anything
+    '''
+    writers = []
+    for _ in range(count):
+        writers.append((await asyncio.open_connection('127.0.0.1', port))[1])
+    return writers
+
+
+def make_large_file(file_size):
+    '''
+    This function writes a temporary file of exactly file_size bytes of
+    text and returns its path
+    '''
+    with tempfile.NamedTemporaryFile("wb", delete=False) as large:
+        block = os.urandom(1024 * 1024).hex().encode()[:1024 * 1024]
+        written = 0
+        while written < file_size:
+            written += large.write(block[:file_size - written])
+    return large.name
+
+
+async def load_test(port, clients, operations, mix, file_size, idle_connections=0):
+    '''
+    This function prepares the user and the large file and runs the clients
+    concurrently, while idle_connections other clients stay connected
+    '''
+    idle = await open_idle_connections(port, idle_connections)
+    setup = await client.FramedClient.connect('127.0.0.1', port)
+    await setup.pipeline(["register bench benchpassword", "login bench benchpassword"])
+    large = make_large_file(file_size)
+    try:
+        await setup.upload(large, "large.txt")
+    finally:
+        os.remove(large)
+    await setup.request("quit")
+    await setup.close()
+    latencies = {}
+    start = time.perf_counter()
+    await asyncio.gather(*[load_client(port, number, operations, mix, latencies)
+                           for number in range(clients)])
+    elapsed = time.perf_counter() - start
+    for writer in idle:
+        writer.close()
+    return latencies, elapsed
+
+
+def run_load_test(clients=50, operations=200, mix=None, file_size=64 * 1024 * 1024, server_arguments=(),
+                  idle_connections=0):
+    '''
+    This function runs the load test against a new server and prints the report
+    '''
+    with ServerProcess(server_arguments) as server:
+        latencies, elapsed = asyncio.run(load_test(server.port, clients, operations,
+                                                   mix or DEFAULT_MIX, file_size, idle_connections))
+        memory = memory_of(server.process.pid)
+    title = f"Load test: {clients} clients x {operations} commands in {elapsed:.2f} s"
+    if idle_connections:
+        title += f", {idle_connections} idle connections"
+    report(title, latencies, elapsed)
+    if memory is not None:
+        print(f"Server memory: {memory[0]} kB resident, {memory[1]} kB peak")
+    print(f"Client peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} kB")
+    return latencies, elapsed
+
+
+def run_startup_benchmark(runs=5):
+    '''
+    This function imports server.py in runs fresh interpreters and
+    returns the median import time, the median peak memory, the
+    heavy modules which were imported and the names of the
+    STARTUP_LIMITS which the medians exceed
+    --------
+    The peak memory is read from /proc, because ru_maxrss keeps the peak
+    of the process before it executed the interpreter
+    '''
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT % (HEAVY_MODULES,)], cwd=HERE,
+                                check=True, capture_output=True, text=True).stdout
+        samples.append(json.loads(output))
+    result = {
+        "import_ms": percentile([sample["import_ms"] for sample in samples], 0.5),
+        "peak_kb": percentile([sample["peak_kb"] for sample in samples], 0.5),
+        "heavy_modules": sorted(set().union(*(sample["heavy_modules"] for sample in samples))),
+    }
+    result["exceeded"] = [name for name, limit in STARTUP_LIMITS.items() if result[name] >= limit]
+    print(f"\nStartup (median of {runs} imports of server.py)")
+    print(f"Import: {result['import_ms']:.1f} ms (limit {STARTUP_LIMITS['import_ms']} ms)")
+    print(f"Peak memory: {result['peak_kb']} kB (limit {STARTUP_LIMITS['peak_kb']} kB)")
+    print("Heavy modules imported: " + (", ".join(result["heavy_modules"]) or "none"))
+    print("Over the limits: " + (", ".join(result["exceeded"]) or "none"))
+    return result
+
+
+def build_tree(folder, entries):
+    '''
+    This function fills a folder with the given number of small files
+    and one sub folder, and dates the folder in the past so that its
+    listing can be cached
+    '''
+    os.makedirs(os.path.join(folder, "sub"), exist_ok=True)
+    for number in range(entries - 1):
+        with open(os.path.join(folder, f"file{number:07d}.txt"), "w") as file:
+            file.write("benchmark data\n")
+    past = time.time() - 60
+    os.utime(folder, (past, past))
+
+
+def time_call(function, repeat):
+    '''
+    This function returns the time of the first call and the median
+    time of the next calls of the function
+    '''
+    samples = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples[0], percentile(samples[1:], 0.5)
+
+
+def run_microbenchmarks(sizes=(1000, 10000), repeat=5):
+    '''
+    This function times the CommandHandler methods for folders of every size
+    --------
+    The records buffered by the path index and the disk usage are written
+    before the temporary folder is left, so they do not land in the
+    working directory
+    '''
+    from CommandHandler import CommandHandler
+    working_directory = os.getcwd()
+    folder = tempfile.mkdtemp(prefix="fms-micro-")
+    results = {}
+    try:
+        os.chdir(folder)
+        handler = CommandHandler()
+        handler.register("micro", "micropassword")
+        handler.login("micro", "micropassword")
+        for size in sizes:
+            tree = os.path.join(CommandHandler.ROOT_DIR, "micro", f"tree{size}")
+            build_tree(tree, size)
+            handler.current_directory = tree
+            handler.write_file("file0000000.txt", "")
+            past = time.time() - 60
+            os.utime(tree, (past, past))
+            counter = iter(range(10 ** 9))
+            calls = {
+                "access_user_info": handler.access_user_info,
+                "list": handler.list,
+                "list --limit 100": lambda: handler.list(limit=100, sort="name"),
+                "read_file": lambda: handler.read_file("file0000000.txt"),
+                "change_folder": lambda: (handler.change_folder("sub"), handler.change_folder("..")),
+                "write_file": lambda: handler.write_file("file0000000.txt", "appended data\n"),
+                "create_folder": lambda: handler.create_folder(f"folder{next(counter)}"),
+            }
+            results[size] = {name: time_call(function, repeat) for name, function in calls.items()}
+        handler.quit()
+        handler.path_index.flush()
+        handler.disk_usage.flush()
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(folder, ignore_errors=True)
+    print("\nMicrobenchmarks (first call / median of next calls, ms)")
+    print(f"{'method':<20}" + "".join(f"{size:>22}" for size in sizes))
+    for name in results[sizes[0]]:
+        cells = "".join(f"{results[size][name][0] * 1000:>11.3f}{results[size][name][1] * 1000:>11.3f}"
+                        for size in sizes)
+        print(f"{name:<20}{cells}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the file management server")
+    parser.add_argument("--clients", type=int, default=50, help="number of concurrent clients")
+    parser.add_argument("--operations", type=int, default=200, help="commands sent by every client")
+    parser.add_argument("--file-size", type=int, default=64 * 1024 * 1024,
+                        help="size in bytes of the large file read by the clients")
+    parser.add_argument("--mix", default="list=4,write_file=3,read_file=3",
+                        help="weights of the commands sent by the clients")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma separated entry counts of the microbenchmark folders, up to 1000000")
+    parser.add_argument("--repeat", type=int, default=5, help="calls of every method in the microbenchmarks")
+    parser.add_argument("--idle-connections", type=int, default=0,
+                        help="connections kept open without sending anything during the load test")
+    parser.add_argument("--server-args", default="", help="extra arguments of server.py, e.g. '--workers 4'")
+    parser.add_argument("--skip-load", action="store_true", help="only run the microbenchmarks")
+    parser.add_argument("--skip-micro", action="store_true", help="only run the load test")
+    parser.add_argument("--skip-startup", action="store_true", help="do not run the startup benchmark")
+    args = parser.parse_args()
+    exceeded = []
+    if not args.skip_startup:
+        exceeded = run_startup_benchmark()["exceeded"]
+    if not args.skip_load:
+        mix = {name: int(weight) for name, weight in (item.split("=") for item in args.mix.split(","))}
+        run_load_test(args.clients, args.operations, mix, args.file_size, args.server_args.split(),
+                      args.idle_connections)
+    if not args.skip_micro:
+        run_microbenchmarks(tuple(int(size) for size in args.sizes.split(",")), args.repeat)
+    if exceeded:
+        sys.exit(1)
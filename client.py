@@ -1,32 +1,634 @@
-'''
-This file is the client program using async I/O
---------
-After the connection has been established the
-user commands are executed as per the CommandHandler class
---------
-The connection is closed based on the user request
-'''
-import asyncio
-
-async def tcp_client():
-    '''
-    This function establishes the TCP connection between the server and the client
-    '''
-    reader, writer = await asyncio.open_connection(
-        '127.0.0.1', 8088)
-    message = ''
-    while True:
-        message = input("$")
-        if message == "":
-            print("$")
-            continue
-
-        writer.write(message.encode())
-        data = await reader.read(4096)
-        print(f"{data.decode()}")
-        if message.lower() == "quit":
-            break
-    print('Close the connection')
-    writer.close()
-
-asyncio.run(tcp_client())
+'''
+This file is the client program using async I/O
+--------
+After the connection has been established the
+user commands are executed as per the CommandHandler class
+--------
+The connection is closed based on the user request
+--------
+With --framed the client uses the framed protocol, which also
+lets a script of commands be sent without waiting for each response
+--------
+Programs import FramedClient, which has a method for every command,
+and ClientPool, which spreads their operations over many connections
+logged in as the same user
+'''
+import argparse
+import asyncio
+import codecs
+import contextlib
+import functools
+import itertools
+import json
+import os
+import tempfile
+import protocol
+
+DOWNLOAD_QUEUE = 16
+READ_ONLY_COMMANDS = ("commands", "list", "read_file", "find", "search", "usage", "jobs")
+LOGGED_IN = ("Logged into the system successfully!", "\nUser logged through another port")
+
+
+class ClientError(Exception):
+    '''
+    Raised with the response of the server when it refuses what
+    the client needs, like the login of a pooled connection
+    '''
+
+
+class FramedClient():
+    '''
+    This class sends commands over the framed protocol
+    --------
+    Every command gets its own request id, so many commands can be
+    sent before the first response arrives. The responses are matched
+    to the commands by their request id.
+    --------
+    Uploads and downloads stream the file in chunks and keep the
+    memory constant. Only one upload is sent at a time on a connection.
+    --------
+    self.timeout : Seconds to wait for a response or for the next chunk
+                   of a download, None to wait for ever. asyncio.TimeoutError
+                   is raised when it passes.
+    --------
+    self.folder : Names of the folders the connection is in, from the
+                  folder of the user, kept by ClientPool
+    --------
+    Every command of the CommandHandler class has a method of its own,
+    which builds the command line and returns the response of the server.
+    '''
+
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.folder = []
+        self.frames = protocol.FrameReader(reader)
+        self.messages = protocol.MessageAssembler()
+        self.request_ids = itertools.count(1)
+        self.waiting = {}
+        self.streams = {}
+        self.uploading = asyncio.Lock()
+        self.receiving = None
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8088, timeout=None):
+        '''
+        This function opens a connection and negotiates the framed protocol,
+        in at most timeout seconds
+        '''
+        return await asyncio.wait_for(cls._connect(host, port, timeout), timeout)
+
+    @classmethod
+    async def _connect(cls, host, port, timeout):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(protocol.HANDSHAKE)
+            await writer.drain()
+            answer = await reader.readexactly(len(protocol.HANDSHAKE_ACK))
+            if answer != protocol.HANDSHAKE_ACK:
+                answer += await reader.read(4096)
+                raise protocol.ProtocolError("Server did not accept the framed protocol: "
+                                             + answer.decode(errors="replace").strip())
+        except BaseException:
+            writer.close()
+            raise
+        client = cls(reader, writer, timeout)
+        client.receiving = asyncio.ensure_future(client._receive())
+        return client
+
+    async def _receive(self):
+        while True:
+            frame = await self.frames.read_frame()
+            if frame is None:
+                break
+            request_id, flags, payload = frame
+            stream = self.streams.get(request_id)
+            if stream is not None:
+                if not flags & protocol.FLAG_MORE:
+                    del self.streams[request_id]
+                await stream.put((flags, payload))
+                continue
+            payload = self.messages.add(request_id, flags, payload)
+            if payload is None:
+                continue
+            future = self.waiting.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result(payload.decode())
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed by the server"))
+        self.waiting.clear()
+        for stream in self.streams.values():
+            await stream.put(None)
+        self.streams.clear()
+
+    def _check_open(self):
+        if self.receiving is not None and self.receiving.done():
+            raise ConnectionError("Connection closed by the server")
+
+    def _send(self, command):
+        self._check_open()
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        self.writer.write(protocol.encode_message(request_id, command.encode()))
+        return request_id, future
+
+    def _send_streamed(self, command):
+        self._check_open()
+        request_id = next(self.request_ids)
+        stream = asyncio.Queue(DOWNLOAD_QUEUE)
+        self.streams[request_id] = stream
+        self.writer.write(protocol.encode_message(request_id, command.encode()))
+        return stream
+
+    def send(self, command):
+        '''
+        This function sends a command and returns a future
+        for its response, without waiting for it
+        '''
+        return self._send(command)[1]
+
+    async def request(self, command):
+        '''
+        This function sends a command and waits for its response
+        '''
+        future = self.send(command)
+        await self.writer.drain()
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def pipeline(self, commands):
+        '''
+        This function sends all the commands at once and
+        returns their responses in the same order
+        '''
+        futures = [self.send(command) for command in commands]
+        await self.writer.drain()
+        return await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+
+    async def batch(self, commands, stop_on_error=False):
+        '''
+        This function runs the commands in one batch and returns the
+        result of every command run as a dictionary with its "command",
+        whether it is "ok" and its "response"
+        '''
+        header = "batch --stop-on-error" if stop_on_error else "batch"
+        response = await self.request("\n".join([header] + list(commands)))
+        return [json.loads(line) for line in response.splitlines() if line]
+
+    async def stream(self, command):
+        '''
+        This function sends a command whose response is streamed, like
+        "list --stream", and yields the parts of the response as they arrive
+        '''
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        stream = self._send_streamed(command)
+        await self.writer.drain()
+        while True:
+            item = await stream.get()
+            if item is None:
+                raise ConnectionError("Connection closed by the server")
+            flags, payload = item
+            text = decoder.decode(payload, final=not flags & protocol.FLAG_MORE)
+            if text:
+                yield text
+            if not flags & protocol.FLAG_MORE:
+                return
+
+    def follow(self, filename, offset=None):
+        '''
+        This function follows a file of the current directory on the server
+        like tail -f, from its end or from offset, and yields the text
+        appended to it as it is written. The first part is the answer of the
+        server and the last one tells why the follow ended, after
+        unfollow(filename) or when the file was removed.
+        '''
+        return self.stream("follow " + filename + ("" if offset is None else " " + str(offset)))
+
+    async def unfollow(self, filename):
+        '''
+        This function stops following a file
+        '''
+        return await self.request("unfollow " + filename)
+
+    async def upload(self, local_path, filename=None):
+        '''
+        This function uploads a local file into the current directory
+        on the server and returns the response of the server
+        '''
+        filename = filename or os.path.basename(local_path)
+        size = os.path.getsize(local_path)
+        async with self.uploading:
+            request_id, future = self._send("upload " + filename + " " + str(size))
+            with open(local_path, "rb") as file:
+                sent = 0
+                while sent < size:
+                    chunk = file.read(min(protocol.FRAME_SIZE, size - sent))
+                    if not chunk:
+                        self.writer.close()
+                        raise OSError(local_path + " became shorter during the upload")
+                    self.writer.write(protocol.encode_frame(request_id, chunk))
+                    await self.writer.drain()
+                    sent += len(chunk)
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def _start_download(self, filename):
+        '''
+        This function sends the download command and returns the queue of its frames
+        with the flags and the payload of the first one
+        '''
+        stream = self._send_streamed("download " + filename)
+        await self.writer.drain()
+        flags, header = await self._next(stream)
+        return stream, flags, header
+
+    async def _next(self, stream):
+        item = await asyncio.wait_for(stream.get(), self.timeout)
+        if item is None:
+            raise ConnectionError("Connection closed during the download")
+        return item
+
+    async def download(self, filename, local_path=None):
+        '''
+        This function downloads a file of the current directory on the
+        server into a temporary file which is renamed to local_path once
+        complete, and returns the response of the server
+        '''
+        local_path = local_path or filename
+        stream, flags, header = await self._start_download(filename)
+        if not flags & protocol.FLAG_MORE:
+            return header.decode()
+        directory = os.path.dirname(os.path.abspath(local_path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".download-")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                while flags & protocol.FLAG_MORE:
+                    flags, chunk = await self._next(stream)
+                    file.write(chunk)
+            os.replace(temp_path, local_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return header.decode()
+
+    async def fetch(self, filename):
+        '''
+        This function downloads a file of the current directory on the
+        server and returns its content as bytes. ClientError is raised
+        with the response of the server when it cannot be downloaded.
+        '''
+        stream, flags, header = await self._start_download(filename)
+        if not flags & protocol.FLAG_MORE:
+            raise ClientError(header.decode().strip())
+        chunks = []
+        while flags & protocol.FLAG_MORE:
+            flags, chunk = await self._next(stream)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    @staticmethod
+    def _options(**options):
+        '''
+        This function turns keyword arguments into the --options of a
+        command, with the dashes in their names, skipping the ones which
+        are None or False
+        '''
+        words = []
+        for name, value in options.items():
+            if value is None or value is False:
+                continue
+            words.append("--" + name.replace("_", "-"))
+            if value is not True:
+                words.append(str(value))
+        return "".join(" " + word for word in words)
+
+    async def commands(self):
+        return await self.request("commands")
+
+    async def register(self, user_id, password):
+        return await self.request("register " + user_id + " " + password)
+
+    async def login(self, user_id, password):
+        return await self.request("login " + user_id + " " + password)
+
+    async def quit(self):
+        return await self.request("quit")
+
+    async def list(self, offset=None, limit=None, sort=None, reverse=False, output=None):
+        '''
+        This function lists the current directory, output is the format
+        of the list: "table", "csv" or "json"
+        '''
+        return await self.request("list" + self._options(offset=offset, limit=limit, sort=sort,
+                                                         reverse=reverse, format=output))
+
+    async def change_folder(self, name):
+        return await self.request("change_folder " + name)
+
+    async def create_folder(self, name):
+        return await self.request("create_folder " + name)
+
+    async def read_file(self, name, count=None):
+        return await self.request("read_file " + name + ("" if count is None else " " + str(count)))
+
+    async def write_file(self, name, data=""):
+        '''
+        This function appends data to a file, which is created when missing
+        '''
+        return await self.request("write_file " + name + (" " + data if data else ""))
+
+    async def find(self, name=None, min_size=None, max_size=None, newer=None, older=None,
+                   kind=None, limit=None, output=None):
+        '''
+        This function finds the files under the current directory, kind is
+        "file" or "dir" and output the format of the result
+        '''
+        return await self.request("find" + self._options(name=name, min_size=min_size, max_size=max_size,
+                                                         newer=newer, older=older, type=kind,
+                                                         limit=limit, format=output))
+
+    async def search(self, text, limit=None, output=None):
+        return await self.request("search " + text + self._options(limit=limit, format=output))
+
+    async def reindex(self):
+        return await self.request("reindex")
+
+    async def usage(self):
+        return await self.request("usage")
+
+    async def delete_folder(self, name):
+        return await self.request("delete_folder " + name)
+
+    async def copy(self, path, destination):
+        return await self.request("copy " + path + " " + destination)
+
+    async def move(self, path, destination):
+        return await self.request("move " + path + " " + destination)
+
+    async def jobs(self, job=None):
+        return await self.request("jobs" + ("" if job is None else " " + str(job)))
+
+    async def cancel(self, job):
+        return await self.request("cancel " + str(job))
+
+    async def flush(self, name=None):
+        return await self.request("flush" + ("" if name is None else " " + name))
+
+    async def fsync(self, name=None):
+        return await self.request("fsync" + ("" if name is None else " " + name))
+
+    async def close(self):
+        self.writer.close()
+        if self.receiving is not None:
+            await asyncio.gather(self.receiving, return_exceptions=True)
+
+
+class ClientPool():
+    '''
+    This class keeps up to size framed connections logged in as one user
+    and runs the operations of a program on them, so that many files are
+    uploaded, downloaded or read at the same time
+    --------
+    The connections are opened on first use and kept open for the next
+    operations. An operation waits while all of them are busy.
+    --------
+    self.timeout : Seconds to wait for a connection or a response, None
+                   to wait for ever
+    --------
+    self.retries / self.retry_delay : How many times an operation whose
+                   connection failed or timed out is run again on a new
+                   connection, and the seconds waited before the first
+                   retry, doubled after each one. Only the operations which
+                   can be repeated are run again: the transfers and the
+                   commands of READ_ONLY_COMMANDS. The others are run again
+                   only when their connection failed before they were sent.
+    --------
+    Every connection has a current directory of its own on the server, so
+    the operations take the folder they work in, from the folder of the
+    user, and the pool moves the connection there first.
+    ========
+    Methods:
+    --------
+    run(): Runs a function of a FramedClient on a connection of the pool.
+    --------
+    request() / write_file(): Run one command.
+    --------
+    upload_many() / download_many() / read_many(): Transfer many files
+                                                   over all the connections.
+    --------
+    close(): Closes the connections.
+    '''
+
+    def __init__(self, user_id, password, host='127.0.0.1', port=8088, size=4, timeout=30,
+                 retries=2, retry_delay=0.1):
+        self.user_id = user_id
+        self.password = password
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle = []
+        self.available = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    async def _open(self):
+        '''
+        This function opens a connection and logs the user in
+        '''
+        client = await FramedClient.connect(self.host, self.port, self.timeout)
+        try:
+            answer = await client.login(self.user_id, self.password)
+            if answer not in LOGGED_IN:
+                raise ClientError(answer.strip())
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        '''
+        This function lends a connection of the pool, opening one when none
+        is idle. A connection given back after any other error than a
+        ClientError is closed, as a transfer may have been left half done.
+        '''
+        if self.available is None:
+            self.available = asyncio.Semaphore(self.size)
+        async with self.available:
+            client = self.idle.pop() if self.idle else await self._open()
+            try:
+                yield client
+            except ClientError:
+                self.idle.append(client)
+                raise
+            except BaseException:
+                await client.close()
+                raise
+            self.idle.append(client)
+
+    @staticmethod
+    async def _enter(client, folder):
+        '''
+        This function moves the connection to folder, from the folder of the user
+        '''
+        path = [name for name in folder.split("/") if name]
+        common = 0
+        while common < min(len(path), len(client.folder)) and path[common] == client.folder[common]:
+            common += 1
+        while len(client.folder) > common:
+            answer = await client.change_folder("..")
+            if not answer.startswith("\nSuccessfully"):
+                raise ClientError(answer.strip())
+            client.folder.pop()
+        for name in path[common:]:
+            answer = await client.change_folder(name)
+            if not answer.startswith("\nSuccessfully"):
+                raise ClientError(answer.strip())
+            client.folder.append(name)
+
+    async def run(self, function, folder="", retry=True):
+        '''
+        This function runs function(client) on a connection of the pool in
+        folder and returns its result. When the connection fails or times
+        out before function is called, or while it runs and retry is True,
+        it is run again on a new connection.
+        '''
+        delay = self.retry_delay
+        for attempt in itertools.count():
+            started = False
+            try:
+                async with self.connection() as client:
+                    await self._enter(client, folder)
+                    client._check_open()
+                    started = True
+                    return await function(client)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if (started and not retry) or attempt >= self.retries:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def request(self, command, folder="", retry=None):
+        '''
+        This function runs one command and returns its response. By default
+        only the commands of READ_ONLY_COMMANDS are run again after their
+        connection failed, as running copy, move or write_file twice is not
+        the same as running them once.
+        '''
+        if retry is None:
+            retry = command.lstrip(" ").split(" ", 1)[0] in READ_ONLY_COMMANDS
+        return await self.run(lambda client: client.request(command), folder, retry)
+
+    async def write_file(self, name, data, folder=""):
+        return await self.run(lambda client: client.write_file(name, data), folder, retry=False)
+
+    async def upload_many(self, local_paths, folder=""):
+        '''
+        This function uploads the local files into folder, as many at a
+        time as the pool has connections, and returns the responses of the
+        server in the same order
+        '''
+        return await asyncio.gather(*[self.run(functools.partial(FramedClient.upload, local_path=local_path),
+                                               folder) for local_path in local_paths])
+
+    async def download_many(self, names, local_folder, folder=""):
+        '''
+        This function downloads the files of folder into local_folder, as
+        many at a time as the pool has connections, and returns the
+        responses of the server in the same order
+        '''
+        return await asyncio.gather(*[self.run(functools.partial(FramedClient.download, filename=name,
+                                                                 local_path=os.path.join(local_folder, name)),
+                                               folder) for name in names])
+
+    async def read_many(self, names, folder=""):
+        '''
+        This function reads the files of folder, as many at a time as the
+        pool has connections, and returns a dictionary of their contents as
+        bytes. ClientError is raised for a file which cannot be read.
+        '''
+        contents = await asyncio.gather(*[self.run(functools.partial(FramedClient.fetch, filename=name), folder)
+                                          for name in names])
+        return dict(zip(names, contents))
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*[client.close() for client in idle], return_exceptions=True)
+
+
+async def tcp_client():
+    '''
+    This function establishes the TCP connection between the server and the client
+    '''
+    reader, writer = await asyncio.open_connection(
+        '127.0.0.1', 8088)
+    message = ''
+    while True:
+        message = input("$")
+        if message == "":
+            print("$")
+            continue
+
+        writer.write(message.encode())
+        data = await reader.read(4096)
+        print(f"{data.decode()}")
+        if message.lower() == "quit":
+            break
+    print('Close the connection')
+    writer.close()
+
+
+async def framed_client(script=None):
+    '''
+    This function runs the client over the framed protocol. The commands
+    of a script are pipelined, one command per line.
+    --------
+    In the interactive mode "upload <local file> [<name>]" and
+    "download <name> [<local file>]" transfer files in chunks.
+    '''
+    client = await FramedClient.connect()
+    if script is not None:
+        commands = [line.rstrip("\n") for line in script if line.strip()]
+        for response in await client.pipeline(commands):
+            print(response)
+        await client.close()
+        return
+    while True:
+        message = input("$")
+        if message == "":
+            print("$")
+            continue
+        words = message.split(" ")
+        if words[0] == "upload" and len(words) in (2, 3):
+            print(await client.upload(*words[1:]))
+        elif words[0] == "download" and len(words) in (2, 3):
+            print(await client.download(*words[1:]))
+        else:
+            print(await client.request(message))
+        if message.lower() == "quit":
+            break
+    print('Close the connection')
+    await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File management client")
+    parser.add_argument("--framed", action="store_true",
+                        help="use the framed protocol instead of the line protocol")
+    parser.add_argument("--script", type=argparse.FileType("r"),
+                        help="file of commands to pipeline, '-' for stdin (implies --framed)")
+    args = parser.parse_args()
+    if args.script is not None:
+        asyncio.run(framed_client(args.script))
+    elif args.framed:
+        asyncio.run(framed_client())
+    else:
+        asyncio.run(tcp_client())
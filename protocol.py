@@ -0,0 +1,145 @@
+'''
+This file defines the framed protocol used between the server and client
+--------
+The client asks for the framed protocol by sending HANDSHAKE as its first
+message and waits for HANDSHAKE_ACK. Clients which do not send it keep
+using the line protocol, where every read is one command.
+--------
+Every frame is a header followed by the payload. The header holds the
+length of the payload, the id of the request the frame belongs to and
+flags. A message bigger than FRAME_SIZE is split into several frames;
+every frame but the last one has FLAG_MORE set.
+--------
+Uploads and downloads stream a file as frames of raw bytes which
+share the request id of their command, so a file never has to be
+held in memory as a whole.
+'''
+import asyncio
+import struct
+
+HANDSHAKE = b"FRAMED/1\n"
+HANDSHAKE_ACK = b"FRAMED/1 OK\n"
+HEADER = struct.Struct("!IIB")
+FLAG_MORE = 1
+FRAME_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    '''
+    Raised when the peer sends a frame which does not follow the protocol
+    '''
+
+
+class ReadTimeout(ProtocolError):
+    '''
+    Raised when the rest of a frame does not arrive in time
+    '''
+
+
+def encode_frame(request_id, payload, flags=0):
+    '''
+    This function returns the bytes of one frame
+    '''
+    return HEADER.pack(len(payload), request_id, flags) + payload
+
+
+def encode_message(request_id, payload):
+    '''
+    This function returns the frames carrying a whole message
+    '''
+    frames = []
+    for start in range(0, len(payload), FRAME_SIZE):
+        flags = FLAG_MORE if start + FRAME_SIZE < len(payload) else 0
+        frames.append(encode_frame(request_id, payload[start:start + FRAME_SIZE], flags))
+    if not frames:
+        frames.append(encode_frame(request_id, b""))
+    return b"".join(frames)
+
+
+class MessageAssembler():
+    '''
+    This class joins the frames of the messages split into several frames
+    --------
+    self.partial : Frames received so far, by request id
+    '''
+
+    def __init__(self):
+        self.partial = {}
+        self.sizes = {}
+
+    def add(self, request_id, flags, payload):
+        '''
+        This function returns the whole payload once the last frame
+        of the message arrived, and None before that
+        '''
+        size = self.sizes.get(request_id, 0) + len(payload)
+        if size > MAX_MESSAGE_SIZE:
+            raise ProtocolError("Message of more than " + str(MAX_MESSAGE_SIZE) + " bytes is too big")
+        if flags & FLAG_MORE:
+            self.partial.setdefault(request_id, []).append(payload)
+            self.sizes[request_id] = size
+            return None
+        parts = self.partial.pop(request_id, [])
+        self.sizes.pop(request_id, None)
+        parts.append(payload)
+        return b"".join(parts)
+
+
+class FrameReader():
+    '''
+    This class reads frames from an asyncio StreamReader
+    --------
+    self.buffered : Bytes already read from the stream which belong
+                    to the next frames, e.g. sent right after the handshake
+    --------
+    self.read_timeout : Seconds the peer may stop sending in the middle of
+                        a frame before ReadTimeout is raised, None to wait
+                        forever. The wait for the start of a frame is not
+                        limited, idle peers are left to the caller.
+    '''
+
+    def __init__(self, reader, buffered=b"", read_timeout=None):
+        self.reader = reader
+        self.buffered = buffered
+        self.read_timeout = read_timeout
+
+    async def _read_exactly(self, size):
+        data = self.buffered[:size]
+        self.buffered = self.buffered[size:]
+        if len(data) == size:
+            return data
+        if self.read_timeout is None:
+            return data + await self.reader.readexactly(size - len(data))
+        pieces = [data]
+        missing = size - len(data)
+        while missing:
+            try:
+                piece = await asyncio.wait_for(self.reader.read(min(missing, FRAME_SIZE)), self.read_timeout)
+            except asyncio.TimeoutError:
+                raise ReadTimeout("No data for " + str(self.read_timeout) + " s in the middle of a frame")
+            if not piece:
+                raise asyncio.IncompleteReadError(b"".join(pieces), size)
+            pieces.append(piece)
+            missing -= len(piece)
+        return b"".join(pieces)
+
+    async def read_frame(self):
+        '''
+        This function returns the request id, flags and payload of the
+        next frame, or None when the connection was closed
+        '''
+        try:
+            if not self.buffered and self.read_timeout is not None:
+                self.buffered = await self.reader.read(HEADER.size)
+                if not self.buffered:
+                    return None
+            header = await self._read_exactly(HEADER.size)
+            length, request_id, flags = HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError("Frame of " + str(length) + " bytes is too big")
+            payload = await self._read_exactly(length)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            return None
+        return request_id, flags, payload
@@ -1,96 +1,1275 @@
-'''
-This file is the server program using async I/O
---------
-'''
-import asyncio
-import signal
-from CommandHandler import CommandHandler
-
-signal.signal(signal.SIGINT, signal.SIG_DFL)
-
-def client_request(commandhandler, message):
-    '''
-    This function initiates the functions for given commands by user
-    '''
-    message = message.rstrip("\n").rstrip(" ").lstrip(" ")
-    if message.split(" ")[0] == "commands":
-        return commandhandler.commands()
-    if message.split(" ")[0] == "register":
-        if len(message.split(" ")) == 3:
-            return commandhandler.register(message.split(" ")[1], message.split(" ")[2])
-        return "Enter correct command"
-
-    if message.split(" ")[0] == "login":
-        if len(message.split(" ")) == 3:
-            return commandhandler.login(message.split(" ")[1], message.split(" ")[2])
-        return "Enter Right Command"
-
-    if message.split(" ")[0] == "quit":
-        return commandhandler.quit()
-    
-    if message.split(" ")[0] == "list":
-        return commandhandler.list()
-
-    if message.split(" ")[0] == "write_file":
-        if len(message.split(" ")) >= 2:
-            return commandhandler.write_file(message.split(" ")[1], " ".join(message.split(" ")[2:]))
-        return "Enter correct command"
-
-    if message.split(" ")[0] == "create_folder":
-        if len(message.split(" ")) == 2:
-            return commandhandler.create_folder(message.split(" ")[1])
-
-        return "Enter correct command"
-    
-    if message.split(" ")[0] == "change_folder":
-        if len(message.split(" ")) == 2:
-            return commandhandler.change_folder(message.split(" ")[1])
-        return "Enter correct command"
-
-    if message.split(" ")[0] == "read_file":
-        if len(message.split(" ")) == 2:
-            return commandhandler.read_file(message.split(" ")[1])
-        return "Enter correct command"
-
-    
-async def handle_echo(reader, writer):
-    '''
-    This funtion acknowledges the connection from the client,
-    acknowledges the messages from the client
-    '''
-    addr = writer.get_extra_info('peername')
-    message = f"{addr} is connected !!!!"
-    print(message)
-    commandhandler = CommandHandler()
-    while True:
-        data = await reader.read(4096)
-        message = data.decode().strip()
-        if message == 'exit':
-            break
-
-        print(f"Received {message} from {addr}")
-        mymsg = client_request(commandhandler, message)
-        msg = str(mymsg).encode()
-        writer.write(msg)
-        await writer.drain()
-    print("Close the connection")
-    writer.close()
-
-
-async def main():
-    '''
-    This function starts the connection between the server and client
-    '''
-    server = await asyncio.start_server(
-        handle_echo, '127.0.0.1', 8088)
-
-
-    addr = server.sockets[0].getsockname()
-    print(f'Serving on {addr}')
-
-    async with server:
-        await server.serve_forever()
-
-
-asyncio.run(main())
-
+'''
+This file is the server program using async I/O
+--------
+'''
+import argparse
+import asyncio
+import functools
+import itertools
+import logging
+import json
+import os
+import re
+import resource
+import signal
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from CommandHandler import CommandHandler
+from SessionManager import SessionManager, SqliteSessionManager
+from Metrics import Metrics
+from WriteBehind import WriteBehind, DURABILITY_MODES
+from PathIndex import PathIndex
+from ChunkStore import ChunkStore
+from ColdStorage import ColdStorage
+from ResponseCache import ResponseCache
+from DiskUsage import DiskUsage
+from JobManager import JobManager
+from FileWatcher import FileWatcher
+import protocol
+
+signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+DEFAULT_THREADS = 8
+PIPELINE_DEPTH = 128
+UPLOAD_QUEUE = 16
+LIST_BATCH = 1000
+SESSION_SWEEP_SECONDS = 5
+SESSIONS_DATABASE = "AccessSession/sessions.db"
+BACKLOG = 1024
+DEFAULT_HIGH_WATER = 256 * 1024
+BUSY_MESSAGE = "\nServer busy, try again later"
+FAILED_MESSAGE = "\nThe command failed on the server"
+
+logger = logging.getLogger("server")
+
+
+class CommandExecutor():
+    '''
+    This class runs the CommandHandler operations on a bounded
+    pool of threads, so that the event loop only does the socket work
+    and one slow command does not stall the other clients
+    --------
+    self.threads : Number of threads in the pool
+    --------
+    self.pending : Number of commands submitted and not finished yet
+    --------
+    self.running : Number of commands being executed by a thread
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, threads=DEFAULT_THREADS):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="command")
+        self.pending = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        '''
+        This function returns the executor of the connections served
+        without one, creating it on first use
+        '''
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    async def run(self, function, *args):
+        '''
+        This function runs the function on the pool and waits for its result
+        '''
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.pool, self._call, function, args)
+        finally:
+            self.pending -= 1
+
+    def _call(self, function, args):
+        with self.lock:
+            self.running += 1
+        try:
+            return function(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    @property
+    def queue_depth(self):
+        '''
+        Number of commands waiting for a free thread
+        '''
+        return max(self.pending - self.running, 0)
+
+    def status(self):
+        '''
+        This function describes the state of the pool
+        '''
+        return "\nThreads: " + str(self.threads) + " | Running: " + str(self.running) + \
+            " | Queued: " + str(self.queue_depth)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+class Connection():
+    '''
+    This class holds what the ConnectionManager watches of one client
+    --------
+    self.last_activity : Monotonic time of the last command received or answered
+    --------
+    self.busy : Number of commands of the client received and not answered yet
+    --------
+    self.buffered / self.stalled_since : Bytes of responses waiting to be sent
+                                         at the last check, and since when they
+                                         do not drain
+    '''
+    __slots__ = ("writer", "last_activity", "busy", "buffered", "stalled_since")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.last_activity = time.monotonic()
+        self.busy = 0
+        self.buffered = 0
+        self.stalled_since = None
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+
+class ConnectionManager():
+    '''
+    This class keeps the connections of the server within limits, so that
+    dead or slow clients cannot hold its sockets and memory forever
+    --------
+    self.max_connections : Connections served at once, the next clients are
+                           answered BUSY_MESSAGE and closed. None for no limit
+    --------
+    self.idle_timeout : Seconds after which a client which sent nothing and
+                        waits for no response is disconnected, None for never
+    --------
+    self.read_timeout : Seconds a framed client may stop sending in the middle
+                        of a frame, see protocol.FrameReader, None for no limit
+    --------
+    self.write_timeout : Seconds the responses buffered for a client may stay
+                         without draining before it is disconnected, None for no limit
+    --------
+    self.high_water : Bytes of responses buffered for a client above which the
+                      command sending them waits until the client reads them
+    --------
+    The idle and write timeouts are checked by watch() for every connection
+    once per WATCH_SECONDS, instead of a timer armed for every read, so
+    that idle connections cost no more than their socket.
+    '''
+
+    WATCH_SECONDS = 1.0
+    _shared = None
+
+    def __init__(self, max_connections=None, idle_timeout=None, read_timeout=None, write_timeout=None,
+                 high_water=DEFAULT_HIGH_WATER):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.high_water = high_water
+        self.connections = set()
+        self.rejected = 0
+        self.idle_closed = 0
+        self.stalled_closed = 0
+
+    @classmethod
+    def shared(cls):
+        '''
+        This function returns the connection manager of this process,
+        creating it on first use
+        '''
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def open(self, writer):
+        '''
+        This function returns the Connection of a new client, or None when
+        max_connections clients are already connected
+        '''
+        if self.max_connections is not None and len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            return None
+        writer.transport.set_write_buffer_limits(high=self.high_water)
+        connection = Connection(writer)
+        self.connections.add(connection)
+        return connection
+
+    def close(self, connection):
+        self.connections.discard(connection)
+
+    def sweep(self, now=None):
+        '''
+        This function closes the idle connections and aborts the ones whose
+        responses stopped draining, and returns their number
+        '''
+        now = time.monotonic() if now is None else now
+        closed = 0
+        for connection in list(self.connections):
+            transport = connection.writer.transport
+            if transport.is_closing():
+                continue
+            buffered = transport.get_write_buffer_size()
+            if not buffered:
+                connection.stalled_since = None
+            elif connection.stalled_since is None or buffered < connection.buffered:
+                connection.stalled_since = now
+            connection.buffered = buffered
+            if self.write_timeout is not None and connection.stalled_since is not None \
+                    and now - connection.stalled_since > self.write_timeout:
+                transport.abort()
+                self.stalled_closed += 1
+                closed += 1
+            elif self.idle_timeout is not None and not connection.busy and not buffered \
+                    and now - connection.last_activity > self.idle_timeout:
+                transport.close()
+                self.idle_closed += 1
+                closed += 1
+        return closed
+
+    async def watch(self):
+        '''
+        This function sweeps the connections every WATCH_SECONDS
+        '''
+        while True:
+            await asyncio.sleep(ConnectionManager.WATCH_SECONDS)
+            closed = self.sweep()
+            if closed:
+                logger.info("Closed %s idle or stalled connections", closed)
+
+    def stats(self):
+        return {"open": len(self.connections), "max": self.max_connections, "rejected": self.rejected,
+                "idle_closed": self.idle_closed, "stalled_closed": self.stalled_closed}
+
+    def status(self):
+        '''
+        This function describes the connections
+        '''
+        return "\n" + " | ".join(name.replace("_", " ").capitalize() + ": " + str(value)
+                                 for name, value in self.stats().items())
+
+
+def raise_file_limit(connections):
+    '''
+    This function raises the limit of open files of the process to its
+    hard limit, so that it can hold the given number of connections
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if connections is not None and soft != resource.RLIM_INFINITY and soft < connections + 64:
+        logger.warning("Only %s files can be open, fewer than the %s connections allowed", soft, connections)
+
+
+def parse_list_options(words):
+    '''
+    This function returns the keyword arguments of CommandHandler.list
+    for the options of the list command, or None if they are not valid
+    --------
+    --stream only changes how the listing is sent and is skipped here
+    '''
+    options = {}
+    words = [word for word in words if word not in ("", "--stream")]
+    while words:
+        option = words.pop(0)
+        if option == "--reverse":
+            options["reverse"] = True
+            continue
+        if not words:
+            return None
+        value = words.pop(0)
+        if option in ("--offset", "--limit") and value.isdigit():
+            options[option[2:]] = int(value)
+        elif option == "--sort" and value in CommandHandler.LIST_SORT_KEYS:
+            options["sort"] = value
+        elif option == "--format" and value in CommandHandler.LIST_FORMATS:
+            options["output"] = value
+        else:
+            return None
+    return options
+
+
+def parse_find_options(words):
+    '''
+    This function returns the keyword arguments of CommandHandler.find
+    for the options of the find command, or None if they are not valid
+    '''
+    options = {}
+    words = [word for word in words if word != ""]
+    while words:
+        option = words.pop(0)
+        if not words:
+            return None
+        value = words.pop(0)
+        if option == "--name":
+            options["name"] = value
+        elif option in ("--min-size", "--max-size", "--limit") and value.isdigit():
+            options[option[2:].replace("-", "_")] = int(value)
+        elif option in ("--newer", "--older") and value.replace(".", "", 1).isdigit():
+            options[option[2:]] = float(value)
+        elif option == "--type" and value in ("file", "dir"):
+            options["kind"] = value
+        elif option == "--format" and value in CommandHandler.LIST_FORMATS:
+            options["output"] = value
+        else:
+            return None
+    return options
+
+
+def find_arguments(words):
+    '''
+    This function turns the options of find into its keyword arguments
+    '''
+    options = parse_find_options(words)
+    return None if options is None else [options]
+
+
+def search_arguments(words):
+    '''
+    This function turns the text and the options of search into the
+    keyword arguments of find
+    '''
+    options = parse_find_options(words[1:])
+    if options is None or not words[0]:
+        return None
+    options["contains"] = words[0]
+    return [options]
+
+
+Command = namedtuple("Command", ["name", "function", "minimum", "maximum", "rest", "convert", "error"])
+COMMANDS = {}
+COMMAND_SEPARATOR = re.compile("[ \n]")
+# Commands about the server itself, called on the event loop with the
+# CommandExecutor, the words of the message and the CommandHandler of the client
+ADMIN_COMMANDS = {}
+
+
+def register_command(name, function, minimum=0, maximum=0, rest=False, convert=None,
+                     error="Enter correct command"):
+    '''
+    This function adds a command of the clients to the table of commands
+    --------
+    function is called with the CommandHandler of the connection and the
+    arguments of the command, between minimum and maximum of them (None
+    for no maximum). With rest the last argument is the rest of the
+    message, spaces included, so a large write_file payload is never split.
+    convert turns the arguments into the ones of the function and returns
+    None when they are not valid. error is answered for wrong arguments.
+    A command taking the rest of the message needs a maximum, ValueError
+    is raised otherwise.
+    '''
+    if rest and maximum is None:
+        raise ValueError("The command " + name + " takes the rest of the message and needs a maximum")
+    COMMANDS[name] = Command(name, function, minimum, maximum, rest, convert, error)
+
+
+def split_command(message):
+    '''
+    This function splits the command word off a message at the first space
+    or new line, without splitting the rest of the message
+    '''
+    separator = COMMAND_SEPARATOR.search(message)
+    if separator is None:
+        return message, ""
+    return message[:separator.start()], message[separator.end():]
+
+
+def parse_command(message):
+    '''
+    This function tokenizes a message once and returns its Command with the
+    arguments of its function, (None, None) for an unknown command and
+    (Command, None) for wrong arguments
+    '''
+    message = message.rstrip("\n").rstrip(" ").lstrip(" ")
+    name, tail = split_command(message)
+    command = COMMANDS.get(name)
+    if command is None:
+        return None, None
+    if not tail:
+        arguments = []
+    elif command.rest:
+        arguments = tail.split(" ", command.maximum - 1)
+    else:
+        arguments = tail.split(" ")
+    if len(arguments) < command.minimum or (command.maximum is not None and len(arguments) > command.maximum):
+        return command, None
+    if command.convert is not None:
+        arguments = command.convert(arguments)
+    return command, arguments
+
+
+def client_request(commandhandler, message):
+    '''
+    This function initiates the functions for given commands by user
+    '''
+    command, arguments = parse_command(message)
+    if command is None:
+        return None
+    if arguments is None:
+        return command.error
+    return command.function(commandhandler, *arguments)
+
+
+def count_arguments(words):
+    '''
+    This function checks the optional character count of read_file
+    '''
+    if len(words) == 2:
+        return [words[0], int(words[1])] if words[1].isdigit() else None
+    return words
+
+
+def list_arguments(words):
+    '''
+    This function turns the options of list into its keyword arguments
+    '''
+    options = parse_list_options(words)
+    return None if options is None else [options]
+
+
+def job_arguments(words):
+    '''
+    This function checks the job number of jobs and cancel
+    '''
+    if not all(word.isdigit() for word in words):
+        return None
+    return [int(word) for word in words]
+
+
+def run_batch(commandhandler, body=""):
+    '''
+    This function runs a batch of commands, one command per line, and returns
+    one json line per command run with its name, whether it succeeded and
+    its response. "--stop-on-error" on the first line stops the batch at the
+    first failed command.
+    '''
+    lines = body.split("\n")
+    stop_on_error = False
+    if lines[0].startswith("--"):
+        options = lines.pop(0).split()
+        if options != ["--stop-on-error"]:
+            return "Enter correct command"
+        stop_on_error = True
+    operations = []
+    for line in lines:
+        if not line.strip():
+            continue
+        command, arguments = parse_command(line)
+        if command is None or arguments is None:
+            operations.append((split_command(line.strip())[0], None))
+        else:
+            operations.append((command.name, functools.partial(batch_call, command.function, arguments)))
+    results = commandhandler.batch(operations, stop_on_error)
+    return "".join(json.dumps({"command": name, "ok": ok, "response": response}) + "\n"
+                   for name, ok, response in results)
+
+
+def batch_call(function, arguments, commandhandler):
+    return function(commandhandler, *arguments)
+
+
+def framed_only(commandhandler, *arguments):
+    return "\nupload, download and follow need the framed protocol (client.py --framed)"
+
+
+register_command("commands", lambda commandhandler, *ignored: commandhandler.commands(), maximum=None)
+register_command("register", CommandHandler.register, 2, 2)
+register_command("login", CommandHandler.login, 2, 2, error="Enter Right Command")
+register_command("quit", lambda commandhandler, *ignored: commandhandler.quit(), maximum=None)
+register_command("list", lambda commandhandler, options: commandhandler.list(**options), 0, None,
+                 convert=list_arguments)
+register_command("write_file", lambda commandhandler, filepath, data="": commandhandler.write_file(filepath, data),
+                 1, 2, rest=True)
+register_command("create_folder", CommandHandler.create_folder, 1, 1)
+register_command("change_folder", CommandHandler.change_folder, 1, 1)
+register_command("read_file", CommandHandler.read_file, 1, 2, convert=count_arguments)
+register_command("find", lambda commandhandler, options: commandhandler.find(**options), 0, None,
+                 convert=find_arguments)
+register_command("search", lambda commandhandler, options: commandhandler.find(**options), 1, None,
+                 convert=search_arguments)
+register_command("reindex", CommandHandler.reindex)
+register_command("usage", CommandHandler.usage)
+register_command("delete_folder", CommandHandler.delete_folder, 1, 1)
+register_command("copy", CommandHandler.copy, 2, 2)
+register_command("move", CommandHandler.move, 2, 2)
+register_command("jobs", CommandHandler.jobs, 0, 1, convert=job_arguments)
+register_command("cancel", CommandHandler.cancel, 1, 1, convert=job_arguments)
+register_command("flush", CommandHandler.flush, 0, 1)
+register_command("fsync", CommandHandler.fsync, 0, 1)
+register_command("batch", run_batch, 0, 1, rest=True)
+register_command("upload", framed_only, maximum=None)
+register_command("download", framed_only, maximum=None)
+register_command("follow", framed_only, maximum=None)
+register_command("unfollow", framed_only, maximum=None)
+
+
+class Upload():
+    '''
+    This class is a file being received from the client
+    --------
+    The chunks are passed from the reading task to the writing task
+    through a bounded queue, so a slow disk slows down the reading
+    from the socket instead of filling the memory
+    '''
+
+    def __init__(self, request_id, filename, size):
+        self.request_id = request_id
+        self.filename = filename
+        self.size = size
+        self.received = 0
+        self.chunks = asyncio.Queue(UPLOAD_QUEUE)
+
+    @classmethod
+    def parse(cls, request_id, payload):
+        '''
+        This function returns an Upload for an "upload <name> <size>"
+        command and None for any other message
+        '''
+        words = payload.decode(errors="replace").strip().split(" ")
+        if len(words) == 3 and words[0] == "upload" and words[2].isdigit():
+            return cls(request_id, words[1], int(words[2]))
+        return None
+
+
+async def receive_upload(upload, commandhandler, executor):
+    '''
+    This function writes the chunks of an upload to a temporary file
+    which is renamed into place when the whole file was received
+    '''
+    temp_path, error = await executor.run(commandhandler.start_upload, upload.filename, upload.size)
+    file = None
+    if error is None:
+        file = await executor.run(open, temp_path, "wb")
+    received = 0
+    while True:
+        chunk = await upload.chunks.get()
+        if chunk is None:
+            break
+        received += len(chunk)
+        if file is None:
+            continue
+        try:
+            await executor.run(file.write, chunk)
+        except OSError as write_error:
+            error = "\nUpload failed: " + str(write_error)
+            await executor.run(file.close)
+            file = None
+    if file is not None:
+        await executor.run(file.close)
+    if error is None and received != upload.size:
+        error = "\nUpload interrupted after " + str(received) + " bytes"
+    if error is not None:
+        await executor.run(commandhandler.abort_upload, temp_path)
+        return error
+    return await executor.run(commandhandler.finish_upload, temp_path, upload.filename)
+
+
+async def send_download(request_id, filename, writer, commandhandler, executor):
+    '''
+    This function streams a file to the client
+    --------
+    The first frame tells the size of the file, the next frames carry
+    the content and an empty frame without FLAG_MORE ends the download.
+    Waiting on drain() after every chunk keeps the memory constant
+    when the client reads slower than the disk. Returns the number of
+    bytes of the file sent.
+    '''
+    path, size, error = await executor.run(commandhandler.start_download, filename)
+    if error is not None:
+        writer.write(protocol.encode_message(request_id, error.encode()))
+        return len(error)
+    sent = 0
+    header = "\nDownloading " + str(size) + " bytes of file " + filename
+    writer.write(protocol.encode_frame(request_id, header.encode(), protocol.FLAG_MORE))
+    file = await executor.run(commandhandler.open_file, path)
+    try:
+        while True:
+            chunk = await executor.run(file.read, protocol.FRAME_SIZE)
+            if not chunk:
+                break
+            writer.write(protocol.encode_frame(request_id, chunk, protocol.FLAG_MORE))
+            sent += len(chunk)
+            await writer.drain()
+    finally:
+        await executor.run(file.close)
+    writer.write(protocol.encode_frame(request_id, b""))
+    return sent
+
+
+async def start_follow(request_id, words, writer, commandhandler, executor, connection, follows):
+    '''
+    This function starts following a file for the client with
+    "follow <name> [<offset>]", from its end by default
+    --------
+    The first frame tells the offset the file is followed from, then
+    send_follow() pushes the bytes appended to the file in the background,
+    while the connection goes on serving the other commands, until
+    "unfollow <name>". follows holds the files followed by the connection.
+    Returns the number of bytes sent.
+    '''
+    name = words[0]
+    if len(words) == 2 and not words[1].isdigit():
+        error = "Enter correct command"
+    elif name in follows:
+        error = "\nAlready following " + name
+    else:
+        path, offset, size, error = await executor.run(commandhandler.start_follow, name,
+                                                       int(words[1]) if len(words) == 2 else None)
+    if error is not None:
+        writer.write(protocol.encode_message(request_id, error.encode()))
+        return len(error)
+    header = "\nFollowing file " + name + " from byte " + str(offset)
+    writer.write(protocol.encode_frame(request_id, header.encode(), protocol.FLAG_MORE))
+    subscriber = FileWatcher.shared().follow(path, offset, size, executor.run, commandhandler.read_bytes)
+    connection.busy += 1
+    follows[name] = (subscriber, asyncio.ensure_future(
+        send_follow(request_id, name, subscriber, writer, connection, follows)))
+    return len(header)
+
+
+async def send_follow(request_id, name, subscriber, writer, connection, follows):
+    '''
+    This function pushes the bytes appended to a followed file to the
+    client as frames with FLAG_MORE, and ends with a frame without it
+    telling why the follow ended. The connection counts as busy while
+    it follows a file, so it is not closed as idle.
+    '''
+    try:
+        while True:
+            data = await subscriber.read()
+            if data is None:
+                break
+            for start in range(0, len(data), protocol.FRAME_SIZE):
+                writer.write(protocol.encode_frame(request_id, data[start:start + protocol.FRAME_SIZE],
+                                                   protocol.FLAG_MORE))
+                await writer.drain()
+        ending = "\nStopped following " + name + ": " + subscriber.ended
+    except OSError as error:
+        ending = "\nStopped following " + name + ": " + (error.strerror or str(error))
+    finally:
+        FileWatcher.shared().unfollow(subscriber)
+        connection.busy -= 1
+        if follows.get(name, (None,))[0] is subscriber:
+            del follows[name]
+    if not writer.is_closing():
+        writer.write(protocol.encode_frame(request_id, ending.encode()))
+
+
+def stop_follow(name, follows):
+    '''
+    This function stops following a file for the client
+    '''
+    follow = follows.get(name)
+    if follow is None:
+        return "\nNot following " + name
+    FileWatcher.shared().unfollow(follow[0])
+    return "\nUnfollowed " + name
+
+
+async def send_listing(request_id, options, writer, commandhandler, executor):
+    '''
+    This function streams a listing to the client, LIST_BATCH rows per
+    frame, while the rows are produced. An empty frame without
+    FLAG_MORE ends the listing. Returns the number of bytes sent.
+    '''
+    rows = commandhandler.list_rows(**options)
+    sent = 0
+    while True:
+        batch = await executor.run(lambda: "".join(itertools.islice(rows, LIST_BATCH)).encode())
+        if not batch:
+            break
+        writer.write(protocol.encode_frame(request_id, batch, protocol.FLAG_MORE))
+        sent += len(batch)
+        await writer.drain()
+    writer.write(protocol.encode_frame(request_id, b""))
+    return sent
+
+
+def server_stats(executor, words, commandhandler):
+    '''
+    This function answers the stats admin command: "stats [json]" reports
+    the metrics, "stats profile" the profile of the sampled commands and
+    "stats reset" clears them. The profile and the reset need a login.
+    '''
+    metrics = Metrics.shared()
+    option = words[1] if len(words) > 1 else "text"
+    if option in ("profile", "reset") and not commandhandler.is_login:
+        return CommandHandler.NOT_LOGGED_IN
+    if option == "profile":
+        return metrics.profile_report()
+    if option == "reset":
+        metrics.reset()
+        return "\nMetrics reset"
+    pool = {"threads": executor.threads, "running": executor.running, "queued": executor.queue_depth}
+    extra = {"pool": pool, "connection_manager": ConnectionManager.shared().stats(),
+             "response_cache": ResponseCache.shared().stats(), "jobs": JobManager.shared().stats(),
+             "follows": FileWatcher.shared().stats()}
+    chunk_store = ChunkStore.shared()
+    if chunk_store.enabled:
+        extra["storage"] = chunk_store.stats()
+    cold_storage = ColdStorage.shared()
+    if cold_storage.cold_after is not None:
+        extra["cold_storage"] = cold_storage.stats()
+    return metrics.report("json" if option == "json" else "text", **extra)
+
+
+ADMIN_COMMANDS["pool_status"] = lambda executor, words, commandhandler: executor.status()
+ADMIN_COMMANDS["stats"] = server_stats
+
+
+def storage_report():
+    '''
+    This function returns the stats of the chunk store, and of the cold
+    storage when it is enabled, which are read from their databases on
+    the thread pool
+    '''
+    report = ChunkStore.shared().report()
+    cold_storage = ColdStorage.shared()
+    if cold_storage.cold_after is not None:
+        report += "\n" + "\n".join(name + ": " + str(value) for name, value in cold_storage.stats().items())
+    return report
+
+
+ADMIN_COMMANDS["storage"] = lambda executor, words, commandhandler: executor.run(storage_report)
+ADMIN_COMMANDS["connections"] = lambda executor, words, commandhandler: ConnectionManager.shared().status()
+
+
+async def dispatch(commandhandler, executor, message):
+    '''
+    This function runs one command of the client and returns the response
+    --------
+    The admin commands are answered on the event loop, unless they return
+    a coroutine, e.g. of executor.run, which is awaited. The other commands
+    run on the thread pool, under cProfile for the sampled ones
+    '''
+    admin = ADMIN_COMMANDS.get(command_word(message))
+    if admin is not None:
+        response = admin(executor, message.split(" "), commandhandler)
+        if asyncio.iscoroutine(response):
+            return await response
+        return response
+    metrics = Metrics.shared()
+    if metrics.should_profile():
+        return await executor.run(metrics.profiled, client_request, commandhandler, message)
+    return await executor.run(client_request, commandhandler, message)
+
+
+async def execute(commandhandler, executor, message):
+    '''
+    This function runs one command of the client and returns the response,
+    recording its latency and size when the metrics are enabled
+    --------
+    A command which fails is logged and answered with FAILED_MESSAGE, so
+    the connection and the commands pipelined after it go on
+    '''
+    metrics = Metrics.shared()
+    start = time.perf_counter()
+    try:
+        response = await dispatch(commandhandler, executor, message)
+    except Exception:
+        logger.exception("Error while running %s", command_name(message))
+        response = FAILED_MESSAGE
+    if metrics.enabled:
+        metrics.record(command_name(message), time.perf_counter() - start, len(message), len(str(response)))
+    return response
+
+
+def command_word(message):
+    '''
+    This function returns the first word of a message
+    '''
+    return split_command(message.lstrip(" ").rstrip("\n"))[0]
+
+
+def command_name(message):
+    '''
+    This function returns the name of the command under which it is recorded
+    '''
+    name = command_word(message)
+    return name if name in COMMANDS or name in ADMIN_COMMANDS else "unknown"
+
+
+async def serve_lines(reader, writer, commandhandler, executor, data, connection):
+    '''
+    This function serves a client using the line protocol, where every
+    read from the connection is one command, until the client says exit
+    or closes the connection
+    '''
+    addr = writer.get_extra_info('peername')
+    while data:
+        message = data.decode(errors="replace").strip()
+        if message == 'exit':
+            break
+
+        logger.debug("Received %s from %s", message, addr)
+        connection.busy += 1
+        mymsg = await execute(commandhandler, executor, message)
+        msg = str(mymsg).encode()
+        writer.write(msg)
+        await writer.drain()
+        connection.busy -= 1
+        connection.touch()
+        data = await reader.read(4096)
+        connection.touch()
+
+
+async def serve_framed(frames, writer, commandhandler, executor, connection):
+    '''
+    This function serves a client using the framed protocol
+    --------
+    The frames are read ahead while earlier commands are executed, so
+    the client can pipeline up to PIPELINE_DEPTH commands without waiting
+    for the responses. Each response carries the id of its request.
+    '''
+    addr = writer.get_extra_info('peername')
+    metrics = Metrics.shared()
+    requests = asyncio.Queue(PIPELINE_DEPTH)
+    follows = {}
+
+    async def read_requests():
+        messages = protocol.MessageAssembler()
+        uploads = {}
+        try:
+            while True:
+                frame = await frames.read_frame()
+                if frame is None:
+                    break
+                connection.touch()
+                request_id, flags, payload = frame
+                upload = uploads.get(request_id)
+                if upload is not None:
+                    upload.received += len(payload)
+                    await upload.chunks.put(payload)
+                    if upload.received >= upload.size:
+                        await upload.chunks.put(None)
+                        del uploads[request_id]
+                    continue
+                payload = messages.add(request_id, flags, payload)
+                if payload is None:
+                    continue
+                upload = Upload.parse(request_id, payload)
+                connection.busy += 1
+                if upload is None:
+                    await requests.put((request_id, payload))
+                    continue
+                await requests.put(upload)
+                if upload.size == 0:
+                    await upload.chunks.put(None)
+                else:
+                    uploads[request_id] = upload
+        except protocol.ProtocolError as error:
+            logger.warning("Protocol error from %s: %s", addr, error)
+        for upload in uploads.values():
+            await upload.chunks.put(None)
+        await requests.put(None)
+
+    reading = asyncio.ensure_future(read_requests())
+    try:
+        while True:
+            request = await requests.get()
+            if request is None:
+                break
+            if isinstance(request, Upload):
+                logger.debug("Received upload of %s from %s", request.filename, addr)
+                start = time.perf_counter()
+                mymsg = await receive_upload(request, commandhandler, executor)
+                metrics.record("upload", time.perf_counter() - start, request.received, len(mymsg))
+                writer.write(protocol.encode_message(request.request_id, mymsg.encode()))
+                await writer.drain()
+                connection.busy -= 1
+                connection.touch()
+                continue
+            request_id, payload = request
+            message = payload.decode(errors="replace").strip()
+            if message == 'exit':
+                break
+
+            logger.debug("Received %s from %s", message, addr)
+            words = message.split(" ")
+            options = parse_list_options(words[1:]) if words[0] == "list" and "--stream" in words else None
+            start = time.perf_counter()
+            if len(words) == 2 and words[0] == "download":
+                sent = await send_download(request_id, words[1], writer, commandhandler, executor)
+                metrics.record("download", time.perf_counter() - start, len(payload), sent)
+            elif options is not None:
+                sent = await send_listing(request_id, options, writer, commandhandler, executor)
+                metrics.record("list", time.perf_counter() - start, len(payload), sent)
+            elif words[0] == "follow" and len(words) in (2, 3):
+                sent = await start_follow(request_id, words[1:], writer, commandhandler, executor, connection,
+                                          follows)
+                metrics.record("follow", time.perf_counter() - start, len(payload), sent)
+            elif words[0] == "unfollow" and len(words) == 2:
+                mymsg = stop_follow(words[1], follows)
+                metrics.record("unfollow", time.perf_counter() - start, len(payload), len(mymsg))
+                writer.write(protocol.encode_message(request_id, mymsg.encode()))
+            else:
+                mymsg = await execute(commandhandler, executor, message)
+                writer.write(protocol.encode_message(request_id, str(mymsg).encode()))
+            await writer.drain()
+            connection.busy -= 1
+            connection.touch()
+    finally:
+        reading.cancel()
+        for subscriber, following in list(follows.values()):
+            following.cancel()
+
+
+async def handle_echo(reader, writer, executor=None, connections=None):
+    '''
+    This funtion acknowledges the connection from the client,
+    acknowledges the messages from the client
+    --------
+    The commands are executed on the thread pool of the executor, the
+    one shared by the process when none is given
+    --------
+    A client whose first message is the protocol handshake is served
+    with the framed protocol, any other client with the line protocol
+    --------
+    The connection is counted by the connections manager, which refuses
+    it when too many clients are connected. Whichever way the connection
+    ends, the client is logged out and the connection is closed. An error
+    of a command is answered by execute, any other error is logged and
+    ends the connection without escaping the handler. When the handler is cancelled, as the server stops, the client
+    is logged out on the event loop, as the thread pool may be gone.
+    '''
+    if executor is None:
+        executor = CommandExecutor.shared()
+    if connections is None:
+        connections = ConnectionManager.shared()
+    addr = writer.get_extra_info('peername')
+    connection = connections.open(writer)
+    if connection is None:
+        logger.warning("Refused %s, %s clients are connected", addr, len(connections.connections))
+        writer.write(BUSY_MESSAGE.encode())
+        writer.close()
+        return
+    logger.info("%s is connected !!!!", addr)
+    metrics = Metrics.shared()
+    metrics.connection_opened()
+    commandhandler = CommandHandler()
+    cancelled = False
+    try:
+        data = await reader.read(4096)
+        connection.touch()
+        if data.startswith(protocol.HANDSHAKE):
+            writer.write(protocol.HANDSHAKE_ACK)
+            await writer.drain()
+            frames = protocol.FrameReader(reader, data[len(protocol.HANDSHAKE):], connections.read_timeout)
+            await serve_framed(frames, writer, commandhandler, executor, connection)
+        else:
+            await serve_lines(reader, writer, commandhandler, executor, data, connection)
+    except ConnectionError as error:
+        logger.info("Lost the connection of %s: %s", addr, error)
+    except asyncio.CancelledError:
+        cancelled = True
+        logger.info("Stopped serving %s", addr)
+    except Exception:
+        logger.exception("Error while serving %s", addr)
+    finally:
+        connections.close(connection)
+        metrics.connection_closed()
+        if commandhandler.session_token is not None:
+            if cancelled:
+                commandhandler.quit()
+            else:
+                try:
+                    await executor.run(commandhandler.quit)
+                except (RuntimeError, asyncio.CancelledError):
+                    commandhandler.quit()
+        logger.info("Close the connection of %s", addr)
+        writer.close()
+
+
+async def maintain_sessions(sessions, executor, snapshot_interval=None):
+    '''
+    This function evicts the idle sessions every SESSION_SWEEP_SECONDS
+    and, if a snapshot interval is given, writes the open sessions to
+    the logged in users file every snapshot_interval seconds
+    '''
+    last_snapshot = time.monotonic()
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        evicted = sessions.evict_idle()
+        if evicted:
+            logger.info("Evicted %s idle sessions", evicted)
+        if snapshot_interval is not None and time.monotonic() - last_snapshot >= snapshot_interval:
+            await executor.run(sessions.snapshot, CommandHandler.LOGGED_IN_USERS_CSV_FILE)
+            last_snapshot = time.monotonic()
+
+
+async def maintain_usage(disk_usage, path_index, executor, reconcile_interval=None):
+    '''
+    This function writes the changes of the disk usage and of the path
+    index every SESSION_SWEEP_SECONDS and, if an interval is given, computes
+    the usage of every user from the disk every reconcile_interval seconds
+    '''
+    last_reconcile = time.monotonic()
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        await executor.run(disk_usage.flush)
+        await executor.run(path_index.flush)
+        if reconcile_interval is None or time.monotonic() - last_reconcile < reconcile_interval:
+            continue
+        last_reconcile = time.monotonic()
+        try:
+            users = await executor.run(disk_usage.reconcile_all, CommandHandler.ROOT_DIR)
+        except OSError:
+            logger.exception("Reconciling the disk usage failed")
+            continue
+        logger.info("Reconciled the disk usage of %s users", users)
+
+
+async def compress_cold_files(cold_storage, executor, interval):
+    '''
+    This function compresses the files of Root/ not written for a while
+    every interval seconds, in the thread pool
+    '''
+    chunk_store = ChunkStore.shared()
+    write_behind = WriteBehind.shared()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            compressed = await executor.run(cold_storage.sweep, CommandHandler.ROOT_DIR,
+                                            chunk_store.manages, write_behind)
+        except OSError:
+            logger.exception("Compressing the cold files failed")
+            continue
+        if compressed:
+            logger.info("Compressed %s cold files", compressed)
+
+
+def listening_socket(host, port):
+    '''
+    This function returns a socket bound with SO_REUSEPORT, so that
+    every worker process can bind its own socket to the same address
+    and the kernel spreads the connections between them
+    '''
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+async def main(options, sock=None):
+    '''
+    This function starts the connection between the server and client
+    '''
+    executor = CommandExecutor(options.threads)
+    metrics = Metrics.shared()
+    metrics.enabled = options.metrics
+    metrics.profile_every = options.profile_every
+    write_behind = WriteBehind.shared()
+    write_behind.durability = options.durability
+    path_index = PathIndex.shared(CommandHandler.PATH_INDEX_DATABASE)
+    path_index.max_age = options.index_max_age
+    ChunkStore.shared().enabled = options.storage == "dedup"
+    cold_storage = ColdStorage.shared()
+    cold_storage.cold_after = options.cold_after
+    ResponseCache.shared().max_bytes = options.response_cache_bytes
+    connections = ConnectionManager.shared()
+    connections.max_connections = options.max_connections
+    connections.idle_timeout = options.connection_idle_timeout
+    connections.read_timeout = options.read_timeout
+    connections.write_timeout = options.write_timeout
+    connections.high_water = options.high_water
+    raise_file_limit(options.max_connections)
+    job_manager = JobManager.shared()
+    job_manager.threads = options.job_threads
+    FileWatcher.shared().poll_seconds = options.follow_poll_seconds
+    disk_usage = DiskUsage.shared(CommandHandler.USAGE_DATABASE)
+    disk_usage.default_quota = options.quota
+    disk_usage.set_quotas(CommandHandler.ROOT_DIR, dict(options.user_quota or ()))
+    sessions = SessionManager.shared()
+    sessions.idle_timeout = options.idle_timeout
+    if sock is None:
+        server = await asyncio.start_server(
+            functools.partial(handle_echo, executor=executor), options.host, options.port, backlog=BACKLOG)
+    else:
+        server = await asyncio.start_server(
+            functools.partial(handle_echo, executor=executor), sock=sock, backlog=BACKLOG)
+
+
+    addr = server.sockets[0].getsockname()
+    print(f'Serving on {addr}', flush=True)
+
+    maintenance = asyncio.ensure_future(maintain_sessions(sessions, executor, options.snapshot_interval))
+    watching = asyncio.ensure_future(connections.watch())
+    accounting = asyncio.ensure_future(maintain_usage(disk_usage, path_index, executor, options.usage_reconcile_interval))
+    compression = None
+    if options.cold_after is not None:
+        compression = asyncio.ensure_future(compress_cold_files(cold_storage, executor, options.cold_interval))
+    serving = asyncio.ensure_future(server.serve_forever())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        async with server:
+            await asyncio.gather(serving, return_exceptions=True)
+    finally:
+        maintenance.cancel()
+        watching.cancel()
+        accounting.cancel()
+        if compression is not None:
+            compression.cancel()
+        executor.shutdown()
+        job_manager.cancel_all()
+        write_behind.close_all()
+        path_index.flush()
+        disk_usage.flush()
+
+
+def run_workers(options):
+    '''
+    This function forks options.workers worker processes which serve
+    the same address through SO_REUSEPORT
+    --------
+    The login sessions are kept in the SQLite database SESSIONS_DATABASE
+    so that every worker sees them, and the registered users file is
+    locked while it is written. The parent process keeps a socket bound
+    to the address, which also gives the workers the port picked when
+    options.port is 0, and stops the workers when it is terminated. The
+    sessions left by a previous run are closed before the workers start.
+    '''
+    previous_run = SqliteSessionManager(SESSIONS_DATABASE)
+    previous_run.clear()
+    previous_run.connection.close()
+    reserved = listening_socket(options.host, options.port)
+    port = reserved.getsockname()[1]
+    print(f'Serving on {(options.host, port)} with {options.workers} workers', flush=True)
+    children = []
+    for _ in range(options.workers):
+        pid = os.fork()
+        if pid == 0:
+            reserved.close()
+            status = 0
+            try:
+                SessionManager.set_shared(SqliteSessionManager(SESSIONS_DATABASE))
+                asyncio.run(main(options, listening_socket(options.host, port)))
+            except BaseException:
+                logger.exception("Worker process %s failed", os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+
+    def stop_workers(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    for child in children:
+        os.waitpid(child, 0)
+    reserved.close()
+
+
+def parse_size(text):
+    '''
+    This function returns the number of bytes of a size like 512, 64K, 10M or 2G
+    '''
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper()
+    try:
+        if text[-1:] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size " + text)
+
+
+def parse_user_quota(text):
+    '''
+    This function returns the user and the bytes of a quota like alice=10G
+    '''
+    user_id, separator, size = text.partition("=")
+    if not separator or not user_id:
+        raise argparse.ArgumentTypeError("expected <user>=<size>, not " + text)
+    return user_id, parse_size(size)
+
+
+def parse_arguments(arguments=None):
+    '''
+    This function returns the options of the server given on the command line
+    '''
+    parser = argparse.ArgumentParser(description="File management server")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address the server listens on")
+    parser.add_argument("--port", type=int, default=8088,
+                        help="port the server listens on, 0 for any free port")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help="number of threads executing the commands")
+    parser.add_argument("--job-threads", type=int, default=8,
+                        help="threads working on the files of delete_folder, copy and move")
+    parser.add_argument("--follow-poll-seconds", type=float, default=None,
+                        help="check the followed files every so many seconds instead of using inotify")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="seconds after which an unused login session is closed")
+    parser.add_argument("--max-connections", type=int, default=10000,
+                        help="clients served at once, the next ones are refused")
+    parser.add_argument("--connection-idle-timeout", type=float, default=600,
+                        help="seconds after which a client which sends nothing is disconnected")
+    parser.add_argument("--read-timeout", type=float, default=30,
+                        help="seconds a client may stop sending in the middle of a frame")
+    parser.add_argument("--write-timeout", type=float, default=60,
+                        help="seconds a client may stop reading the responses sent to it")
+    parser.add_argument("--high-water", type=int, default=DEFAULT_HIGH_WATER,
+                        help="bytes of responses buffered for a client before waiting for it to read them")
+    parser.add_argument("--snapshot-interval", type=float, default=None,
+                        help="seconds between two snapshots of the sessions to the logged in users file")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default="write",
+                        help="write: appends are written before write_file answers, buffered: appends "
+                             "are kept in memory for up to 0.2 s, fsync: appends are on the disk "
+                             "before write_file answers")
+    parser.add_argument("--storage", choices=("plain", "dedup"), default="plain",
+                        help="dedup stores the content of the new files once, in chunks shared by every user")
+    parser.add_argument("--cold-after", type=float, default=None,
+                        help="seconds without writes after which a file of Root/ is compressed, "
+                             "off by default")
+    parser.add_argument("--cold-interval", type=float, default=300,
+                        help="seconds between two looks for files to compress")
+    parser.add_argument("--quota", type=parse_size, default=None,
+                        help="bytes every user may store, like 500M or 10G, no limit by default")
+    parser.add_argument("--user-quota", type=parse_user_quota, action="append",
+                        help="quota of one user, like alice=50G, can be repeated")
+    parser.add_argument("--usage-reconcile-interval", type=float, default=3600,
+                        help="seconds between two computations of the disk usage of every user from the disk")
+    parser.add_argument("--index-max-age", type=float, default=None,
+                        help="seconds after which find scans the tree of a user again for changes "
+                             "made outside of the server")
+    parser.add_argument("--response-cache-bytes", type=int, default=32 * 1024 * 1024,
+                        help="bytes of read_file and list responses kept for the clients polling "
+                             "unchanged files and folders, 0 to disable")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record the latency and size of the commands, reported by the stats command")
+    parser.add_argument("--profile-every", type=int, default=None,
+                        help="with --metrics, run one command out of this many under cProfile")
+    parser.add_argument("--log-level", default="INFO",
+                        help="level of the log messages, DEBUG logs every command")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        asyncio.run(main(args))
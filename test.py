@@ -1,136 +1,2165 @@
-"""
-This program deals with the testing of
-the server-client application
-"""
-import unittest
-import sys
-import pandas
-from CommandHandler import CommandHandler
-import os
-import shutil
-
-
-class TestClient(unittest.TestCase):
-    """
-    This class defines the tests that are conducted
-    for the functions defined in the client-server application
-    """
-
-    def test_commands_output(self):
-        """
-        This function deals with testing commands output
-        """
-
-        commands = ["register : For registering the new user ,command:register <username> <password> \n",
-                 "login : To login, command:login <username> <password>,Note:password should be in integer\n",
-                 "quit : To logout, command:quit\n",
-                 
-                 "change_folder : To change the path, command:change_folder <name>\n",
-                 "list : list of all files in the path, command:list\n",
-                 "read_file : To read content from the file, command:read_file <name>\n",
-                 "write_file : To write content into the file, command:write_file <name>\n",
-                 "create_folder : To create new folder, command:create_folder <name>\n"
-                ]
-        description = ""
-        for command in commands:
-            description += command
-
-        user_test = CommandHandler()
-        obtained_result = user_test.commands()
-        self.assertEqual(description, obtained_result)
-
-    def test_register_password_length(self):
-        """
-        This function deals with test for registration data 
-        and whether password with length of less than 8 characters 
-        are not getting accepted.
-        """
-        user_test = CommandHandler()
-        expected_result = "\n Password length should be more than 8 characters."
-        obtained_result = user_test.register('test1', '122')
-        self.assertEqual(expected_result, obtained_result)
-        user_test.quit()
-        
-        
-    
-    def test_register_successful_registration(self):
-        """
-        This function deals with test whether the user provided data
-         is being registered successfully
-        """
-
-        user_test = CommandHandler()
-        expected_result = "\nSuccessfully registered user"
-        obtained_result = user_test.register("test2", "13791247nbdshrlfngls")
-        self.assertEqual(expected_result, obtained_result)
-        user_test.quit()
-        shutil.rmtree(os.path.join("Root/test2"))
-        shutil.rmtree(os.path.join("AccessSession/"))
-
-    
-    def test_login(self):
-        """
-        This function deals with test for login data
-        """
-
-        user_test = CommandHandler()
-        user_test.register('test', '123456737')
-        expected_result = ["\nWrong Password, try again"]
-        obtained_result = []
-        tests = [['test', '12345678']]
-        for test in tests:
-            obtained_result.append(user_test.login(test[0], test[1]))
-        user_test.quit()
-        self.assertListEqual(obtained_result, expected_result)
-        shutil.rmtree(os.path.join("Root/"))
-        shutil.rmtree("AccessSession/")
-
-    def test_quit(self):
-        """
-        This function deals whether the server closing 
-        the TCP connection between client and server in a
-        proper way
-        """
-        user_test = CommandHandler()
-        user_test.register('test', '12343535373')
-        user_test.login('test','12343535373')
-        user_test.quit()
-        expected_result = "\nLogged Out"
-        obtained_result = user_test.quit()
-        self.assertEqual(expected_result, obtained_result)
-        shutil.rmtree(os.path.join("Root/"))
-        shutil.rmtree("AccessSession/")
-
-
-def step_completed(test_to_use):
-    """
-    This function deals with execution of all the
-    tests in sequence and returns the result
-    """
-
-    load = unittest.TestLoader()
-    suite = unittest.TestSuite()
-
-    suite.addTests(load.loadTestsFromTestCase(test_to_use))
-    runtest = unittest.TextTestRunner(verbosity=2)
-    result = runtest.run(suite)
-
-    if result.skipped:
-        return False
-
-    return result.wasSuccessful()
-
-
-def testing():
-    """
-    This function executes the function of step_completed
-    """
-    print('*'*60 + "\nTesting:\n")
-    return step_completed(TestClient)
-
-if __name__ == "__main__":
-    if testing() is not True:
-        print("\n\tThe tests did not pass,")
-        sys.exit(1)
-
-    sys.exit(0)
\ No newline at end of file
+"""
+This program deals with the testing of
+the server-client application
+"""
+import unittest
+import sys
+from CommandHandler import CommandHandler
+import os
+import shutil
+import asyncio
+import time
+import subprocess
+import functools
+import threading
+import json
+import csv
+import server
+import client
+import protocol
+import benchmark
+from UserRegistry import UserRegistry
+from DirectoryCache import DirectoryCache
+from SessionManager import SessionManager, SqliteSessionManager
+from Metrics import Metrics, Histogram, Timer
+from WriteBehind import WriteBehind
+from PathIndex import PathIndex
+from ChunkStore import ChunkStore, CHUNK_SIZE
+from ColdStorage import ColdStorage, BLOCK_SIZE
+from ResponseCache import ResponseCache
+from DiskUsage import DiskUsage
+from JobManager import JobManager, copy_file
+from FileWatcher import FileWatcher, Subscriber
+
+
+class TestClient(unittest.TestCase):
+    """
+    This class defines the tests that are conducted
+    for the functions defined in the client-server application
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    def test_commands_output(self):
+        """
+        This function deals with testing commands output
+        """
+
+        commands = ["register : For registering the new user ,command:register <username> <password> \n",
+                 "login : To login, command:login <username> <password>,Note:password should be in integer\n",
+                 "quit : To logout, command:quit\n",
+                 
+                 "change_folder : To change the path, command:change_folder <name>\n",
+                 "list : list of all files in the path, command:list [--offset <n>] [--limit <n>] "
+                 "[--sort name|size|mtime] [--reverse] [--format table|csv|json] [--stream]\n",
+                 "read_file : To read content from the file, command:read_file <name> [<characters>]\n",
+                 "write_file : To write content into the file, command:write_file <name>\n",
+                 "create_folder : To create new folder, command:create_folder <name>\n",
+                 "upload : To upload a file in chunks, command:upload <name> <size> (framed protocol)\n",
+                 "download : To download a file in chunks, command:download <name> (framed protocol)\n",
+                 "follow : To receive what is appended to a file as it is written, "
+                 "command:follow <name> [<offset>] (framed protocol)\n",
+                 "unfollow : To stop following a file, command:unfollow <name> (framed protocol)\n",
+                 "find : To find files in all sub folders, command:find [--name <pattern>] "
+                 "[--min-size <n>] [--max-size <n>] [--newer <seconds>] [--older <seconds>] "
+                 "[--type file|dir] [--limit <n>] [--format table|csv|json]\n",
+                 "search : To find files whose name contains a text, command:search <text> [<find options>]\n",
+                 "reindex : To index the files changed outside of the server, command:reindex\n",
+                 "usage : To see the space used and the quota, command:usage\n",
+                 "delete_folder : To delete a folder and all its content, command:delete_folder <name>\n",
+                 "copy : To copy a file or a folder, command:copy <path> <destination>\n",
+                 "move : To move or rename a file or a folder, command:move <path> <destination>\n",
+                 "jobs : To see the progress of delete_folder, copy and move, command:jobs [<job>]\n",
+                 "cancel : To stop a job, command:cancel <job>\n",
+                 "flush : To write the buffered data of a file or of all files, command:flush [<name>]\n",
+                 "fsync : To write the buffered data of a file or of all files to the disk, "
+                 "command:fsync [<name>]\n",
+                 "batch : To run many commands at once, command:batch [--stop-on-error] followed by "
+                 "one command per line\n"
+                ]
+        description = ""
+        for command in commands:
+            description += command
+
+        user_test = CommandHandler()
+        obtained_result = user_test.commands()
+        self.assertEqual(description, obtained_result)
+
+    def test_register_password_length(self):
+        """
+        This function deals with test for registration data 
+        and whether password with length of less than 8 characters 
+        are not getting accepted.
+        """
+        user_test = CommandHandler()
+        expected_result = "\n Password length should be more than 8 characters."
+        obtained_result = user_test.register('test1', '122')
+        self.assertEqual(expected_result, obtained_result)
+        user_test.quit()
+        
+        
+    
+    def test_register_successful_registration(self):
+        """
+        This function deals with test whether the user provided data
+         is being registered successfully
+        """
+
+        user_test = CommandHandler()
+        expected_result = "\nSuccessfully registered user"
+        obtained_result = user_test.register("test2", "13791247nbdshrlfngls")
+        self.assertEqual(expected_result, obtained_result)
+        user_test.quit()
+        shutil.rmtree(os.path.join("Root/test2"))
+        shutil.rmtree(os.path.join("AccessSession/"))
+
+    
+    def test_login(self):
+        """
+        This function deals with test for login data
+        """
+
+        user_test = CommandHandler()
+        user_test.register('test', '123456737')
+        expected_result = ["\nWrong Password, try again"]
+        obtained_result = []
+        tests = [['test', '12345678']]
+        for test in tests:
+            obtained_result.append(user_test.login(test[0], test[1]))
+        user_test.quit()
+        self.assertListEqual(obtained_result, expected_result)
+        shutil.rmtree(os.path.join("Root/"))
+        shutil.rmtree("AccessSession/")
+
+    def test_quit(self):
+        """
+        This function deals whether the server closing 
+        the TCP connection between client and server in a
+        proper way
+        """
+        user_test = CommandHandler()
+        user_test.register('test', '12343535373')
+        user_test.login('test','12343535373')
+        user_test.quit()
+        expected_result = "\nLogged Out"
+        obtained_result = user_test.quit()
+        self.assertEqual(expected_result, obtained_result)
+        shutil.rmtree(os.path.join("Root/"))
+        shutil.rmtree("AccessSession/")
+
+
+class TestUserRegistry(unittest.TestCase):
+    """
+    This class defines the tests for the shared user registry
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    def test_registry_is_shared(self):
+        """
+        This function deals with test whether all the command handlers
+        of the process use the same registry
+        """
+        first = CommandHandler()
+        second = CommandHandler()
+        self.assertIs(first.registry, second.registry)
+        first.register("shared", "sharedpassword")
+        self.assertEqual(second.login("shared", "sharedpassword"),
+                         "Logged into the system successfully!")
+        second.quit()
+
+    def test_registry_reads_quoted_and_blank_lines(self):
+        """
+        This function deals with test whether the csv file is read like
+        before, with quoted fields, blank lines and missing passwords
+        """
+        os.makedirs("AccessSession", exist_ok=True)
+        with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "w") as writer:
+            writer.write('username,password\nplain,secret\n\n"quoted","a,b"\nnopassword\n')
+        registry = UserRegistry(CommandHandler.REGISTERED_USERS_CSV_FILE, CommandHandler.CSV_HEADING)
+        registry.refresh()
+        self.assertEqual(registry.registered, {"plain": "secret", "quoted": "a,b", "nopassword": ""})
+
+    def test_registry_picks_up_external_edits(self):
+        """
+        This function deals with test whether users added to the csv
+        file by another program are seen by the registry
+        """
+        user_test = CommandHandler()
+        user_test.access_user_info()
+        self.assertFalse(user_test.registry.is_registered("outside"))
+        with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "a") as writer:
+            writer.write("outside,outsidepassword\n")
+        os.makedirs("Root/outside")
+        self.assertEqual(user_test.login("outside", "outsidepassword"),
+                         "Logged into the system successfully!")
+        user_test.quit()
+
+
+def logged_in_handler(user_id, password="testpassword"):
+    """
+    This function registers a user and returns a
+    command handler logged in as that user
+    """
+    user_test = CommandHandler()
+    user_test.register(user_id, password)
+    user_test.login(user_id, password)
+    return user_test
+
+
+def remove_test_files():
+    """
+    This function removes Root/ and AccessSession/ after writing the
+    records buffered by the shared path index and disk usage, which
+    would otherwise create their databases again when the tests exit
+    """
+    PathIndex.shared(CommandHandler.PATH_INDEX_DATABASE).flush()
+    DiskUsage.shared(CommandHandler.USAGE_DATABASE).flush()
+    shutil.rmtree("Root/", ignore_errors=True)
+    shutil.rmtree("AccessSession/", ignore_errors=True)
+
+
+class TestReadFile(unittest.TestCase):
+    """
+    This class defines the tests for reading files in windows
+    """
+
+    def setUp(self):
+        self.user_test = logged_in_handler("reader")
+
+    def tearDown(self):
+        self.user_test.quit()
+        remove_test_files()
+
+    def test_read_windows_and_wrap(self):
+        """
+        This function deals with test whether the file is read window
+        by window and starts from the beginning after the end
+        """
+        self.user_test.write_file("log.txt", "abcdefghij")
+        self.assertEqual(self.user_test.read_file("log.txt", 4), "\nRead file from 0 to 4are\nabcd")
+        self.assertEqual(self.user_test.read_file("log.txt", 4), "\nRead file from 4 to 8are\nefgh")
+        self.assertEqual(self.user_test.read_file("log.txt", 4), "\nRead file from 8 to 12are\nij")
+        self.assertEqual(self.user_test.read_file("log.txt", 4), "\nRead file from 0 to 4are\nabcd")
+
+    def test_read_does_not_split_characters(self):
+        """
+        This function deals with test whether a window never ends
+        in the middle of a multi-byte character
+        """
+        self.user_test.write_file("utf.txt", "a\u00e9b")
+        self.assertTrue(self.user_test.read_file("utf.txt", 2).endswith("are\na"))
+        self.assertTrue(self.user_test.read_file("utf.txt", 3).endswith("are\n\u00e9b"))
+
+    def test_read_through_memory_map(self):
+        """
+        This function deals with test whether big files read through
+        a memory map give the same windows
+        """
+        self.user_test.write_file("big.txt", "0123456789")
+        threshold = CommandHandler.MMAP_THRESHOLD
+        CommandHandler.MMAP_THRESHOLD = 1
+        try:
+            self.user_test.read_file("big.txt", 3)
+            self.assertTrue(self.user_test.read_file("big.txt", 3).endswith("are\n345"))
+        finally:
+            CommandHandler.MMAP_THRESHOLD = threshold
+
+
+class TestCommandExecutor(unittest.TestCase):
+    """
+    This class defines the tests for running commands on the thread pool
+    """
+
+    def test_blocking_command_does_not_block_loop(self):
+        """
+        This function deals with test whether the event loop keeps
+        running while a slow command is executed
+        """
+        executor = server.CommandExecutor(threads=1)
+
+        async def scenario():
+            ticks = 0
+            slow = [asyncio.ensure_future(executor.run(time.sleep, 0.2)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            depth = executor.queue_depth
+            while not all(task.done() for task in slow):
+                ticks += 1
+                await asyncio.sleep(0.01)
+            return ticks, depth
+
+        ticks, depth = asyncio.run(scenario())
+        executor.shutdown()
+        self.assertGreater(ticks, 10)
+        self.assertEqual(depth, 2)
+        self.assertEqual(executor.queue_depth, 0)
+
+    def test_connections_share_the_default_executor(self):
+        """
+        This function deals with test whether the connections served
+        without an executor share one thread pool instead of one each
+        """
+        async def scenario():
+            test_server = await asyncio.start_server(server.handle_echo, '127.0.0.1', 0)
+            port = test_server.sockets[0].getsockname()[1]
+            for _ in range(3):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b"commands")
+                await reader.read(4096)
+                writer.close()
+            test_server.close()
+            await test_server.wait_closed()
+
+        init = server.CommandExecutor.__init__
+        created = []
+
+        def counted_init(executor, *args):
+            created.append(executor)
+            init(executor, *args)
+
+        server.CommandExecutor.__init__ = counted_init
+        try:
+            asyncio.run(scenario())
+        finally:
+            server.CommandExecutor.__init__ = init
+        self.assertLessEqual(len(created), 1)
+        self.assertIs(server.CommandExecutor.shared(), server.CommandExecutor.shared())
+
+
+class TestDirectoryCache(unittest.TestCase):
+    """
+    This class defines the tests for the cache of directory listings
+    """
+
+    def setUp(self):
+        self.folder = "cache_test_folder"
+        os.mkdir(self.folder)
+        for name in ("a.txt", "b.txt"):
+            with open(os.path.join(self.folder, name), "w") as file:
+                file.write(name)
+        os.mkdir(os.path.join(self.folder, "sub"))
+        os.utime(self.folder, (time.time() - 60, time.time() - 60))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        remove_test_files()
+
+    def test_listing_is_reused_until_directory_changes(self):
+        """
+        This function deals with test whether an unchanged directory is
+        served from the cache and a changed one is scanned again
+        """
+        cache = DirectoryCache()
+        self.assertEqual(sorted(cache.listing(self.folder)), ["a.txt", "b.txt", "sub"])
+        self.assertTrue(cache.lookup(self.folder, "sub").is_dir)
+        self.assertEqual(cache.lookup(self.folder, "a.txt").size, 5)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        with open(os.path.join(self.folder, "c.txt"), "w") as file:
+            file.write("c")
+        os.utime(self.folder, (time.time() - 30, time.time() - 30))
+        self.assertIsNotNone(cache.lookup(self.folder, "c.txt"))
+        self.assertEqual(cache.misses, 2)
+
+    def test_least_recently_used_listing_is_evicted(self):
+        """
+        This function deals with test whether the cache keeps at most
+        max_entries entries
+        """
+        cache = DirectoryCache(max_entries=4)
+        cache.listing(self.folder)
+        cache.listing(os.path.join(self.folder, "sub"))
+        self.assertEqual(cache.cached_entries, 3)
+        other = os.path.join(self.folder, "sub", "other")
+        os.mkdir(other)
+        for name in ("x", "y"):
+            open(os.path.join(other, name), "w").close()
+        os.utime(other, (time.time() - 60, time.time() - 60))
+        cache.listing(other)
+        self.assertNotIn(os.path.abspath(self.folder), cache.listings)
+        self.assertEqual(cache.cached_entries, 2)
+
+    def test_write_file_updates_listing(self):
+        """
+        This function deals with test whether the sizes shown by list
+        follow the writes of the command handler
+        """
+        user_test = logged_in_handler("cacher")
+        user_test.write_file("log.txt", "12345")
+        os.utime(user_test.current_directory, (time.time() - 60, time.time() - 60))
+        self.assertIn("log.txt | 5 |", user_test.list())
+        user_test.write_file("log.txt", "678")
+        self.assertIn("log.txt | 8 |", user_test.list())
+        self.assertEqual(user_test.create_folder("log.txt"), "\nA file named log.txt already exists")
+        user_test.quit()
+
+
+def run_with_server(scenario, connections=None):
+    """
+    This function starts the server on a free port, runs the
+    scenario coroutine function with the port and stops the server
+    """
+    async def run():
+        executor = server.CommandExecutor(threads=2)
+        test_server = await asyncio.start_server(
+            functools.partial(server.handle_echo, executor=executor, connections=connections), '127.0.0.1', 0)
+        port = test_server.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port)
+        finally:
+            test_server.close()
+            await test_server.wait_closed()
+            executor.shutdown()
+    return asyncio.run(run())
+
+
+class TestProtocol(unittest.TestCase):
+    """
+    This class defines the tests for the line and framed protocols
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    def test_pipelined_framed_commands(self):
+        """
+        This function deals with test whether pipelined commands get
+        their own responses, including payloads bigger than one frame
+        """
+        payload = "x" * (protocol.FRAME_SIZE * 2 + 10)
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            responses = await framed.pipeline([
+                "register piper piperpassword",
+                "login piper piperpassword",
+                "write_file big.txt " + payload,
+                "read_file big.txt 5",
+            ])
+            await framed.request("quit")
+            await framed.close()
+            return responses
+
+        responses = run_with_server(scenario)
+        self.assertEqual(responses[0], "\nSuccessfully registered user")
+        self.assertEqual(responses[1], "Logged into the system successfully!")
+        self.assertTrue(responses[2].startswith("\nCreated and written data"))
+        self.assertEqual(responses[3], "\nRead file from 0 to 5are\nxxxxx")
+        self.assertEqual(os.path.getsize("Root/piper/big.txt"), len(payload))
+
+    def test_line_protocol_still_served(self):
+        """
+        This function deals with test whether clients which do not
+        negotiate the framed protocol keep working
+        """
+        async def scenario(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b"login nobody nobodypassword")
+            response = await reader.read(4096)
+            writer.close()
+            return response
+
+        self.assertEqual(run_with_server(scenario),
+                         b"\nUser not registered, please register to continue")
+
+
+class TestTransfers(unittest.TestCase):
+    """
+    This class defines the tests for the chunked upload and download
+    """
+
+    def setUp(self):
+        self.local = "transfer_source.bin"
+        with open(self.local, "wb") as file:
+            file.write(os.urandom(protocol.FRAME_SIZE * 3 + 123))
+
+    def tearDown(self):
+        for path in (self.local, "transfer_copy.bin"):
+            if os.path.exists(path):
+                os.remove(path)
+        remove_test_files()
+
+    def test_upload_and_download_round_trip(self):
+        """
+        This function deals with test whether a file bigger than one
+        frame is uploaded and downloaded back unchanged
+        """
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            await framed.pipeline(["register mover moverpassword", "login mover moverpassword"])
+            uploaded = await framed.upload(self.local, "data.bin")
+            listing = await framed.request("list")
+            downloaded = await framed.download("data.bin", "transfer_copy.bin")
+            missing = await framed.download("missing.bin", "transfer_copy.bin")
+            await framed.request("quit")
+            await framed.close()
+            return uploaded, listing, downloaded, missing
+
+        uploaded, listing, downloaded, missing = run_with_server(scenario)
+        size = os.path.getsize(self.local)
+        self.assertEqual(uploaded, "\nUploaded " + str(size) + " bytes to file data.bin")
+        self.assertIn("data.bin | " + str(size), listing)
+        self.assertEqual(downloaded, "\nDownloading " + str(size) + " bytes of file data.bin")
+        self.assertEqual(missing, "\nGiven file does not exist")
+        with open(self.local, "rb") as original, open("transfer_copy.bin", "rb") as copy:
+            self.assertEqual(original.read(), copy.read())
+        self.assertEqual([name for name in os.listdir("Root/") if name.startswith(".upload-")], [])
+
+    def test_upload_needs_login(self):
+        """
+        This function deals with test whether an upload without login
+        is refused and the connection can still be used
+        """
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            refused = await framed.upload(self.local, "data.bin")
+            after = await framed.request("list")
+            await framed.close()
+            return refused, after
+
+        self.assertEqual(run_with_server(scenario), (CommandHandler.NOT_LOGGED_IN, CommandHandler.NOT_LOGGED_IN))
+
+
+class TestList(unittest.TestCase):
+    """
+    This class defines the tests for the options of list
+    """
+
+    def setUp(self):
+        self.user_test = logged_in_handler("lister")
+        for name, data in (("b.txt", "bb"), ("a.txt", "aaa"), ("c.txt", "c")):
+            self.user_test.write_file(name, data)
+
+    def tearDown(self):
+        self.user_test.quit()
+        remove_test_files()
+
+    def test_sorted_pages(self):
+        """
+        This function deals with test whether the listing is sorted
+        and cut to the asked page
+        """
+        page = self.user_test.list(offset=1, limit=1, sort="name", output="csv")
+        self.assertEqual(page.splitlines()[1:], ["b.txt,file,2," + page.splitlines()[1].split(",")[3]])
+        rows = self.user_test.list(sort="size", reverse=True, output="json").splitlines()
+        self.assertEqual([json.loads(row)["name"] for row in rows], ["a.txt", "b.txt", "c.txt"])
+        self.assertEqual(self.user_test.list(offset=5, output="json"), "")
+        self.assertEqual(server.parse_list_options(["--sort", "date"]), None)
+        self.assertEqual(server.parse_list_options(["--limit", "2", "--stream", "--reverse"]),
+                         {"limit": 2, "reverse": True})
+
+    def test_streamed_listing(self):
+        """
+        This function deals with test whether a streamed listing arrives
+        in several parts with all the rows
+        """
+        listing_batch = server.LIST_BATCH
+        server.LIST_BATCH = 1
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            await framed.request("login lister testpassword")
+            parts = [part async for part in framed.stream("list --stream --sort name --format json")]
+            await framed.close()
+            return parts
+
+        try:
+            parts = run_with_server(scenario)
+        finally:
+            server.LIST_BATCH = listing_batch
+        self.assertEqual([json.loads(part)["name"] for part in parts], ["a.txt", "b.txt", "c.txt"])
+
+
+class TestSessionManager(unittest.TestCase):
+    """
+    This class defines the tests for the login sessions
+    """
+
+    def tearDown(self):
+        SessionManager.shared().idle_timeout = None
+        remove_test_files()
+
+    def test_sessions_of_several_connections(self):
+        """
+        This function deals with test whether every connection has its
+        own session and logging out one keeps the others
+        """
+        first = logged_in_handler("sessioner")
+        second = CommandHandler()
+        self.assertEqual(second.login("sessioner", "testpassword"), "\nUser logged through another port")
+        self.assertNotEqual(first.session_token, second.session_token)
+        first.quit()
+        self.assertTrue(first.sessions.is_logged_in("sessioner"))
+        self.assertEqual(first.list(), CommandHandler.NOT_LOGGED_IN)
+        self.assertNotEqual(second.list(), CommandHandler.NOT_LOGGED_IN)
+        second.quit()
+        self.assertFalse(second.sessions.is_logged_in("sessioner"))
+
+    def test_idle_session_is_evicted(self):
+        """
+        This function deals with test whether an idle session is closed
+        and its connection has to login again
+        """
+        user_test = logged_in_handler("idler")
+        user_test.sessions.idle_timeout = 60
+        self.assertEqual(user_test.sessions.evict_idle(), 0)
+        self.assertGreaterEqual(user_test.sessions.evict_idle(now=time.monotonic() + 120), 1)
+        self.assertNotIn(user_test.session_token, user_test.sessions.sessions)
+        self.assertEqual(user_test.list(), CommandHandler.NOT_LOGGED_IN)
+        self.assertEqual(user_test.current_directory, CommandHandler.ROOT_DIR)
+
+    def test_snapshot(self):
+        """
+        This function deals with test whether the snapshot lists
+        the open sessions
+        """
+        user_test = logged_in_handler("snapper")
+        user_test.sessions.snapshot(CommandHandler.LOGGED_IN_USERS_CSV_FILE)
+        with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE) as file:
+            rows = list(csv.DictReader(file))
+        self.assertIn(("snapper", user_test.session_token), [(row["username"], row["token"]) for row in rows])
+        user_test.quit()
+
+
+class TestWorkers(unittest.TestCase):
+    """
+    This class defines the tests for the worker processes
+    and the state they share
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    def test_sqlite_sessions_are_shared(self):
+        """
+        This function deals with test whether sessions opened through one
+        connection to the database are seen through another one, and closed
+        by clear()
+        """
+        first = SqliteSessionManager("AccessSession/test_sessions.db")
+        second = SqliteSessionManager("AccessSession/test_sessions.db", idle_timeout=60)
+        token = first.login("worker")
+        self.assertTrue(second.is_logged_in("worker"))
+        self.assertEqual(second.users, {"worker": {token}})
+        self.assertEqual(second.evict_idle(now=second.clock() + 120), 1)
+        self.assertFalse(first.is_logged_in("worker"))
+        self.assertFalse(first.logout(token))
+        first.login("worker")
+        self.assertEqual(second.clear(), 1)
+        self.assertFalse(first.is_logged_in("worker"))
+
+    def test_workers_share_the_port(self):
+        """
+        This function deals with test whether the worker processes serve
+        the same port and share the registered users and sessions
+        """
+        process = subprocess.Popen([sys.executable, "server.py", "--workers", "2", "--port", "0"],
+                                   stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(process.stdout.readline().split(", ")[1].split(")")[0])
+            for _ in range(2):
+                process.stdout.readline()
+
+            async def scenario():
+                connections = [await client.FramedClient.connect('127.0.0.1', port) for _ in range(4)]
+                responses = [await connections[0].request("register forked forkedpassword")]
+                for connection in connections:
+                    responses.append(await connection.request("login forked forkedpassword"))
+                for connection in connections:
+                    await connection.close()
+                return responses
+
+            responses = asyncio.run(scenario())
+        finally:
+            process.terminate()
+            process.wait(10)
+            process.stdout.close()
+        self.assertEqual(responses[:2], ["\nSuccessfully registered user", "Logged into the system successfully!"])
+        self.assertEqual(responses[2:], ["\nUser logged through another port"] * 3)
+
+
+class TestBenchmark(unittest.TestCase):
+    """
+    This class defines smoke tests for the benchmark harness
+    """
+
+    def test_percentile(self):
+        """
+        This function deals with test for the percentiles of the report
+        """
+        samples = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(samples, 0.5), 51)
+        self.assertEqual(benchmark.percentile(samples, 0.99), 99)
+        self.assertEqual(benchmark.percentile([], 0.5), 0.0)
+
+    def test_small_runs(self):
+        """
+        This function deals with test whether the load test and the
+        microbenchmarks run and leave no state behind
+        """
+        working_directory = os.listdir(".")
+        latencies, elapsed = benchmark.run_load_test(clients=2, operations=5, file_size=1024)
+        self.assertEqual(sum(len(samples) for samples in latencies.values()), 2 * 7)
+        results = benchmark.run_microbenchmarks(sizes=(10,), repeat=1)
+        self.assertIn("list", results[10])
+        for file_size in (1024, 2 * 1024 * 1024 + 5):
+            large = benchmark.make_large_file(file_size)
+            self.assertEqual(os.path.getsize(large), file_size)
+            os.remove(large)
+        self.assertEqual(sorted(os.listdir(".")), sorted(working_directory))
+
+    def test_startup_budget(self):
+        """
+        This function deals with test whether importing the server stays
+        within the import time and memory budget, without pandas or numpy
+        """
+        result = benchmark.run_startup_benchmark(runs=3)
+        self.assertEqual(result["heavy_modules"], [])
+        self.assertLess(result["import_ms"], benchmark.STARTUP_LIMITS["import_ms"])
+        self.assertLess(result["peak_kb"], benchmark.STARTUP_LIMITS["peak_kb"])
+        self.assertEqual(result["exceeded"], [])
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    This class defines the tests for the metrics of the server
+    """
+
+    def setUp(self):
+        self.metrics = Metrics.shared()
+        self.metrics.reset()
+
+    def tearDown(self):
+        self.metrics.enabled = False
+        self.metrics.profile_every = None
+        self.metrics.reset()
+        remove_test_files()
+
+    def test_histogram(self):
+        """
+        This function deals with test for the percentiles of the latency histogram
+        """
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.add(0.0002)
+        histogram.add(0.3)
+        self.assertEqual(histogram.percentile(0.5), 0.00025)
+        self.assertEqual(histogram.percentile(0.99), 0.00025)
+        self.assertEqual(histogram.percentile(1.0), 0.3)
+        self.assertEqual(histogram.summary()["count"], 100)
+
+    def test_disabled_metrics(self):
+        """
+        This function deals with test whether nothing is recorded
+        while the metrics are disabled
+        """
+        self.metrics.record("list", 0.1, 10, 10)
+        with Timer(self.metrics, "access_user_info"):
+            pass
+        self.assertEqual(self.metrics.snapshot()["commands"], {})
+        self.assertEqual(self.metrics.snapshot()["timers"], {})
+        self.assertEqual(self.metrics.report(), "\nMetrics are disabled, start the server with --metrics")
+
+    def test_stats_command(self):
+        """
+        This function deals with test whether the stats command reports
+        the commands sent to the server and the profile of the sampled ones
+        """
+        self.metrics.enabled = True
+        self.metrics.profile_every = 2
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            refused = await framed.pipeline(["stats reset", "stats profile"])
+            await framed.pipeline(["register metered testpassword", "login metered testpassword",
+                                   "list", "bogus"])
+            responses = await framed.pipeline(["stats json", "stats profile", "stats", "quit"])
+            await framed.close()
+            return refused, responses[:3]
+
+        refused, (values, profile, text) = run_with_server(scenario)
+        self.assertEqual(refused, [CommandHandler.NOT_LOGGED_IN] * 2)
+        values = json.loads(values)
+        self.assertEqual(set(values["commands"]), {"register", "login", "list", "unknown", "stats"})
+        self.assertEqual(values["commands"]["list"]["count"], 1)
+        self.assertIn("access_user_info", values["timers"])
+        self.assertEqual(values["connections"], 1)
+        self.assertIn("cumulative", profile)
+        self.assertIn("\nlist | 1 | ", text)
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    This class defines the tests for the table of commands
+    """
+
+    def tearDown(self):
+        server.COMMANDS.pop("echo", None)
+
+    def test_arguments(self):
+        """
+        This function deals with test whether the arguments are
+        tokenized once and checked against the table
+        """
+        command, arguments = server.parse_command("write_file notes.txt  two  spaces \n")
+        self.assertEqual((command.name, arguments), ("write_file", ["notes.txt", " two  spaces"]))
+        self.assertEqual(server.parse_command("read_file notes.txt 12")[1], ["notes.txt", 12])
+        self.assertEqual(server.parse_command("read_file notes.txt twelve")[1], None)
+        self.assertEqual(server.parse_command("list --limit 2")[1], [{"limit": 2}])
+        self.assertEqual(server.parse_command("bogus command"), (None, None))
+        self.assertEqual(server.client_request(None, "register onlyname"), "Enter correct command")
+        self.assertEqual(server.client_request(None, "login a b c"), "Enter Right Command")
+        self.assertEqual(server.client_request(None, "create_folder"), "Enter correct command")
+
+    def test_register_command(self):
+        """
+        This function deals with test whether a new command
+        can be added to the table
+        """
+        server.register_command("echo", lambda commandhandler, text: text, 1, 1, rest=True)
+        self.assertEqual(server.client_request(None, "echo hello  world"), "hello  world")
+        with self.assertRaises(ValueError):
+            server.register_command("echo", lambda commandhandler, *words: words, 1, None, rest=True)
+        self.assertEqual(server.command_name("echo hello"), "echo")
+        self.assertEqual(server.command_name("stats json"), "stats")
+        self.assertEqual(server.command_name("bogus"), "unknown")
+
+
+class TestBatch(unittest.TestCase):
+    """
+    This class defines the tests for the batch command
+    """
+
+    def setUp(self):
+        self.user_test = logged_in_handler("batcher")
+
+    def tearDown(self):
+        self.user_test.quit()
+        remove_test_files()
+
+    def run_batch(self, body):
+        return [json.loads(line) for line in server.client_request(self.user_test, body).splitlines()]
+
+    def test_batch(self):
+        """
+        This function deals with test whether every command of a batch
+        runs and reports its own result
+        """
+        results = self.run_batch("batch\ncreate_folder logs\nchange_folder logs\nwrite_file a.txt one\n"
+                                 "write_file a.txt  two\nread_file a.txt\nbogus\nlist --format json")
+        self.assertEqual([result["command"] for result in results],
+                         ["create_folder", "change_folder", "write_file", "write_file", "read_file", "bogus", "list"])
+        self.assertEqual([result["ok"] for result in results], [True, True, True, True, True, False, True])
+        self.assertTrue(results[4]["response"].endswith("one two"))
+        self.assertEqual(json.loads(results[6]["response"])["size"], 7)
+        with open("Root/batcher/logs/a.txt") as file:
+            self.assertEqual(file.read(), "one two")
+
+    def test_stop_on_error(self):
+        """
+        This function deals with test whether a batch stops at the first
+        failed command when asked to
+        """
+        results = self.run_batch("batch --stop-on-error\ncreate_folder once\ncreate_folder once\ncreate_folder twice")
+        self.assertEqual([result["ok"] for result in results], [True, False])
+        self.assertFalse(os.path.exists("Root/batcher/twice"))
+        self.user_test.quit()
+        self.assertEqual(self.run_batch("batch\ncreate_folder twice"),
+                         [{"command": "batch", "ok": False, "response": CommandHandler.NOT_LOGGED_IN}])
+
+    def test_batch_over_framed_protocol(self):
+        """
+        This function deals with test whether the client sends
+        a batch in one request
+        """
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            await framed.request("login batcher testpassword")
+            results = await framed.batch(["create_folder folder" + str(number) for number in range(100)])
+            await framed.close()
+            return results
+
+        results = run_with_server(scenario)
+        self.assertEqual(len(results), 100)
+        self.assertTrue(all(result["ok"] for result in results))
+        self.assertEqual(len(os.listdir("Root/batcher")), 100)
+
+
+class TestWriteBehind(unittest.TestCase):
+    """
+    This class defines the tests for the files kept open by write_file
+    """
+
+    def setUp(self):
+        self.folder = "write_behind_folder"
+        os.mkdir(self.folder)
+        self.path = os.path.join(self.folder, "log.txt")
+
+    def tearDown(self):
+        write_behind = WriteBehind.shared()
+        write_behind.close_all()
+        write_behind.durability = "write"
+        shutil.rmtree(self.folder, ignore_errors=True)
+        remove_test_files()
+
+    def read(self, path=None):
+        with open(path or self.path, "rb") as file:
+            return file.read()
+
+    def test_buffered_appends(self):
+        """
+        This function deals with test whether buffered appends reach the
+        file on flush, once max_buffer bytes are pending or after max_delay
+        """
+        write_behind = WriteBehind("buffered", max_buffer=8, max_delay=0.1)
+        self.assertEqual(write_behind.append(self.path, b"abc"), 3)
+        self.assertEqual(write_behind.append(self.path, b"def"), 6)
+        self.assertEqual(self.read(), b"")
+        write_behind.flush()
+        self.assertEqual(self.read(), b"abcdef")
+        write_behind.append(self.path, b"ghijklmn")
+        self.assertEqual(self.read(), b"abcdefghijklmn")
+        write_behind.append(self.path, b"o")
+        time.sleep(0.5)
+        self.assertEqual(self.read(), b"abcdefghijklmno")
+        write_behind.close_all()
+
+    def test_reopens_removed_files(self):
+        """
+        This function deals with test whether the appends to a file removed
+        or replaced since it was opened go to the new file, and whether at
+        most max_files files are kept open
+        """
+        write_behind = WriteBehind("fsync", max_files=1)
+        write_behind.append(self.path, b"old")
+        os.remove(self.path)
+        self.assertEqual(write_behind.append(self.path, b"new"), 3)
+        self.assertEqual(self.read(), b"new")
+        other = os.path.join(self.folder, "other.txt")
+        write_behind.append(other, b"x")
+        self.assertEqual(list(write_behind.handles), [os.path.abspath(other)])
+        write_behind.close_all()
+
+    def test_fsync_while_the_handle_is_closed(self):
+        """
+        This function deals with test whether an fsync during which the
+        handle of the file is closed, as the LRU does, still succeeds
+        """
+        write_behind = WriteBehind("fsync")
+        fsync = os.fsync
+        closed = []
+
+        def close_during_fsync(descriptor):
+            if not closed:
+                closed.append(descriptor)
+                write_behind.close(self.path)
+            fsync(descriptor)
+
+        os.fsync = close_during_fsync
+        try:
+            self.assertEqual(write_behind.append(self.path, b"synced"), 6)
+        finally:
+            os.fsync = fsync
+        self.assertTrue(closed)
+        self.assertEqual(list(write_behind.handles), [])
+        self.assertEqual(self.read(), b"synced")
+
+    def test_exclusive_holds_only_its_file(self):
+        """
+        This function deals with test whether the buffered appends of a file
+        are written when it is held, and whether the other files are still
+        appended to meanwhile
+        """
+        write_behind = WriteBehind("buffered", max_buffer=1024, max_delay=60)
+        other = os.path.join(self.folder, "other.txt")
+        write_behind.append(self.path, b"held")
+        write_behind.append(other, b"x")
+        with write_behind.exclusive(self.path):
+            self.assertEqual(self.read(), b"held")
+            appender = threading.Thread(target=write_behind.append, args=(other, b"y"))
+            appender.start()
+            appender.join(5)
+            self.assertFalse(appender.is_alive())
+        write_behind.close_all()
+        self.assertEqual(self.read(other), b"xy")
+
+    def test_write_file_through_write_behind(self):
+        """
+        This function deals with test whether write_file appends through the
+        shared table, keeps the cached size up to date and is read back
+        """
+        WriteBehind.shared().durability = "buffered"
+        user_test = logged_in_handler("appender")
+        other_test = logged_in_handler("appender")
+        user_test.write_file("log.txt", "12345")
+        os.utime(user_test.current_directory, (time.time() - 60, time.time() - 60))
+        other_test.write_file("log.txt", "678")
+        self.assertEqual(self.read("Root/appender/log.txt"), b"")
+        self.assertIn("log.txt | 8 |", user_test.list())
+        self.assertEqual(self.read("Root/appender/log.txt"), b"12345678")
+        user_test.write_file("log.txt", "9")
+        self.assertTrue(other_test.read_file("log.txt").endswith("123456789"))
+        user_test.write_file("log.txt", "0")
+        self.assertEqual(server.client_request(user_test, "fsync log.txt"), "\nSynced log.txt")
+        self.assertEqual(self.read("Root/appender/log.txt"), b"1234567890")
+        self.assertEqual(user_test.write_file("..", "x"), "\nA folder named .. already exists")
+        user_test.quit()
+        other_test.quit()
+
+
+class TestPathIndex(unittest.TestCase):
+    """
+    This class defines the tests for find and the path index
+    """
+
+    def setUp(self):
+        self.user_test = logged_in_handler("finder")
+        self.user_test.create_folder("logs")
+        self.user_test.change_folder("logs")
+        self.user_test.write_file("app.log", "x" * 50)
+        self.user_test.create_folder("old")
+        self.user_test.change_folder("old")
+        self.user_test.write_file("app.1.log", "x" * 500)
+        self.user_test.change_folder("..")
+        self.user_test.change_folder("..")
+        self.user_test.write_file("notes.txt", "notes")
+
+    def tearDown(self):
+        self.user_test.quit()
+        PathIndex.shared().max_age = None
+        remove_test_files()
+
+    def find(self, command):
+        return [json.loads(line)["path"] for line in
+                server.client_request(self.user_test, command + " --format json").splitlines()]
+
+    def test_find(self):
+        """
+        This function deals with test whether find searches the whole
+        tree under the current directory with its filters
+        """
+        self.assertEqual(self.find("find --name *.log"), ["logs/app.log", "logs/old/app.1.log"])
+        self.assertEqual(self.find("find --type dir"), ["logs", "logs/old"])
+        self.assertEqual(self.find("find --min-size 100 --type file"), ["logs/old/app.1.log"])
+        self.assertEqual(self.find("find --max-size 60 --type file --limit 1"), ["logs/app.log"])
+        self.assertEqual(self.find("search app.1"), ["logs/old/app.1.log"])
+        self.assertEqual(self.find("find --newer 60 --name notes*"), ["notes.txt"])
+        self.assertEqual(self.find("find --older 60"), [])
+        self.user_test.change_folder("logs")
+        self.assertEqual(self.find("find --type file"), ["app.log", "old/app.1.log"])
+        self.assertEqual(server.client_request(self.user_test, "find --size 3"), "Enter correct command")
+
+    def test_changes_outside_of_the_server(self):
+        """
+        This function deals with test whether the files created outside
+        of the server are found after a reindex or a new scan
+        """
+        self.assertEqual(self.find("find --name outside.txt"), [])
+        with open("Root/finder/logs/outside.txt", "w") as file:
+            file.write("outside")
+        self.assertEqual(self.find("find --name outside.txt"), [])
+        self.assertEqual(server.client_request(self.user_test, "reindex"), "\nIndexed 6 entries")
+        self.assertEqual(self.find("find --name outside.txt"), ["logs/outside.txt"])
+        os.remove("Root/finder/logs/outside.txt")
+        PathIndex.shared().max_age = 0
+        self.assertEqual(self.find("find --name outside.txt"), [])
+
+    def test_writes_during_a_rescan(self):
+        """
+        This function deals with test whether a file written while the tree
+        is walked by a rescan is recorded without waiting for it, and kept
+        """
+        path_index = PathIndex.shared()
+        walk = PathIndex._walk
+
+        def write_while_walking(user_id, root):
+            writer = threading.Thread(target=self.user_test.write_file, args=("during.txt", "during"))
+            writer.start()
+            writer.join(5)
+            self.assertFalse(writer.is_alive())
+            return walk(user_id, root)
+
+        path_index._walk = write_while_walking
+        try:
+            self.assertEqual(server.client_request(self.user_test, "reindex"), "\nIndexed 6 entries")
+        finally:
+            del path_index._walk
+        self.assertEqual(self.find("find --name during.txt"), ["during.txt"])
+
+
+class TestChunkStore(unittest.TestCase):
+    """
+    This class defines the tests for the deduplicating chunk store
+    """
+
+    def setUp(self):
+        self.folder = "chunk_store_folder"
+        os.mkdir(self.folder)
+        self.store = ChunkStore(os.path.join(self.folder, "store"), enabled=True, cache_bytes=3 * CHUNK_SIZE)
+        self.content = os.urandom(2 * CHUNK_SIZE + 100)
+
+    def tearDown(self):
+        chunk_store = ChunkStore.shared()
+        chunk_store.enabled = False
+        shutil.rmtree(self.folder, ignore_errors=True)
+        shutil.rmtree(chunk_store.folder, ignore_errors=True)
+        remove_test_files()
+
+    def import_content(self, name):
+        source = os.path.join(self.folder, "source")
+        with open(source, "wb") as file:
+            file.write(self.content)
+        path = os.path.join(self.folder, name)
+        self.store.import_file(source, path)
+        return path
+
+    def test_duplicates_are_stored_once(self):
+        """
+        This function deals with test whether the same content is stored
+        once and read back from any offset
+        """
+        first = self.import_content("first")
+        second = self.import_content("second")
+        self.assertEqual(os.path.getsize(first), len(self.content))
+        stats = self.store.stats()
+        self.assertEqual(stats["chunks"], 2)
+        self.assertEqual(stats["stored_bytes"], 2 * CHUNK_SIZE + 200)
+        self.assertGreater(stats["dedup_ratio"], 1.9)
+        for offset, count in ((0, 10), (CHUNK_SIZE - 5, 10), (2 * CHUNK_SIZE + 50, 100), (0, 3 * CHUNK_SIZE)):
+            self.assertEqual(self.store.read(second, offset, count), self.content[offset:offset + count])
+        self.assertGreater(self.store.stats()["cache_hits"], 0)
+        self.store.remove(first)
+        self.assertEqual(self.store.stats()["chunks"], 2)
+        self.store.remove(second)
+        self.assertEqual(self.store.stats()["chunks"], 0)
+        self.assertFalse(self.store.manages(second))
+
+    def test_appends_only_write_new_chunks(self):
+        """
+        This function deals with test whether an append stores only
+        the chunks it completes
+        """
+        path = os.path.join(self.folder, "log")
+        self.assertEqual(self.store.append(path, self.content[:100]), 100)
+        self.assertEqual(self.store.stats()["chunks"], 0)
+        self.store.append(path, self.content[100:CHUNK_SIZE + 10])
+        self.assertEqual(self.store.stats()["chunks"], 1)
+        self.store.append(path, self.content[CHUNK_SIZE + 10:])
+        self.assertEqual(self.store.stats()["chunks"], 2)
+        with self.store.open(path) as reader:
+            self.assertEqual(reader.read(len(self.content) + 1), self.content)
+
+    def test_read_while_replaced_and_plain_stats(self):
+        """
+        This function deals with test whether a read whose chunk is removed
+        by a replacement of the file reads the new content, and whether the
+        stats of an unused store do not create its database
+        """
+        path = self.import_content("data.bin")
+        read_chunk = self.store._chunk
+        replaced = []
+
+        def replace_first(digest):
+            if not replaced:
+                replaced.append(digest)
+                self.content = os.urandom(2 * CHUNK_SIZE + 100)
+                self.import_content("data.bin")
+            return read_chunk(digest)
+
+        self.store._chunk = replace_first
+        self.assertEqual(self.store.read(path, 0, len(self.content)), self.content)
+        self.assertFalse(os.path.exists(self.store._chunk_path(replaced[0])))
+        unused = ChunkStore(os.path.join(self.folder, "unused"))
+        self.assertEqual(unused.stats()["chunks"], 0)
+        self.assertFalse(os.path.exists(unused.database))
+
+    def test_commands_with_chunk_store(self):
+        """
+        This function deals with test whether write_file, read_file, list
+        and the transfers keep their behaviour with the chunk store
+        """
+        ChunkStore.shared().enabled = True
+        user_test = logged_in_handler("deduper")
+        user_test.write_file("notes.txt", "hello ")
+        user_test.write_file("notes.txt", "world")
+        self.assertTrue(ChunkStore.shared().manages("Root/deduper/notes.txt"))
+        self.assertEqual(user_test.read_file("notes.txt", 5).split("\n")[-1], "hello")
+        self.assertEqual(user_test.read_file("notes.txt", 50).split("\n")[-1], " world")
+        self.assertIn("notes.txt | 11 |", user_test.list())
+        local = os.path.join(self.folder, "local.bin")
+        with open(local, "wb") as file:
+            file.write(self.content)
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            await framed.request("login deduper testpassword")
+            await framed.upload(local, "one.bin")
+            await framed.upload(local, "two.bin")
+            await framed.download("two.bin", os.path.join(self.folder, "copy.bin"))
+            storage = await framed.request("storage")
+            await framed.close()
+            return storage
+
+        storage = run_with_server(scenario)
+        with open(os.path.join(self.folder, "copy.bin"), "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertIn("chunks: 2\n", storage)
+        user_test.quit()
+
+
+class TestColdStorage(unittest.TestCase):
+    """
+    This class defines the tests for the compression of the cold files
+    """
+
+    def setUp(self):
+        self.folder = "cold_storage_folder"
+        os.mkdir(self.folder)
+        self.storage = ColdStorage(os.path.join(self.folder, "store"), cold_after=60, min_size=1)
+        self.content = b"".join(b"line %d of the log\n" % number for number in range(40000))
+
+    def tearDown(self):
+        cold_storage = ColdStorage.shared()
+        cold_storage.cold_after = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+        shutil.rmtree(cold_storage.folder, ignore_errors=True)
+        remove_test_files()
+
+    def write_log(self, name, age):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as file:
+            file.write(self.content)
+        written = time.time() - age
+        os.utime(path, (written, written))
+        return path
+
+    def test_sweep_compresses_only_cold_files(self):
+        """
+        This function deals with test whether the sweep compresses the
+        files not written for a while, keeping their size and time, and
+        whether any window of them reads back the same bytes
+        """
+        cold = self.write_log("cold.log", 120)
+        warm = self.write_log("warm.log", 0)
+        mtime = os.path.getmtime(cold)
+        self.assertEqual(self.storage.sweep(self.folder), 1)
+        self.assertTrue(self.storage.manages(cold))
+        self.assertFalse(self.storage.manages(warm))
+        self.assertEqual(os.path.getsize(cold), len(self.content))
+        self.assertEqual(os.path.getmtime(cold), mtime)
+        stats = self.storage.stats()
+        self.assertEqual(stats["cold_files"], 1)
+        self.assertGreater(stats["cold_ratio"], 3)
+        for offset, count in ((0, 10), (BLOCK_SIZE - 5, 10), (len(self.content) - 3, 100), (0, len(self.content))):
+            self.assertEqual(self.storage.read(cold, offset, count), self.content[offset:offset + count])
+        self.assertEqual(self.storage.sweep(self.folder), 0)
+
+    def test_appends_after_compression(self):
+        """
+        This function deals with test whether the bytes appended to a
+        compressed file are read back and compressed by the next sweep
+        """
+        cold = self.write_log("cold.log", 120)
+        self.storage.sweep(self.folder)
+        with open(cold, "ab") as file:
+            file.write(b"appended\n")
+        expected = self.content + b"appended\n"
+        self.assertEqual(self.storage.read(cold, len(self.content) - 5, 100), expected[-14:])
+        self.assertEqual(self.storage.sweep(self.folder, now=time.time() + 120), 1)
+        with self.storage.open(cold) as reader:
+            self.assertEqual(reader.read(len(expected) + 1), expected)
+        stored = [name for name in os.listdir(os.path.join(self.folder, "store")) if name.endswith(".z")]
+        self.assertEqual(len(stored), 1)
+
+    def test_reads_during_the_swap(self):
+        """
+        This function deals with test whether the file reads back its bytes
+        while its sparse file replaces it, from this process and from another
+        one, and whether a second sweep at the same time leaves it alone
+        """
+        cold = self.write_log("cold.log", 120)
+        other_process = ColdStorage(os.path.join(self.folder, "store"), cold_after=60, min_size=1)
+        replace = os.replace
+        during = []
+
+        def swap(source, destination):
+            if os.path.basename(source).startswith(".placeholder-"):
+                during.append(other_process.sweep(self.folder))
+                during.append(self.storage.read(cold, 0, 100))
+                reader = threading.Thread(target=lambda: during.append(other_process.read(cold, 0, 100)))
+                reader.start()
+                replace(source, destination)
+                reader.join()
+            else:
+                replace(source, destination)
+
+        os.replace = swap
+        try:
+            self.assertEqual(self.storage.sweep(self.folder), 1)
+        finally:
+            os.replace = replace
+        self.assertEqual(during, [0, self.content[:100], self.content[:100]])
+        self.assertTrue(other_process.manages(cold))
+        self.assertEqual(other_process.read(cold, 0, len(self.content)), self.content)
+
+    def test_disabled_storage_creates_no_database(self):
+        """
+        This function deals with test whether forgetting a file while the
+        cold storage is disabled does not create its database
+        """
+        disabled = ColdStorage(os.path.join(self.folder, "disabled"))
+        disabled.remove(self.write_log("plain.log", 0))
+        self.assertFalse(disabled.manages(os.path.join(self.folder, "plain.log")))
+        self.assertFalse(os.path.exists(disabled.database))
+
+    def test_commands_with_cold_storage(self):
+        """
+        This function deals with test whether read_file, write_file and
+        the transfers keep their behaviour on compressed files
+        """
+        cold_storage = ColdStorage.shared()
+        cold_storage.cold_after = 60
+        user_test = logged_in_handler("archivist")
+        user_test.write_file("old.log", self.content.decode())
+        path = "Root/archivist/old.log"
+        written = time.time() - 120
+        os.utime(path, (written, written))
+        self.assertEqual(cold_storage.sweep("Root/", write_behind=WriteBehind.shared()), 1)
+        self.assertEqual(user_test.read_file("old.log", 18).split("\n", 2)[-1], "line 0 of the log\n")
+        self.assertEqual(user_test.read_file("old.log", 18).split("\n", 2)[-1], "line 1 of the log\n")
+        user_test.write_file("old.log", "new line\n")
+        self.assertTrue(cold_storage.manages(path))
+        self.assertIn("old.log | " + str(len(self.content) + 9) + " |", user_test.list())
+        copy = os.path.join(self.folder, "copy.log")
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port)
+            await framed.request("login archivist testpassword")
+            await framed.download("old.log", copy)
+            await framed.upload(copy, "old.log")
+            await framed.close()
+
+        run_with_server(scenario)
+        with open(copy, "rb") as file:
+            self.assertEqual(file.read(), self.content + b"new line\n")
+        self.assertFalse(cold_storage.manages(path))
+        user_test.quit()
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    This class defines the tests for the cache of the responses of
+    read_file and list
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    @staticmethod
+    def make_old(path, age=60):
+        written = time.time() - age
+        os.utime(path, (written, written))
+
+    def test_lru_eviction(self):
+        """
+        This function deals with test whether the cache keeps at most
+        max_bytes bytes and evicts the least recently used responses
+        """
+        cache = ResponseCache(max_bytes=80)
+        cache.put("a", "x" * 10)
+        cache.put("b", "y" * 10)
+        self.assertEqual(cache.get("a"), "x" * 10)
+        for number in range(7):
+            cache.put(number, "z" * 10)
+        self.assertEqual(cache.get("a"), "x" * 10)
+        self.assertIsNone(cache.get("b"))
+        cache.put("big", "w" * 11)
+        self.assertIsNone(cache.get("big"))
+        stats = cache.stats()
+        self.assertEqual(stats["bytes"], 80)
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (2, 2, 1))
+
+    def test_read_file_is_cached_until_the_file_changes(self):
+        """
+        This function deals with test whether polling an unchanged file
+        is answered from the cache and a change of it is seen
+        """
+        user_test = logged_in_handler("poller")
+        user_test.response_cache = ResponseCache()
+        user_test.write_file("status.txt", "hello world")
+        path = "Root/poller/status.txt"
+        self.make_old(path)
+        first = [user_test.read_file("status.txt", 5) for _ in range(3)]
+        second = [user_test.read_file("status.txt", 5) for _ in range(3)]
+        self.assertEqual(first, second)
+        self.assertEqual(first[2].split("\n")[-1], "d")
+        self.assertEqual(user_test.response_cache.stats()["hits"], 3)
+        user_test.write_file("status.txt", "!")
+        self.make_old(path, 30)
+        user_test.read_file("status.txt", 10)
+        self.assertEqual(user_test.read_file("status.txt", 10).split("\n")[-1], "d!")
+        self.assertEqual(user_test.response_cache.stats()["hits"], 3)
+        user_test.quit()
+
+    def test_list_is_cached_until_the_folder_changes(self):
+        """
+        This function deals with test whether polling an unchanged folder
+        is answered from the cache, and whether writes show in the listing
+        """
+        user_test = logged_in_handler("lister")
+        user_test.response_cache = ResponseCache()
+        user_test.write_file("a.txt", "hello")
+        user_test.create_folder("logs")
+        self.make_old("Root/lister/a.txt")
+        self.make_old("Root/lister")
+        listing = user_test.list(output="json")
+        self.assertEqual(user_test.list(output="json"), listing)
+        self.assertEqual(user_test.response_cache.stats()["hits"], 1)
+        user_test.write_file("a.txt", " world")
+        self.assertIn('"size": 11', user_test.list(output="json"))
+        self.assertNotEqual(user_test.list(sort="size", output="json"), listing)
+        user_test.quit()
+
+
+class TestConnections(unittest.TestCase):
+    """
+    This class defines the tests for the limits and timeouts of the connections
+    """
+
+    def tearDown(self):
+        remove_test_files()
+
+    @staticmethod
+    async def line_request(port, message):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(message.encode())
+        response = await reader.read(4096)
+        return reader, writer, response.decode()
+
+    @staticmethod
+    async def wait_until_closed(manager):
+        for _ in range(100):
+            if not manager.connections:
+                return
+            await asyncio.sleep(0.01)
+
+    def test_closed_client_is_logged_out(self):
+        """
+        This function deals with test whether a client closing the connection
+        ends its handler and its login session
+        """
+        manager = server.ConnectionManager()
+
+        async def scenario(port):
+            reader, writer, _ = await self.line_request(port, "register closer closerpassword")
+            writer.write(b"login closer closerpassword")
+            self.assertIn("successfully", (await reader.read(4096)).decode())
+            writer.close()
+            await self.wait_until_closed(manager)
+            reader, writer, response = await self.line_request(port, "login closer closerpassword")
+            writer.close()
+            await self.wait_until_closed(manager)
+            return response
+
+        self.assertEqual(run_with_server(scenario, manager), "Logged into the system successfully!")
+        self.assertEqual(manager.connections, set())
+
+    def test_failed_command_is_answered(self):
+        """
+        This function deals with test whether a message which is not UTF-8
+        or whose command fails in the server is answered, and whether the
+        connection goes on afterwards
+        """
+        manager = server.ConnectionManager()
+        client_request = server.client_request
+
+        def failing(commandhandler, message):
+            if message == "commands":
+                raise RuntimeError("failed on purpose")
+            return client_request(commandhandler, message)
+
+        async def scenario(port):
+            reader, writer, _ = await self.line_request(port, "register breaker breakerpassword")
+            writer.write(b"login breaker breakerpassword")
+            await reader.read(4096)
+            writer.write(b"\xff\xfe not utf-8")
+            replaced = await reader.read(4096)
+            writer.write(b"commands")
+            failed = await reader.read(4096)
+            writer.write(b"login breaker breakerpassword")
+            after = await reader.read(4096)
+            writer.close()
+            await self.wait_until_closed(manager)
+            return replaced, failed.decode(), after.decode()
+
+        server.client_request = failing
+        try:
+            with self.assertLogs("server", level="ERROR") as logs:
+                replaced, failed, after = run_with_server(scenario, manager)
+        finally:
+            server.client_request = client_request
+        self.assertNotEqual(replaced, b"")
+        self.assertEqual(failed, server.FAILED_MESSAGE)
+        self.assertIn("failed on purpose", "\n".join(logs.output))
+        self.assertEqual(after, "\nAlready Logged In")
+        self.assertEqual(manager.connections, set())
+
+    def test_connection_limit_and_idle_timeout(self):
+        """
+        This function deals with test whether the clients over the limit are
+        refused and the idle clients are disconnected by the sweep
+        """
+        manager = server.ConnectionManager(max_connections=2, idle_timeout=60)
+
+        async def scenario(port):
+            first = await self.line_request(port, "commands")
+            second = await self.line_request(port, "commands")
+            refused = await self.line_request(port, "commands")
+            self.assertEqual(refused[2], server.BUSY_MESSAGE)
+            self.assertEqual(manager.sweep(), 0)
+            self.assertEqual(manager.sweep(time.monotonic() + 61), 2)
+            closed = [await first[0].read(4096), await second[0].read(4096)]
+            for _, writer, _ in (first, second, refused):
+                writer.close()
+            await self.wait_until_closed(manager)
+            return closed
+
+        self.assertEqual(run_with_server(scenario, manager), [b"", b""])
+        self.assertEqual(manager.stats()["rejected"], 1)
+        self.assertEqual(manager.stats()["idle_closed"], 2)
+
+    def test_read_timeout_in_a_frame(self):
+        """
+        This function deals with test whether a framed client which stops
+        in the middle of a frame is disconnected
+        """
+        manager = server.ConnectionManager(read_timeout=0.2)
+
+        async def scenario(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(protocol.HANDSHAKE + protocol.encode_frame(1, b"commands")[:-3])
+            self.assertEqual(await reader.readline(), protocol.HANDSHAKE_ACK)
+            closed = await asyncio.wait_for(reader.read(4096), 5)
+            writer.close()
+            await self.wait_until_closed(manager)
+            return closed
+
+        self.assertEqual(run_with_server(scenario, manager), b"")
+
+    def test_stalled_writer_is_aborted(self):
+        """
+        This function deals with test whether a client which does not read
+        its responses is disconnected once they stop draining
+        """
+        manager = server.ConnectionManager(write_timeout=1, high_water=1024)
+
+        class Writer():
+            def __init__(self, buffered):
+                self.transport = self
+                self.buffered = buffered
+                self.aborted = False
+
+            def is_closing(self):
+                return self.aborted
+
+            def get_write_buffer_size(self):
+                return self.buffered
+
+            def abort(self):
+                self.aborted = True
+
+        stalled = Writer(4096)
+        draining = Writer(4096)
+        for writer in (stalled, draining):
+            manager.connections.add(server.Connection(writer))
+        now = time.monotonic()
+        manager.sweep(now)
+        draining.buffered = 1024
+        self.assertEqual(manager.sweep(now + 0.5), 0)
+        draining.buffered = 512
+        self.assertEqual(manager.sweep(now + 1.2), 1)
+        self.assertTrue(stalled.aborted)
+        self.assertFalse(draining.aborted)
+
+
+class TestDiskUsage(unittest.TestCase):
+    """
+    This class defines the tests for the disk usage of the users and their quotas
+    """
+
+    def tearDown(self):
+        DiskUsage.shared(CommandHandler.USAGE_DATABASE).default_quota = None
+        remove_test_files()
+
+    def test_usage_follows_the_commands(self):
+        """
+        This function deals with test whether write_file, create_folder and
+        upload keep the usage equal to what is on the disk
+        """
+        user_test = logged_in_handler("counter")
+        user_test.write_file("a.txt", "hello")
+        user_test.write_file("a.txt", " world")
+        user_test.create_folder("logs")
+        user_test.change_folder("logs")
+        user_test.write_file("b.txt", "héllo")
+        local = "Root/upload.bin"
+        with open(local, "wb") as file:
+            file.write(b"x" * 100)
+        user_test.change_folder("..")
+        temp_path, error = user_test.start_upload("a.txt", 100)
+        shutil.copy(local, temp_path)
+        user_test.finish_upload(temp_path, "a.txt")
+        os.remove(local)
+        self.assertEqual(user_test.usage(), "\nUsed: 106 bytes in 2 files and 1 folders | Quota: none")
+        self.assertEqual(DiskUsage._walk("Root/counter"), (106, 2, 1))
+        user_test.disk_usage.flush()
+        with open("Root/counter/outside.txt", "w") as file:
+            file.write("written outside of the server")
+        self.assertIn("Used: 106 bytes", user_test.usage())
+        user_test.disk_usage.reconcile("counter", "Root/counter")
+        self.assertIn("Used: 135 bytes in 3 files", user_test.usage())
+        user_test.quit()
+
+    def test_write_file_under_a_folder(self):
+        """
+        This function deals with test whether writing twice to a file given
+        with its folder counts the file once
+        """
+        user_test = logged_in_handler("nested")
+        user_test.create_folder("sub")
+        self.assertIn("Created", user_test.write_file("sub/file", "hello"))
+        self.assertIn("Success", user_test.write_file("sub/file", " world"))
+        self.assertEqual(user_test.usage(), "\nUsed: 11 bytes in 1 files and 1 folders | Quota: none")
+        self.assertEqual(DiskUsage._walk("Root/nested"), (11, 1, 1))
+        user_test.quit()
+
+    def test_quota_is_enforced(self):
+        """
+        This function deals with test whether writes and uploads over the
+        quota of the user are refused
+        """
+        user_test = logged_in_handler("limited")
+        user_test.disk_usage.default_quota = 20
+        self.assertIn("successfully", user_test.write_file("a.txt", "x" * 15))
+        self.assertEqual(user_test.write_file("a.txt", "x" * 10),
+                         "\nQuota exceeded: 10 more bytes would make 25 of the 20 bytes allowed")
+        self.assertIn("Quota: 20 bytes (75.0% used)", user_test.usage())
+        self.assertIsNone(user_test.start_upload("b.txt", 6)[0])
+        temp_path, error = user_test.start_upload("a.txt", 20)
+        self.assertIsNone(error)
+        user_test.abort_upload(temp_path)
+        user_test.disk_usage.set_quota("limited", "Root/limited", 100)
+        self.assertIn("successfully", user_test.write_file("a.txt", "x" * 10))
+        user_test.disk_usage.set_quotas("Root/", {})
+        self.assertIn("Quota: 20 bytes", user_test.usage())
+        user_test.disk_usage.set_quotas("Root/", {"limited": 50})
+        self.assertIn("Quota: 50 bytes", user_test.usage())
+        user_test.quit()
+        self.assertEqual(server.parse_size("64K"), 65536)
+        self.assertEqual(server.parse_user_quota("alice=1.5G"), ("alice", 3 * 1024 ** 3 // 2))
+
+    def test_changes_during_a_reconcile(self):
+        """
+        This function deals with test whether the changes made while a
+        folder is walked are counted once by the reconcile, whether the
+        walk had reached their folder or not
+        """
+        os.makedirs("Root/walked/sub")
+        with open("Root/walked/file", "w") as file:
+            file.write("1234")
+        usage = DiskUsage("AccessSession/walk_usage.db")
+        walk = DiskUsage._walk
+
+        def write(path, data):
+            with open(path, "w") as file:
+                file.write(data)
+            usage.add("walked", len(data), 1, path=path)
+
+        def walk_and_write(root, passed):
+            write("Root/walked/sub/early", "12345")
+            found = walk(root, passed)
+            write("Root/walked/late", "1234567890")
+            return found
+
+        usage._walk = walk_and_write
+        self.assertEqual(usage.reconcile("walked", "Root/walked")[:3], (19, 3, 1))
+        usage.flush()
+        self.assertEqual(usage.usage("walked", "Root/walked")[:3], (19, 3, 1))
+        self.assertEqual(DiskUsage._walk("Root/walked"), (19, 3, 1))
+
+
+class TestTreeJobs(unittest.TestCase):
+    """
+    This class defines the tests for delete_folder, copy and move and their jobs
+    """
+
+    def tearDown(self):
+        chunk_store = ChunkStore.shared()
+        chunk_store.enabled = False
+        shutil.rmtree(chunk_store.folder, ignore_errors=True)
+        remove_test_files()
+
+    @staticmethod
+    def make_tree(user_test):
+        user_test.create_folder("logs")
+        user_test.change_folder("logs")
+        user_test.write_file("a.txt", "first")
+        user_test.create_folder("old")
+        user_test.change_folder("old")
+        user_test.write_file("b.txt", "second")
+        user_test.create_folder("empty")
+        user_test.change_folder("..")
+        user_test.change_folder("..")
+
+    def test_failed_items_are_counted(self):
+        """
+        This function deals with test whether any error of a file of a job,
+        not only an OSError, is counted as a failed file
+        """
+        manager = JobManager(threads=2)
+
+        def work(job, item):
+            if item == "broken":
+                raise ValueError("bad manifest")
+            job.advance(1)
+
+        job = manager.start("worker", "test", ["Root/worker"],
+                            lambda job: manager.fan_out(job, functools.partial(work, job), ["a", "broken", "b"]))
+        self.assertTrue(manager.wait(job, 10))
+        manager.pool.shutdown()
+        self.assertEqual((job.state, job.files, job.errors), ("done", 2, 1))
+        self.assertEqual(job.first_error, "broken: bad manifest")
+
+    def test_delete_folder(self):
+        """
+        This function deals with test whether delete_folder removes a whole
+        tree and takes it out of the usage and the path index
+        """
+        user_test = logged_in_handler("cleaner")
+        self.make_tree(user_test)
+        user_test.write_file("keep.txt", "kept")
+        user_test.change_folder("logs")
+        self.assertEqual(user_test.delete_folder("../logs"), "\nCannot delete the current directory")
+        user_test.change_folder("..")
+        self.assertEqual(user_test.delete_folder("keep.txt"), "\n No such directory exists")
+        self.assertEqual(user_test.delete_folder("../other"), "\n No such directory exists")
+        self.assertEqual(user_test.delete_folder("logs"), "\nDeleted folder logs: 2 files, 3 folders, 11 bytes")
+        self.assertEqual(os.listdir("Root/cleaner"), ["keep.txt"])
+        self.assertNotIn("logs", user_test.list())
+        self.assertEqual(user_test.usage(), "\nUsed: 4 bytes in 1 files and 0 folders | Quota: none")
+        self.assertNotIn("a.txt", user_test.find())
+        user_test.quit()
+
+    def test_copy_and_move(self):
+        """
+        This function deals with test whether copy and move copy and rename
+        trees, files stored as chunks included, and keep the usage and the
+        path index right
+        """
+        user_test = logged_in_handler("mover")
+        self.make_tree(user_test)
+        ChunkStore.shared().enabled = True
+        user_test.write_file("chunked.txt", "stored as chunks")
+        self.assertEqual(user_test.copy("logs", "backup"), "\nCopied logs to backup: 2 files, 3 folders, 11 bytes")
+        with open("Root/mover/backup/old/b.txt") as file:
+            self.assertEqual(file.read(), "second")
+        self.assertEqual(user_test.copy("logs", "logs/old"), "\nCannot copy or move a folder into itself")
+        self.assertEqual(user_test.copy("logs", "backup/.."), "\nA file or folder named logs already exists")
+        self.assertEqual(user_test.copy("chunked.txt", "backup"),
+                         "\nCopied chunked.txt to backup: 1 files, 0 folders, 16 bytes")
+        self.assertTrue(ChunkStore.shared().manages("Root/mover/backup/chunked.txt"))
+        self.assertEqual(user_test.move("backup", "logs/old"), "\nMoved backup to logs/old")
+        self.assertEqual(user_test.move("chunked.txt", "renamed.txt"), "\nMoved chunked.txt to renamed.txt")
+        self.assertEqual(user_test.read_file("renamed.txt").split("\n")[-1], "stored as chunks")
+        user_test.change_folder("logs")
+        user_test.change_folder("old")
+        user_test.change_folder("backup")
+        self.assertEqual(user_test.read_file("chunked.txt").split("\n")[-1], "stored as chunks")
+        user_test.change_folder("..")
+        self.assertEqual(user_test.move("..", "other"), "\nCannot move the current directory")
+        self.assertEqual(user_test.move("backup", "../../gone"), "\nMoved backup to ../../gone")
+        found = user_test.find(kind="file", output="csv")
+        self.assertIn("\nb.txt,", found)
+        user_test.change_folder("..")
+        user_test.change_folder("..")
+        self.assertIn("gone/old/b.txt", user_test.find(name="b.txt"))
+        self.assertEqual(user_test.usage(), "\nUsed: 54 bytes in 6 files and 6 folders | Quota: none")
+        self.assertEqual(DiskUsage._walk("Root/mover"), (54, 6, 6))
+        user_test.quit()
+
+    def test_jobs_and_cancel(self):
+        """
+        This function deals with test whether a long job runs in the
+        background with its progress, keeps other jobs off its paths and
+        can be cancelled
+        """
+        user_test = logged_in_handler("waiter")
+        self.make_tree(user_test)
+        started = threading.Event()
+
+        def long_job(job):
+            job.total_files = 10
+            job.advance(3)
+            started.set()
+            job.cancelled.wait(10)
+            return "\nStopped after " + str(job.files) + " files"
+
+        job = user_test.job_manager.start("waiter", "wait logs", ["Root/waiter/logs"], long_job)
+        started.wait(10)
+        self.assertIn("\n" + str(job.job_id) + " | wait logs | running | 1 of 10 files | 3 bytes |",
+                      user_test.jobs())
+        self.assertEqual(user_test.delete_folder("logs"), "\nAnother job is running on logs")
+        self.assertEqual(user_test.cancel(job.job_id + 1), "\nNo running job " + str(job.job_id + 1))
+        self.assertEqual(user_test.cancel(job.job_id), "\nStopped after 1 files")
+        self.assertIn("| wait logs | cancelled |", user_test.jobs(job.job_id))
+        self.assertEqual(logged_in_handler("other").jobs(job.job_id), "\nNo such job " + str(job.job_id))
+        self.assertIn("Deleted folder logs", user_test.delete_folder("logs"))
+        self.assertEqual(server.job_arguments(["7"]), [7])
+        self.assertIsNone(server.job_arguments(["seven"]))
+
+    def test_copy_file(self):
+        """
+        This function deals with test whether copy_file copies empty, small
+        and large files exactly
+        """
+        os.makedirs("Root/copies")
+        for size in (0, 10, 3 * 1024 * 1024 + 7):
+            content = os.urandom(size)
+            source = "Root/copies/source" + str(size)
+            with open(source, "wb") as file:
+                file.write(content)
+            self.assertEqual(copy_file(source, source + ".copy"), size)
+            with open(source + ".copy", "rb") as file:
+                self.assertEqual(file.read(), content)
+            self.assertRaises(FileExistsError, copy_file, source, source + ".copy")
+
+
+class TestFollow(unittest.TestCase):
+    """
+    This class defines the tests for the follow command pushing the appends to a file
+    """
+
+    def tearDown(self):
+        FileWatcher.shared().poll_seconds = None
+        remove_test_files()
+
+    @staticmethod
+    async def follower(port, offset=None):
+        framed = await client.FramedClient.connect('127.0.0.1', port)
+        await framed.request("login tailer testpassword")
+        parts = framed.follow("log.txt", offset)
+        return framed, parts, await parts.__anext__()
+
+    @staticmethod
+    async def read_until(parts, text):
+        received = ""
+        while text not in received:
+            received += await asyncio.wait_for(parts.__anext__(), 10)
+        return received
+
+    def follow_appends(self):
+        logged_in_handler("tailer").write_file("log.txt", "start\n")
+
+        async def scenario(port):
+            writer = await client.FramedClient.connect('127.0.0.1', port)
+            await writer.request("login tailer testpassword")
+            first, first_parts, first_header = await self.follower(port)
+            second, second_parts, second_header = await self.follower(port, 0)
+            stats = FileWatcher.shared().stats()
+            await writer.request("write_file log.txt one")
+            received = [await self.read_until(first_parts, "one"), await self.read_until(second_parts, "one")]
+            await writer.request("write_file log.txt twó")
+            received[0] += await self.read_until(first_parts, "twó")
+            await first.unfollow("log.txt")
+            ending = await asyncio.wait_for(first_parts.__anext__(), 10)
+            self.assertEqual(await first.request("list"), await writer.request("list"))
+            os.remove("Root/tailer/log.txt")
+            received[1] += await self.read_until(second_parts, "Stopped")
+            for framed in (writer, first, second):
+                await framed.close()
+            return first_header, second_header, stats, received, ending
+
+        return run_with_server(scenario)
+
+    def test_follow_with_inotify(self):
+        """
+        This function deals with test whether two followers of a file get
+        the bytes appended to it pushed from one watch, from the end or
+        from an offset, until they unfollow or the file is removed
+        """
+        first_header, second_header, stats, received, ending = self.follow_appends()
+        self.assertEqual(first_header, "\nFollowing file log.txt from byte 6")
+        self.assertEqual(second_header, "\nFollowing file log.txt from byte 0")
+        self.assertEqual(stats["files"], 1)
+        self.assertEqual(stats["subscribers"], 2)
+        self.assertEqual(stats["mode"], "inotify")
+        self.assertEqual(received[0], "onetwó")
+        self.assertEqual(received[1], "start\nonetwó\nStopped following log.txt: removed")
+        self.assertEqual(ending, "\nStopped following log.txt: unfollowed")
+        self.assertEqual(FileWatcher.shared().stats()["files"], 0)
+
+    def test_follow_by_polling(self):
+        """
+        This function deals with test whether the files are followed
+        by polling them when inotify is not used
+        """
+        FileWatcher.shared().poll_seconds = 0.05
+        first_header, second_header, stats, received, ending = self.follow_appends()
+        self.assertEqual(stats["mode"], "poll")
+        self.assertEqual(received[1], "start\nonetwó\nStopped following log.txt: removed")
+
+    def test_slow_follower_reads_what_it_missed(self):
+        """
+        This function deals with test whether a follower which fell more
+        than MAX_QUEUED bytes behind reads the bytes it missed from the file
+        """
+        os.makedirs("Root/slow")
+        path = "Root/slow/big.log"
+        with open(path, "wb") as file:
+            file.write(b"a")
+
+        async def read(path, offset, count):
+            with open(path, "rb") as file:
+                file.seek(offset)
+                return file.read(count)
+
+        async def scenario():
+            watcher = FileWatcher(poll_seconds=60)
+            subscriber = watcher.follow(path, 0, 1, lambda function, *args: function(*args), read)
+            content = b"a"
+            for part in range(5):
+                data = os.urandom(Subscriber.MAX_QUEUED // 2 + 1)
+                content += data
+                with open(path, "ab") as file:
+                    file.write(data)
+                await subscriber.watch.check()
+            received = b""
+            while len(received) < len(content):
+                received += await subscriber.read()
+            watcher.unfollow(subscriber)
+            self.assertIsNone(await subscriber.read())
+            return received, content, watcher.stats()
+
+        received, content, stats = asyncio.run(scenario())
+        self.assertEqual(received, content)
+        self.assertEqual(stats["files"], 0)
+
+
+class TestClientPool(unittest.TestCase):
+    """
+    This class defines the tests for the client library and its pool of connections
+    """
+
+    def setUp(self):
+        self.local = "PoolFiles"
+        os.makedirs(self.local, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.local, ignore_errors=True)
+        remove_test_files()
+
+    def test_typed_methods(self):
+        """
+        This function deals with test whether the methods of the client
+        build the command lines of the commands and their options
+        """
+        logged_in_handler("typed")
+
+        async def scenario(port):
+            framed = await client.FramedClient.connect('127.0.0.1', port, timeout=10)
+            responses = [await framed.login("typed", "testpassword"),
+                         await framed.create_folder("docs"),
+                         await framed.write_file("a.txt", "hello world"),
+                         await framed.read_file("a.txt", 5),
+                         await framed.list(sort="name", output="json"),
+                         await framed.find(kind="file", output="csv"),
+                         await framed.copy("a.txt", "docs/b.txt"),
+                         await framed.usage()]
+            await framed.close()
+            return responses
+
+        responses = run_with_server(scenario)
+        self.assertEqual(responses[0], "\nUser logged through another port")
+        self.assertEqual(responses[1], "\nSuccessfully created directory docs")
+        self.assertEqual(responses[3], "\nRead file from 0 to 5are\nhello")
+        self.assertEqual([json.loads(line)["name"] for line in responses[4].splitlines()], ["a.txt", "docs"])
+        self.assertIn("\na.txt,file,11,", responses[5])
+        self.assertEqual(responses[6], "\nCopied a.txt to docs/b.txt: 1 files, 0 folders, 11 bytes")
+        self.assertTrue(responses[7].startswith("\nUsed: 22 bytes in 2 files and 1 folders"))
+
+    def test_parallel_transfers(self):
+        """
+        This function deals with test whether the pool uploads, reads and
+        downloads many files over its connections, in the folder asked for
+        """
+        logged_in_handler("pooled")
+        contents = {}
+        for number in range(8):
+            name = "file" + str(number) + ".bin"
+            contents[name] = os.urandom(number * protocol.FRAME_SIZE // 3 + 1)
+            with open(os.path.join(self.local, name), "wb") as file:
+                file.write(contents[name])
+        downloads = os.path.join(self.local, "downloads")
+        os.mkdir(downloads)
+
+        async def scenario(port):
+            async with client.ClientPool("pooled", "testpassword", port=port, size=3, timeout=10) as pool:
+                await pool.request("create_folder data")
+                uploaded = await pool.upload_many([os.path.join(self.local, name) for name in contents], "data")
+                read = await pool.read_many(list(contents), "data/")
+                downloaded = await pool.download_many(list(contents), downloads, "/data")
+                listed = await pool.request("list")
+                with self.assertRaises(client.ClientError):
+                    await pool.read_many(["missing.bin"], "data")
+                return uploaded, read, downloaded, listed, len(pool.idle)
+
+        uploaded, read, downloaded, listed, opened = run_with_server(scenario)
+        self.assertTrue(all("uploaded" in response.lower() for response in uploaded), uploaded)
+        self.assertEqual(read, contents)
+        self.assertEqual(len(downloaded), len(contents))
+        for name, content in contents.items():
+            with open(os.path.join(downloads, name), "rb") as file:
+                self.assertEqual(file.read(), content)
+        self.assertIn("data", listed)
+        self.assertNotIn("file0.bin", listed)
+        self.assertEqual(opened, 3)
+
+    def test_retry_and_timeout(self):
+        """
+        This function deals with test whether an operation is run again on
+        a new connection when its connection was closed, and whether a
+        server which does not answer raises asyncio.TimeoutError
+        """
+        logged_in_handler("retried")
+
+        async def silent(reader, writer):
+            await reader.read()
+            writer.close()
+
+        async def scenario(port):
+            pool = client.ClientPool("retried", "testpassword", port=port, size=1, timeout=10, retry_delay=0)
+            await pool.request("usage")
+            dropped = pool.idle[0]
+            dropped.writer.close()
+            await dropped.receiving
+            usage = await pool.request("usage")
+            replaced = pool.idle[0] is not dropped
+            await pool.close()
+            silent_server = await asyncio.start_server(silent, '127.0.0.1', 0)
+            silent_port = silent_server.sockets[0].getsockname()[1]
+            pool = client.ClientPool("retried", "testpassword", port=silent_port, timeout=0.2, retries=1)
+            try:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await pool.request("usage")
+            finally:
+                await pool.close()
+                silent_server.close()
+                await silent_server.wait_closed()
+            return usage, replaced
+
+        usage, replaced = run_with_server(scenario)
+        self.assertTrue(usage.startswith("\nUsed:"))
+        self.assertTrue(replaced)
+
+    def test_only_read_only_commands_are_retried(self):
+        """
+        This function deals with test whether a command whose connection
+        is lost after it was sent is run again only when it is read only
+        """
+        received = []
+
+        async def dying(reader, writer):
+            await reader.readexactly(len(protocol.HANDSHAKE))
+            writer.write(protocol.HANDSHAKE_ACK)
+            frames = protocol.FrameReader(reader)
+            while True:
+                frame = await frames.read_frame()
+                if frame is None:
+                    break
+                command = frame[2].decode()
+                if command.startswith("login "):
+                    writer.write(protocol.encode_message(frame[0], b"Logged into the system successfully!"))
+                    continue
+                received.append(command)
+                break
+            writer.close()
+
+        async def scenario():
+            dying_server = await asyncio.start_server(dying, '127.0.0.1', 0)
+            port = dying_server.sockets[0].getsockname()[1]
+            pool = client.ClientPool("dying", "testpassword", port=port, timeout=10, retries=2, retry_delay=0)
+            try:
+                for command in ("create_folder once", "usage"):
+                    with self.assertRaises(ConnectionError):
+                        await pool.request(command)
+            finally:
+                await pool.close()
+                dying_server.close()
+                await dying_server.wait_closed()
+
+        asyncio.run(scenario())
+        self.assertEqual(received, ["create_folder once"] + ["usage"] * 3)
+
+
+def step_completed(test_to_use):
+    """
+    This function deals with execution of all the
+    tests in sequence and returns the result
+    """
+
+    load = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(load.loadTestsFromTestCase(test_to_use))
+    runtest = unittest.TextTestRunner(verbosity=2)
+    result = runtest.run(suite)
+
+    if result.skipped:
+        return False
+
+    return result.wasSuccessful()
+
+
+def testing():
+    """
+    This function executes the function of step_completed
+    """
+    print('*'*60 + "\nTesting:\n")
+    test_cases = [
+        TestClient,
+        TestUserRegistry,
+        TestReadFile,
+        TestDirectoryCache,
+        TestCommandExecutor,
+        TestProtocol,
+        TestTransfers,
+        TestList,
+        TestSessionManager,
+        TestWorkers,
+        TestBenchmark,
+        TestMetrics,
+        TestDispatcher,
+        TestBatch,
+        TestWriteBehind,
+        TestPathIndex,
+        TestChunkStore,
+        TestColdStorage,
+        TestResponseCache,
+        TestConnections,
+        TestDiskUsage,
+        TestTreeJobs,
+        TestFollow,
+        TestClientPool,
+    ]
+    results = [step_completed(test_case) for test_case in test_cases]
+    return all(results)
+
+
+if __name__ == "__main__":
+    if testing() is not True:
+        print("\n\tThe tests did not pass,")
+        sys.exit(1)
+
+    sys.exit(0)